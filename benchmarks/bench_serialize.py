@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+'''
+Compares pickle with the flexpay.serialize formats for size and encode/decode time.
+
+    $ python benchmarks/bench_serialize.py
+'''
+import cPickle
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flexpay import serialize
+from flexpay.response import Response, make_response
+from run import SMALL_XML, large_xml
+
+def canonical(resp):
+    # Children sorted by name, the order of a response's attribute dict isn't preserved by every format.
+    children = []
+    for name in sorted(resp._attrs or ()):
+        for child in resp.getlist(name):
+            children.append((name, canonical(child) if isinstance(child, Response) else child))
+    return type(resp).__name__, resp.get_name(), resp.value, children
+
+def codecs():
+    yield 'pickle', lambda r: cPickle.dumps(r, 2), cPickle.loads
+    yield 'pickle (no text)', None, cPickle.loads
+    for name in sorted(serialize.FORMATS):
+        if name == 'msgpack' and serialize.msgpack is None:
+            continue
+        yield name, lambda r, name=name: serialize.dumps(r, name), lambda d, name=name: serialize.loads(d, name)
+
+def main():
+    samples = [
+        ('GetTransactionStatus', make_response(SMALL_XML, 'GetTransactionStatus'),
+         make_response(SMALL_XML, 'GetTransactionStatus', keep_text=False), 5000),
+        ('GetAccountActivity x1000', make_response(large_xml(), 'GetAccountActivity'),
+         make_response(large_xml(), 'GetAccountActivity', keep_text=False), 10),
+    ]
+    for label, resp, bare, number in samples:
+        expected = canonical(bare)
+        print label
+        print '  {0:18} {1:>10} {2:>12} {3:>12}'.format('format', 'bytes', 'encode us', 'decode us')
+        for name, encode, decode in codecs():
+            if encode is None:
+                # What pickling saves by leaving out ResponseText, for a fair comparison.
+                encode, source = (lambda r: cPickle.dumps(r, 2)), bare
+            else:
+                source = resp
+            data = encode(source)
+            decoded = decode(data)
+            decoded._attrs.pop('ResponseText', None)
+            assert canonical(decoded) == expected, name
+            enc = min(timeit.repeat(lambda: encode(source), number=number, repeat=3)) / number
+            dec = min(timeit.repeat(lambda: decode(data), number=number, repeat=3)) / number
+            print '  {0:18} {1:10d} {2:12.1f} {3:12.1f}'.format(name, len(data), enc * 1e6, dec * 1e6)
+
+if __name__ == '__main__':
+    main()
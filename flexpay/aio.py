@@ -0,0 +1,425 @@
+'''
+Asynchronous client for event loop based applications.
+
+This module needs `trollius <https://pypi.python.org/pypi/trollius>`_, the asyncio port for Python 2.
+Install it with ``pip install flexpay[async]``.
+'''
+import socket
+import ssl
+import sys
+import time
+import urllib
+from urlparse import urlsplit
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    asyncio = None
+
+from flexpay.batch import BatchResult
+from flexpay.exceptions import RestAPIException
+from flexpay.payment import FlexPay, SandboxAPI, CurrencyCode
+from flexpay.response import make_response
+from flexpay.results import VerificationStatus
+from flexpay.verify import split_url
+
+__all__ = ["AsyncPooledTransport", "AsyncFlexPay"]
+
+def _require_asyncio():
+    if asyncio is None:
+        raise ImportError('flexpay.aio requires the trollius package.')
+
+def _coroutine(f):
+    # Defer to asyncio.coroutine when it's available so the module can still be imported without it.
+    if asyncio is None:
+        return f
+    return asyncio.coroutine(f)
+
+class _Connection(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.time()
+
+    def close(self):
+        self.writer.close()
+
+class _HostPool(object):
+    def __init__(self, scheme, host, port, max_size, idle_timeout, timeout, ssl_context, loop):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.loop = loop
+        self.slots = asyncio.Semaphore(max_size, loop=loop)
+        self.idle = []
+
+    @_coroutine
+    def acquire(self):
+        yield From(self.slots.acquire())
+        now = time.time()
+        while self.idle:
+            conn = self.idle.pop()
+            if now - conn.last_used < self.idle_timeout and not conn.reader.at_eof():
+                raise Return((conn, True))
+            conn.close()
+        try:
+            if self.scheme == 'https':
+                connect = asyncio.open_connection(self.host,
+                                                  self.port,
+                                                  ssl=self.ssl_context,
+                                                  server_hostname=self.host,
+                                                  loop=self.loop)
+            else:
+                connect = asyncio.open_connection(self.host, self.port, loop=self.loop)
+            reader, writer = yield From(asyncio.wait_for(connect, self.timeout, loop=self.loop))
+        except:
+            self.slots.release()
+            raise
+        raise Return((_Connection(reader, writer), False))
+
+    def release(self, conn, reusable):
+        if reusable:
+            conn.last_used = time.time()
+            self.idle.append(conn)
+        else:
+            conn.close()
+        self.slots.release()
+
+    def close(self):
+        idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+@_coroutine
+def _read_body(reader, headers):
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = yield From(reader.readline())
+            size = int(size.split(';', 1)[0].strip(), 16)
+            if size == 0:
+                # Skip any trailers.
+                while (yield From(reader.readline())) not in ('\r\n', '\n', ''):
+                    pass
+                break
+            chunks.append((yield From(reader.readexactly(size))))
+            yield From(reader.readline())
+        raise Return(''.join(chunks))
+    if 'content-length' in headers:
+        body = yield From(reader.readexactly(int(headers['content-length'])))
+        raise Return(body)
+    body = yield From(reader.read())
+    raise Return(body)
+
+@_coroutine
+def _read_response(reader):
+    status_line = yield From(reader.readline())
+    if not status_line:
+        raise IOError('Connection closed before a response was received.')
+    version, status, reason = (status_line.rstrip('\r\n').split(' ', 2) + [''])[:3]
+    headers = {}
+    while True:
+        line = yield From(reader.readline())
+        if line in ('\r\n', '\n', ''):
+            break
+        name, value = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    body = yield From(_read_body(reader, headers))
+    keep_alive = headers.get('connection', '').lower() != 'close' and\
+                 version != 'HTTP/1.0' and\
+                 ('content-length' in headers or 'transfer-encoding' in headers)
+    raise Return((int(status), reason, body, keep_alive))
+
+class AsyncPooledTransport(object):
+    '''
+    A non-blocking pool of keep-alive connections, one pool per host. The asynchronous counterpart
+    of :py:class:`flexpay.transport.PooledTransport`.
+
+        :param max_size: Maximum number of open connections per host.
+
+        :param idle_timeout: Seconds a connection may sit unused before it's closed.
+
+        :param timeout: Seconds to wait for a connection, for the request to be sent and for the response, the
+            default is the global socket timeout. ``asyncio.TimeoutError`` is raised when one of them takes longer.
+
+        :param ssl_context: The ``ssl.SSLContext`` used for every HTTPS connection.
+
+        :param loop: The event loop, the default is ``asyncio.get_event_loop()``.
+    '''
+
+    def __init__(self,
+                 max_size=100,
+                 idle_timeout=30.0,
+                 timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                 ssl_context=None,
+                 loop=None):
+        _require_asyncio()
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        if ssl_context is None:
+            ssl_context = ssl.create_default_context()
+        self.ssl_context = ssl_context
+        self.loop = loop or asyncio.get_event_loop()
+        self._pools = {}
+
+    def pool_for(self, url):
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = _HostPool(parts.scheme,
+                             parts.hostname,
+                             port,
+                             self.max_size,
+                             self.idle_timeout,
+                             self._timeout(),
+                             self.ssl_context,
+                             self.loop)
+            self._pools[key] = pool
+        return pool
+
+    def _timeout(self):
+        if self.timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            return socket.getdefaulttimeout()
+        return self.timeout
+
+    @_coroutine
+    def prewarm(self, url, count=1):
+        '''
+        Opens up to ``count`` connections to the host in url and leaves them idle in the pool.
+        '''
+        pool = self.pool_for(url)
+        conns = []
+        try:
+            for i in range(min(count, self.max_size)):
+                conn, reused = yield From(pool.acquire())
+                conns.append(conn)
+        finally:
+            for conn in conns:
+                pool.release(conn, True)
+
+    @_coroutine
+    def fetch(self, url):
+        '''
+        Sends a GET request for url. Returns ``(status, reason, body)``.
+        '''
+        pool = self.pool_for(url)
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request = 'GET {0} HTTP/1.1\r\nHost: {1}\r\nAccept-Encoding: identity\r\n\r\n'.format(path, parts.netloc)
+
+        while True:
+            conn, reused = yield From(pool.acquire())
+            sent = False
+            try:
+                conn.writer.write(request)
+                yield From(asyncio.wait_for(conn.writer.drain(), pool.timeout, loop=self.loop))
+                sent = True
+                status, reason, body, keep_alive = yield From(asyncio.wait_for(_read_response(conn.reader),
+                                                                               pool.timeout,
+                                                                               loop=self.loop))
+            except (IOError, OSError, asyncio.IncompleteReadError):
+                pool.release(conn, False)
+                # The server may have closed an idle keep-alive connection, try again on a new one. Once the
+                # request has been sent the server may have acted on it, and a Pay or Refund mustn't be sent twice.
+                if reused and not sent:
+                    continue
+                raise
+            except:
+                pool.release(conn, False)
+                raise
+            pool.release(conn, keep_alive)
+            raise Return((status, reason, body))
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.close()
+
+class AsyncFlexPay(FlexPay):
+    '''
+    A :py:class:`flexpay.payment.FlexPay` whose API methods are coroutines.
+
+    Every API method takes the same arguments and produces the same :py:class:`flexpay.response.Response`
+    as the blocking client::
+
+        flex_pay = AsyncFlexPay(AWS_PUBLIC_KEY, AWS_SECRET_KEY)
+
+        @asyncio.coroutine
+        def charge(order):
+            resp = yield From(flex_pay.pay(order.id, order.sender_id, order.amount))
+            raise Return(resp.TransactionId)
+
+    Share one :py:class:`AsyncPooledTransport` between instances to share their connections.
+
+    The helpers built on the API methods are coroutines too: :py:meth:`batch`, :py:meth:`iter_tokens`,
+    :py:meth:`for_each_account_activity`, :py:meth:`verify_return_url` and :py:meth:`verify_notification`.
+    A generator can't wait on the loop, so :py:meth:`iter_account_activity` raises ``TypeError``.
+    '''
+
+    def __init__(self,
+                 aws_public_key,
+                 aws_secret_key,
+                 api=SandboxAPI,
+                 currency_code=CurrencyCode.USD,
+                 transport=None,
+                 keep_response_text=True,
+                 loop=None,
+                 cache=None):
+        _require_asyncio()
+        if transport is None:
+            transport = AsyncPooledTransport(loop=loop)
+        FlexPay.__init__(self, aws_public_key, aws_secret_key, api, currency_code, transport, keep_response_text,
+                         cache=cache)
+        self.loop = loop or getattr(transport, 'loop', None) or asyncio.get_event_loop()
+
+    @_coroutine
+    def call_api(self, params):
+        cache = self.cache
+        if cache is not None:
+            scope = self.scope()
+            resp = cache.get(params, scope)
+            if resp is not None:
+                raise Return(resp)
+            key = dict(params)
+        url, params = self.sign_request(params)
+        try:
+            resp = yield From(self.make_request(url, params))
+        finally:
+            if cache is not None:
+                cache.written(key, scope)
+        if cache is not None:
+            cache.put(key, resp, scope)
+        raise Return(resp)
+
+    @_coroutine
+    def make_request(self, url, params):
+        dest = '{0}?{1}'.format(url, urllib.urlencode(params))
+        status, reason, data = yield From(self.transport.fetch(dest))
+        if not 200 <= status < 300:
+            raise RestAPIException(status, reason, data)
+        raise Return(make_response(data, params['Action'], keep_text=self.keep_response_text))
+
+    @_coroutine
+    def batch(self, operations, max_workers=8, callback=None):
+        '''
+        Runs many API calls concurrently, at most max_workers in flight at once. The same as
+        :py:meth:`flexpay.payment.FlexPay.batch`, returns a list of :py:class:`flexpay.batch.BatchResult`. If
+        the callback raises, every operation still runs and the first exception is raised at the end.
+        '''
+        operations = list(operations)
+        results = [None] * len(operations)
+        slots = asyncio.Semaphore(max_workers, loop=self.loop)
+        callback_errors = []
+
+        @_coroutine
+        def run(i, op):
+            yield From(slots.acquire())
+            try:
+                response = yield From(getattr(self, op[0])(*op[1:]))
+                result = BatchResult(i, op, response=response)
+            except Exception, error:
+                result = BatchResult(i, op, error=error)
+            finally:
+                slots.release()
+            results[i] = result
+            if callback is not None:
+                try:
+                    callback(result)
+                except Exception:
+                    callback_errors.append(sys.exc_info())
+
+        yield From(asyncio.gather(*[run(i, op) for i, op in enumerate(operations)], loop=self.loop))
+        if callback_errors:
+            error = callback_errors[0]
+            raise error[0], error[1], error[2]
+        raise Return(results)
+
+    @_coroutine
+    def iter_tokens(self, order_id=None, token_status=None, token_type=None):
+        '''
+        Returns the list of every Token returned by :py:meth:`get_tokens`.
+        '''
+        resp = yield From(self.get_tokens(order_id, token_status, token_type))
+        raise Return(resp.getlist('Token'))
+
+    def iter_account_activity(self, *args, **kwargs):
+        raise TypeError('AsyncFlexPay can\'t iterate over account activity, use for_each_account_activity.')
+
+    @_coroutine
+    def for_each_account_activity(self,
+                                  callback,
+                                  start_date,
+                                  end_date=None,
+                                  max_batch_size=None,
+                                  operation=None,
+                                  role=None,
+                                  transaction_status=None,
+                                  prefetch=True):
+        '''
+        Calls callback with every Transaction of the account activity between start_date and end_date,
+        following ``NextStartingDate`` from page to page like :py:meth:`flexpay.payment.FlexPay.iter_account_activity`.
+        With prefetch the next page is requested while callback works through the current one. Returns the
+        number of transactions.
+        '''
+        def fetch(start):
+            return self.get_account_activity(start, end_date, max_batch_size, operation, role, transaction_status)
+
+        count = 0
+        page = yield From(fetch(start_date))
+        while page is not None:
+            next_start = getattr(page, 'NextStartingDate', None)
+            following = None
+            if next_start is not None and next_start.value:
+                following = fetch(next_start.value)
+                if prefetch:
+                    following = asyncio.ensure_future(following, loop=self.loop)
+            try:
+                for txn in page.getlist('Transaction'):
+                    callback(txn)
+                    count += 1
+            except:
+                if following is not None and prefetch:
+                    following.cancel()
+                raise
+            page = (yield From(following)) if following is not None else None
+        raise Return(count)
+
+    @_coroutine
+    def verify_return_url(self, url, fallback=False):
+        '''
+        The same as :py:meth:`flexpay.payment.FlexPay.verify_return_url`. Verifying runs on the loop's
+        executor, since it may have to fetch the signing certificate.
+        '''
+        url_end_point, params = split_url(url)
+        valid = yield From(self._verify(params, url_end_point, 'GET', url, fallback))
+        raise Return(valid)
+
+    @_coroutine
+    def verify_notification(self, params, url_end_point, fallback=False):
+        '''
+        The same as :py:meth:`flexpay.payment.FlexPay.verify_notification`. Verifying runs on the loop's
+        executor, since it may have to fetch the signing certificate.
+        '''
+        url = '{0}?{1}'.format(url_end_point, urllib.urlencode(params))
+        valid = yield From(self._verify(params, url_end_point, 'POST', url, fallback))
+        raise Return(valid)
+
+    @_coroutine
+    def _verify(self, params, url_end_point, http_method, url, fallback):
+        try:
+            valid = yield From(self.loop.run_in_executor(None, self.verifier.verify, params, url_end_point,
+                                                         http_method))
+            raise Return(valid)
+        except (IOError, ValueError):
+            if not fallback:
+                raise
+        resp = yield From(self.verify_signature(url))
+        raise Return(resp.verification_status == VerificationStatus.Success)
@@ -0,0 +1,100 @@
+import sys
+import threading
+from Queue import Queue, Empty
+
+__all__ = ["BatchResult", "run_batch"]
+
+class BatchResult(object):
+    '''
+    The outcome of one operation in a batch.
+
+        .. py:attribute:: index
+
+            Position of the operation in the list passed to :py:func:`run_batch`.
+
+        .. py:attribute:: operation
+
+            The operation tuple itself.
+
+        .. py:attribute:: response
+
+            The :py:class:`flexpay.response.Response` when the call succeeded, otherwise None.
+
+        .. py:attribute:: error
+
+            The exception raised by the call, usually a :py:class:`flexpay.exceptions.RestAPIException`, otherwise None.
+    '''
+
+    def __init__(self, index, operation, response=None, error=None):
+        self.index = index
+        self.operation = operation
+        self.response = response
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return '<BatchResult {0} {1} ok>'.format(self.index, self.operation[0])
+        return '<BatchResult {0} {1} {2!r}>'.format(self.index, self.operation[0], self.error)
+
+def run_batch(client, operations, max_workers=8, callback=None):
+    '''
+    Runs API calls on a pool of at most ``max_workers`` threads.
+
+    Each operation is a tuple of a method name followed by its arguments, for example
+    ``('settle', transaction_id)`` or ``('refund', order_id, transaction_id, amount)``.
+
+        :param client: The :py:class:`flexpay.payment.FlexPay` to make the calls with.
+
+        :param operations: A list of operation tuples.
+
+        :param max_workers: Maximum number of calls in flight at once.
+
+        :param callback: Called with each :py:class:`BatchResult` as soon as it completes. Calls to the
+            callback are serialized, so it doesn't need to be thread safe. If it raises, every operation still
+            runs and the first exception is raised once they're done.
+
+        :Returns:
+            A list of :py:class:`BatchResult`, in the same order as operations.
+    '''
+    operations = list(operations)
+    results = [None] * len(operations)
+    pending = Queue()
+    for i in range(len(operations)):
+        pending.put(i)
+
+    callback_lock = threading.Lock()
+    callback_errors = []
+
+    def worker():
+        while True:
+            try:
+                i = pending.get_nowait()
+            except Empty:
+                return
+            op = operations[i]
+            try:
+                result = BatchResult(i, op, response=getattr(client, op[0])(*op[1:]))
+            except Exception, error:
+                result = BatchResult(i, op, error=error)
+            results[i] = result
+            if callback is not None:
+                with callback_lock:
+                    try:
+                        callback(result)
+                    except Exception:
+                        callback_errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for i in range(min(max_workers, len(operations)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    if callback_errors:
+        error = callback_errors[0]
+        raise error[0], error[1], error[2]
+    return results
@@ -0,0 +1,392 @@
+import calendar
+import heapq
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from hashlib import sha1
+from Queue import Queue, Empty
+from flexpay.retry import RetryPolicy
+
+__all__ = ["BillingScheduler", "Charge", "caller_reference"]
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS subscriptions (
+    id TEXT PRIMARY KEY,
+    sender_token_id TEXT NOT NULL,
+    amount TEXT NOT NULL,
+    period TEXT NOT NULL,
+    anchor INTEGER NOT NULL,
+    next_cycle INTEGER NOT NULL,
+    active INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS charges (
+    subscription_id TEXT NOT NULL,
+    cycle INTEGER NOT NULL,
+    caller_reference TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    transaction_id TEXT,
+    transaction_status TEXT,
+    error TEXT,
+    updated INTEGER NOT NULL,
+    PRIMARY KEY (subscription_id, cycle)
+);
+'''
+
+def caller_reference(subscription_id, cycle):
+    '''
+    The ``CallerReference`` of a subscription's charge for a billing cycle. It's the same every time the
+    charge is attempted, so FPS never runs it twice.
+    '''
+    return '{0}-c{1}'.format(subscription_id, cycle)
+
+def _add_months(d, months):
+    month = d.month - 1 + months
+    year = d.year + month // 12
+    month = month % 12 + 1
+    return d.replace(year=year, month=month, day=min(d.day, calendar.monthrange(year, month)[1]))
+
+class _Subscription(object):
+    __slots__ = ('id', 'sender_token_id', 'amount', 'period', 'anchor', 'next_cycle', 'active')
+
+    def __init__(self, id, sender_token_id, amount, period, anchor, next_cycle, active):
+        self.id = id
+        self.sender_token_id = sender_token_id
+        self.amount = amount
+        self.period = period
+        self.anchor = anchor
+        self.next_cycle = next_cycle
+        self.active = active
+
+    def due(self, cycle):
+        '''
+        Start of cycle in seconds since the epoch.
+        '''
+        if self.period == 'month':
+            return calendar.timegm(_add_months(datetime.utcfromtimestamp(self.anchor), cycle).utctimetuple())
+        return self.anchor + cycle * int(self.period)
+
+    def cycle_after(self, when):
+        '''
+        The first cycle due after when, a time in seconds since the epoch.
+        '''
+        if self.period != 'month':
+            return max(0, int((when - self.anchor) // int(self.period)) + 1)
+        anchor = datetime.utcfromtimestamp(self.anchor)
+        when_date = datetime.utcfromtimestamp(when)
+        cycle = max(0, (when_date.year - anchor.year) * 12 + when_date.month - anchor.month - 1)
+        while self.due(cycle) <= when:
+            cycle += 1
+        return cycle
+
+class Charge(object):
+    '''
+    The outcome of one attempt to charge a subscription, passed to the scheduler's callback.
+
+        .. py:attribute:: final
+
+            False when the attempt failed transiently and will be retried.
+    '''
+
+    def __init__(self, subscription_id, cycle, caller_reference, response=None, error=None, final=True):
+        self.subscription_id = subscription_id
+        self.cycle = cycle
+        self.caller_reference = caller_reference
+        self.response = response
+        self.error = error
+        self.final = final
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<Charge {0} ok={1} final={2}>'.format(self.caller_reference, self.ok, self.final)
+
+class BillingScheduler(object):
+    '''
+    Bills Recurring pipeline tokens with :py:meth:`flexpay.payment.FlexPay.pay` on their schedules::
+
+        scheduler = BillingScheduler(flex_pay, '/var/lib/shop/billing.db', window=6 * 3600, max_workers=16)
+        scheduler.add(subscription.id, subscription.token_id, '9.99', start=subscription.paid_until)
+        scheduler.run()
+
+    Charges wait in a heap ordered by due time. Each charge is spread over the window after its due time by
+    an offset derived from the subscription and cycle, so the start of the month isn't one burst and a restart
+    keeps the same spread. At most max_workers charges are in flight.
+
+    Every subscription, cycle and attempt is kept in a sqlite database. A charge is recorded as pending before
+    it's sent, with a ``CallerReference`` fixed for its cycle, see :py:func:`caller_reference`. A pending charge
+    found after a restart is sent again, and FPS returns the original transaction instead of charging twice.
+    When the scheduler wasn't running, or a subscription is added with a start in the past, only the last
+    max_catch_up cycles that came due are billed and earlier ones are skipped, so a long outage doesn't charge a
+    buyer for months back to back. A cycle with a charge still pending is never skipped.
+
+        :param client: The :py:class:`flexpay.payment.FlexPay` that charges.
+
+        :param path: The sqlite database holding the schedule.
+
+        :param window: Seconds after the due time over which charges are spread.
+
+        :param max_workers: Maximum charges in flight.
+
+        :param retry_delay: Seconds before a transiently failed charge is tried again.
+
+        :param max_attempts: Attempts before a charge is given up as failed.
+
+        :param callback: Called with each :py:class:`Charge`, from the thread running the scheduler.
+
+        :param max_catch_up: Cycles already due that are billed, 0 starts at the next cycle to come due. None
+            bills every missed cycle.
+    '''
+
+    def __init__(self,
+                 client,
+                 path,
+                 window=3600,
+                 max_workers=8,
+                 retry_delay=300,
+                 max_attempts=5,
+                 callback=None,
+                 max_catch_up=1,
+                 clock=time.time):
+        self.client = client
+        self.window = window
+        self.max_workers = max_workers
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.callback = callback
+        self.max_catch_up = max_catch_up
+        self.clock = clock
+        self.transient = RetryPolicy()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.executescript(_SCHEMA)
+        self._lock = threading.Lock() # Guards the database, the heap and the subscriptions.
+        self._stopped = False
+        self._wakeup = Queue()
+        self._heap = []
+        self._seq = 0
+        self._subscriptions = {}
+        for row in self.db.execute('SELECT * FROM subscriptions WHERE active').fetchall():
+            sub = _Subscription(*row)
+            self._subscriptions[sub.id] = sub
+            self._catch_up(sub)
+            self._schedule(sub, sub.next_cycle, self._fire_time(sub, sub.next_cycle))
+
+    def _fire_time(self, sub, cycle):
+        # The same spread on every run, derived from the subscription and cycle.
+        offset = int(sha1('{0}:{1}'.format(sub.id, cycle)).hexdigest()[:8], 16) / float(1 << 32)
+        return sub.due(cycle) + offset * self.window
+
+    def _catch_up(self, sub):
+        # Skips the missed cycles before the last max_catch_up. Called with the lock held, or from __init__.
+        if self.max_catch_up is None:
+            return
+        cycle = max(sub.next_cycle, sub.cycle_after(self.clock()) - self.max_catch_up)
+        if cycle == sub.next_cycle:
+            return
+        row = self.db.execute('SELECT state FROM charges WHERE subscription_id = ? AND cycle = ?',
+                              (sub.id, sub.next_cycle)).fetchone()
+        if row is not None and row[0] == 'pending':
+            return # It may have been charged, it's sent again to find out.
+        sub.next_cycle = cycle
+        with self.db:
+            self.db.execute('UPDATE subscriptions SET next_cycle = ? WHERE id = ?', (sub.next_cycle, sub.id))
+
+    def _schedule(self, sub, cycle, when):
+        self._seq += 1
+        heapq.heappush(self._heap, (when, self._seq, sub.id, cycle))
+
+    def add(self, subscription_id, sender_token_id, amount, start=None, period='month'):
+        '''
+        Adds a subscription, or updates its token and amount if it exists.
+
+            :param start: A datetime in UTC when the first cycle is due, the default is now. Cycles due before
+                now are billed up to the scheduler's max_catch_up.
+
+            :param period: ``'month'`` to bill on the same day every month, or a timedelta.
+        '''
+        if isinstance(period, timedelta):
+            period = str(int(period.total_seconds()))
+        anchor = calendar.timegm((start or datetime.utcnow()).utctimetuple())
+        with self._lock:
+            sub = self._subscriptions.get(subscription_id)
+            if sub is not None:
+                sub.sender_token_id = sender_token_id
+                sub.amount = str(amount)
+                with self.db:
+                    self.db.execute('UPDATE subscriptions SET sender_token_id = ?, amount = ? WHERE id = ?',
+                                    (sub.sender_token_id, sub.amount, sub.id))
+                return
+            # A cancelled subscription that's added again continues from the cycle it stopped at.
+            row = self.db.execute('SELECT anchor, next_cycle FROM subscriptions WHERE id = ?',
+                                  (subscription_id,)).fetchone()
+            anchor, next_cycle = row if row is not None else (anchor, 0)
+            sub = _Subscription(subscription_id, sender_token_id, str(amount), period, anchor, next_cycle, 1)
+            self._catch_up(sub)
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO subscriptions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (sub.id, sub.sender_token_id, sub.amount, sub.period, sub.anchor,
+                                 sub.next_cycle, sub.active))
+            self._subscriptions[sub.id] = sub
+            self._schedule(sub, sub.next_cycle, self._fire_time(sub, sub.next_cycle))
+        self._wakeup.put(None)
+
+    def cancel(self, subscription_id):
+        '''
+        Stops billing a subscription. A charge already in flight still completes.
+        '''
+        with self._lock:
+            sub = self._subscriptions.pop(subscription_id, None)
+            if sub is not None:
+                sub.active = 0
+            with self.db:
+                self.db.execute('UPDATE subscriptions SET active = 0 WHERE id = ?', (subscription_id,))
+
+    def charges(self, subscription_id):
+        '''
+        Returns ``(cycle, caller_reference, state, attempts, transaction_id, transaction_status, error)`` for
+        every charge of a subscription, state is pending, done or failed.
+        '''
+        with self._lock:
+            return self.db.execute('SELECT cycle, caller_reference, state, attempts, transaction_id, '
+                                   'transaction_status, error FROM charges WHERE subscription_id = ? '
+                                   'ORDER BY cycle', (subscription_id,)).fetchall()
+
+    def _begin(self, sub, cycle):
+        # Records the attempt before it's sent, returns None when the cycle was already billed. Called with the
+        # lock held.
+        now = int(self.clock())
+        row = self.db.execute('SELECT state FROM charges WHERE subscription_id = ? AND cycle = ?',
+                              (sub.id, cycle)).fetchone()
+        with self.db:
+            if row is None:
+                self.db.execute('INSERT INTO charges VALUES (?, ?, ?, ?, 1, NULL, NULL, NULL, ?)',
+                                (sub.id, cycle, caller_reference(sub.id, cycle), 'pending', now))
+            elif row[0] == 'pending':
+                self.db.execute('UPDATE charges SET attempts = attempts + 1, updated = ? '
+                                'WHERE subscription_id = ? AND cycle = ?', (now, sub.id, cycle))
+            else:
+                sub.next_cycle = cycle + 1
+                self.db.execute('UPDATE subscriptions SET next_cycle = ? WHERE id = ?', (sub.next_cycle, sub.id))
+                self._catch_up(sub)
+                self._schedule(sub, sub.next_cycle, self._fire_time(sub, sub.next_cycle))
+                return None
+        return caller_reference(sub.id, cycle)
+
+    def _finish(self, sub, cycle, ref, response, error):
+        # Records the outcome and schedules what comes next. Called with the lock held.
+        final = True
+        if error is not None and self.transient.is_retryable(error):
+            attempts = self.db.execute('SELECT attempts FROM charges WHERE subscription_id = ? AND cycle = ?',
+                                       (sub.id, cycle)).fetchone()[0]
+            final = attempts >= self.max_attempts
+        with self.db:
+            if error is None:
+                status = response.transaction_status
+                self.db.execute('UPDATE charges SET state = ?, transaction_id = ?, transaction_status = ?, '
+                                'error = NULL WHERE subscription_id = ? AND cycle = ?',
+                                ('done', response.transaction_id, str(status) if status is not None else None,
+                                 sub.id, cycle))
+            else:
+                code = getattr(error, 'code', None) or type(error).__name__
+                self.db.execute('UPDATE charges SET state = ?, error = ? WHERE subscription_id = ? AND cycle = ?',
+                                ('failed' if final else 'pending', code, sub.id, cycle))
+            if final:
+                sub.next_cycle = cycle + 1
+                self.db.execute('UPDATE subscriptions SET next_cycle = ? WHERE id = ?', (sub.next_cycle, sub.id))
+        if self._subscriptions.get(sub.id) is not sub:
+            pass # Cancelled meanwhile.
+        elif final:
+            self._catch_up(sub)
+            self._schedule(sub, sub.next_cycle, self._fire_time(sub, sub.next_cycle))
+        else:
+            self._schedule(sub, cycle, self.clock() + self.retry_delay)
+        return Charge(sub.id, cycle, ref, response, error, final)
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.put(None)
+
+    def run(self, until=None):
+        '''
+        Charges subscriptions as they come due, until :py:meth:`stop` is called or, when until is given,
+        until that time in seconds since the epoch has passed and nothing is in flight.
+        '''
+        self._stopped = False
+        jobs = Queue()
+        wakeup = self._wakeup
+
+        def worker():
+            while True:
+                job = jobs.get()
+                if job is None:
+                    return
+                sub, cycle, ref, amount, token = job
+                try:
+                    wakeup.put((sub, cycle, ref, self.client.pay(ref, token, amount), None))
+                except Exception, error:
+                    wakeup.put((sub, cycle, ref, None, error))
+
+        threads = [threading.Thread(target=worker) for i in range(self.max_workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        in_flight = 0
+        try:
+            while not self._stopped:
+                now = self.clock()
+                ending = until is not None and now >= until
+                with self._lock:
+                    heap = self._heap
+                    while heap and heap[0][0] <= now and in_flight < self.max_workers and not ending:
+                        when, seq, sid, cycle = heapq.heappop(heap)
+                        sub = self._subscriptions.get(sid)
+                        if sub is None or sub.next_cycle != cycle:
+                            continue
+                        ref = self._begin(sub, cycle)
+                        if ref is None:
+                            continue
+                        jobs.put((sub, cycle, ref, sub.amount, sub.sender_token_id))
+                        in_flight += 1
+                    next_fire = heap[0][0] if heap else None
+
+                if ending and not in_flight:
+                    break
+                # Wait for a result, or until the next charge is due or the run ends.
+                timeout = None
+                if not ending:
+                    if next_fire is not None and in_flight < self.max_workers:
+                        timeout = next_fire - now
+                    if until is not None:
+                        timeout = until - now if timeout is None else min(timeout, until - now)
+                try:
+                    result = wakeup.get(timeout=max(timeout, 0.001)) if timeout is not None else wakeup.get()
+                except Empty:
+                    continue
+                if result is None:
+                    continue
+                in_flight -= 1
+                with self._lock:
+                    charge = self._finish(*result)
+                if self.callback is not None:
+                    self.callback(charge)
+        finally:
+            for t in threads:
+                jobs.put(None)
+            # Record the charges still in flight, so they aren't left pending until the next run.
+            while in_flight:
+                result = wakeup.get()
+                if result is None:
+                    continue
+                in_flight -= 1
+                with self._lock:
+                    charge = self._finish(*result)
+                if self.callback is not None:
+                    self.callback(charge)
+
+    def close(self):
+        with self._lock:
+            self.db.close()
@@ -0,0 +1,186 @@
+import threading
+import time
+from collections import OrderedDict
+from flexpay.results import TransactionStatus
+from flexpay.retry import READ_ACTIONS
+
+__all__ = ["CachePolicy", "ResponseCache", "FINAL_STATUSES", "default_policies"]
+
+FINAL_STATUSES = frozenset([TransactionStatus.Success, TransactionStatus.Failure, TransactionStatus.Cancelled])
+'''
+Transaction statuses that never change, a transaction in one of them can be cached for good.
+'''
+
+def _final_status(response):
+    status = getattr(response, 'transaction_status', None)
+    if status is None:
+        status = getattr(response, 'TransactionStatus', None)
+        status = status.value if status is not None else None
+    return status in FINAL_STATUSES
+
+class CachePolicy(object):
+    '''
+    How responses for one Action are cached.
+
+        :param ttl: Seconds a response stays fresh, None keeps it until it's evicted or invalidated.
+
+        :param max_size: Number of responses kept, the least recently used is evicted first.
+
+        :param cacheable: Called with a response, only responses it returns True for are cached. The default
+            caches every response.
+    '''
+
+    def __init__(self, ttl=None, max_size=1000, cacheable=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.cacheable = cacheable
+
+def default_policies():
+    '''
+    Transactions that reached a final status are kept until evicted, balances for 5 seconds.
+    '''
+    return {
+        'GetTransactionStatus': CachePolicy(max_size=10000, cacheable=_final_status),
+        'GetAccountBalance': CachePolicy(ttl=5.0, max_size=16),
+    }
+
+class _Store(object):
+    '''
+    The entries and counters of one Action, an LRU ordered from least to most recently used.
+    '''
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.entries = OrderedDict() # key -> (expires, response)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+def _key(params, scope):
+    return (tuple(scope), tuple(sorted(params.iteritems())))
+
+class ResponseCache(object):
+    '''
+    A read-through cache for API responses, pass it to :py:class:`flexpay.payment.FlexPay` with ``cache``::
+
+        cache = ResponseCache()
+        flex_pay = FlexPay(PUB_KEY, SECRET_KEY, cache=cache)
+        ...
+        print cache.stats()['GetTransactionStatus']['hits']
+
+    Only the Actions in policies are cached. Responses are keyed on the access key and endpoint of the client and
+    the parameters of the request, so clients for different accounts can share one cache. A cached response is
+    the same object every time, treat responses as read only.
+
+    Calls that change a transaction invalidate what's cached about it: Refund and Cancel drop their
+    ``TransactionId``, Settle its ``ReserveTransactionId``, and every call that moves money drops the
+    cached balances of its account.
+
+        :param policies: A dict of Action to :py:class:`CachePolicy`, the default is :py:func:`default_policies`.
+    '''
+
+    def __init__(self, policies=None, clock=time.time):
+        if policies is None:
+            policies = default_policies()
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._stores = dict((action, _Store(policy)) for action, policy in policies.iteritems())
+
+    def get(self, params, scope=()):
+        '''
+        Returns the cached response for params, or None.
+
+            :param scope: What else tells requests apart, :py:class:`flexpay.payment.FlexPay` passes its access
+                key and endpoint.
+        '''
+        store = self._stores.get(params['Action'])
+        if store is None:
+            return None
+        key = _key(params, scope)
+        with self._lock:
+            entry = store.entries.pop(key, None)
+            if entry is not None:
+                expires, response = entry
+                if expires is None or expires > self.clock():
+                    # Put it back as the most recently used.
+                    store.entries[key] = entry
+                    store.hits += 1
+                    return response
+            store.misses += 1
+            return None
+
+    def put(self, params, response, scope=()):
+        store = self._stores.get(params['Action'])
+        if store is None:
+            return
+        policy = store.policy
+        if policy.cacheable is not None and not policy.cacheable(response):
+            return
+        expires = None if policy.ttl is None else self.clock() + policy.ttl
+        key = _key(params, scope)
+        with self._lock:
+            store.entries.pop(key, None)
+            store.entries[key] = (expires, response)
+            while len(store.entries) > policy.max_size:
+                store.entries.popitem(last=False)
+                store.evictions += 1
+
+    def invalidate(self, action=None, scope=None, **params):
+        '''
+        Drops cached responses. With no arguments everything, with only action every response for that
+        Action, otherwise the response for that Action and parameters::
+
+            cache.invalidate('GetTransactionStatus', TransactionId=txn_id)
+
+        Responses are dropped for every account, unless scope limits it to one, such as
+        ``cache.invalidate('GetAccountBalance', flex_pay.scope())``.
+        '''
+        if params:
+            params['Action'] = action
+            params = tuple(sorted(params.iteritems()))
+        with self._lock:
+            if action is None:
+                stores = self._stores.values()
+            else:
+                store = self._stores.get(action)
+                stores = [store] if store is not None else []
+            for store in stores:
+                if scope is None and not params:
+                    store.entries.clear()
+                elif scope is not None and params:
+                    store.entries.pop((tuple(scope), params), None)
+                else:
+                    # Every entry of one scope, or one request in every scope.
+                    part, value = (0, tuple(scope)) if scope is not None else (1, params)
+                    for key in [key for key in store.entries if key[part] == value]:
+                        del store.entries[key]
+
+    def written(self, params, scope=()):
+        '''
+        Called after every call that isn't a read, drops the responses it may have made stale.
+        '''
+        action = params['Action']
+        if action in READ_ACTIONS:
+            return
+        for name in ('TransactionId', 'ReserveTransactionId'):
+            transaction_id = params.get(name)
+            if transaction_id is not None:
+                self.invalidate('GetTransactionStatus', scope, TransactionId=transaction_id)
+        if action != 'CancelToken':
+            self.invalidate('GetAccountBalance', scope)
+
+    def stats(self):
+        '''
+        Returns ``{action: {'hits': n, 'misses': n, 'evictions': n, 'size': n}}``.
+        '''
+        with self._lock:
+            return dict((action, {'hits': store.hits,
+                                  'misses': store.misses,
+                                  'evictions': store.evictions,
+                                  'size': len(store.entries)})
+                        for action, store in self._stores.iteritems())
+
+    def reset_stats(self):
+        with self._lock:
+            for store in self._stores.itervalues():
+                store.hits = store.misses = store.evictions = 0
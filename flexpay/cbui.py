@@ -0,0 +1,68 @@
+import multiprocessing
+import urllib
+from collections import deque
+from flexpay.signing import Signer, RequestTemplate
+
+__all__ = ["CBUITemplate", "generate_urls"]
+
+class CBUITemplate(object):
+    '''
+    A precompiled Co-Branded UI request for one combination of the parameters shared by many orders
+    (caller key, pipeline, payment methods, currency). The static part of the query string is encoded once.
+    '''
+
+    def __init__(self, signer, url, static_params):
+        self.request = RequestTemplate(signer, url, static_params)
+        self.prefix = '{0}?{1}&'.format(url, urllib.urlencode(static_params))
+
+    def url(self, fields):
+        signature = self.request.sign_fields(fields)
+        return '{0}{1}&{2}'.format(self.prefix, urllib.urlencode(fields), urllib.urlencode({'signature': signature}))
+
+# Templates built by pool worker processes, keyed by (secret key, url, static parameters).
+_worker_templates = {}
+
+def _worker_template(secret_key, url, static_items):
+    key = (secret_key, url, static_items)
+    template = _worker_templates.get(key)
+    if template is None:
+        template = _worker_templates[key] = CBUITemplate(Signer(secret_key), url, dict(static_items))
+    return template
+
+def _sign_chunk(job):
+    secret_key, url, entries = job
+    return [_worker_template(secret_key, url, static_items).url(fields) for static_items, fields in entries]
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def generate_urls(secret_key, url, entries, processes=None, chunk_size=500):
+    '''
+    Signs ``(static_items, fields)`` entries across a pool of processes and yields the URLs in order.
+
+    At most two chunks per process are in flight at once, so memory stays bounded however long entries is.
+    static_items is a sorted tuple of the static parameters, fields a dict of the per order parameters.
+    '''
+    pool = multiprocessing.Pool(processes)
+    try:
+        max_pending = 2 * (processes or multiprocessing.cpu_count())
+        pending = deque()
+        for chunk in _chunks(entries, chunk_size):
+            pending.append(pool.apply_async(_sign_chunk, ((secret_key, url, chunk),)))
+            if len(pending) >= max_pending:
+                for u in pending.popleft().get():
+                    yield u
+        while pending:
+            for u in pending.popleft().get():
+                yield u
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
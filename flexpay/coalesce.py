@@ -0,0 +1,77 @@
+import sys
+import threading
+from flexpay.retry import READ_ACTIONS
+
+__all__ = ["SingleFlight"]
+
+class _Flight(object):
+    __slots__ = ('done', 'response', 'exc_info', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.exc_info = None
+        self.waiters = 0
+
+class SingleFlight(object):
+    '''
+    Coalesces identical reads that are in flight at the same time: the first caller sends the request and
+    every caller that asks for the same thing meanwhile waits for it and gets the same response, or the same
+    exception. Nothing is kept once the call finishes, so there's no staleness::
+
+        flex_pay = FlexPay(PUB_KEY, SECRET_KEY, single_flight=SingleFlight())
+
+    Requests are identical when they're signed with the same access key, go to the same endpoint and have
+    the same Action and parameters, so clients for different accounts can share one instance. The shared
+    response is the same object for every caller, treat it as read only.
+
+        :param actions: Actions that may be coalesced, only reads by default.
+    '''
+
+    def __init__(self, actions=READ_ACTIONS):
+        self.actions = actions
+        self.calls = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def call(self, params, send, scope=()):
+        '''
+        Returns ``send()``, or the outcome of an identical call already in flight for params.
+
+            :param scope: What else tells requests apart, :py:class:`flexpay.payment.FlexPay` passes its access
+                key and endpoint.
+        '''
+        if params['Action'] not in self.actions:
+            return send()
+        key = (tuple(scope), tuple(sorted(params.iteritems())))
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+                leader = False
+
+        if leader:
+            try:
+                flight.response = send()
+            except Exception:
+                flight.exc_info = sys.exc_info()
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+
+        if flight.exc_info is not None:
+            raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+        return flight.response
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
@@ -1,8 +1,74 @@
-__all__ = ["RestAPIException"]
+import xml.sax
+from collections import namedtuple
+
+__all__ = ["RestAPIException", "APIError", "parse_errors"]
+
+APIError = namedtuple('APIError', ['code', 'message'])
+'''
+One ``<Error>`` of an FPS error response.
+'''
+
+class _ErrorHandler(xml.sax.ContentHandler):
+    def __init__(self):
+        self.errors = []
+        self._error = None
+        self._text = []
+    
+    def startElement(self, name, attrs):
+        if name == 'Error':
+            self._error = {}
+        self._text = []
+    
+    def endElement(self, name):
+        if name == 'Error':
+            self.errors.append(APIError(self._error.get('Code'), self._error.get('Message')))
+            self._error = None
+        elif self._error is not None and name in ('Code', 'Message'):
+            self._error[name] = ''.join(self._text).strip()
+        self._text = []
+    
+    def characters(self, content):
+        self._text.append(content)
+
+def parse_errors(body):
+    '''
+    Returns the list of :py:class:`APIError` in an FPS error response body. Bodies that aren't XML have none.
+    '''
+    h = _ErrorHandler()
+    try:
+        xml.sax.parseString(body, h)
+    except xml.sax.SAXException:
+        pass
+    return h.errors
 
 class RestAPIException(StandardError):
     def __init__(self, *args):
         StandardError.__init__(self, *args)
+        self._errors = None
+    
+    @property
+    def status(self):
+        '''
+        The HTTP status code.
+        '''
+        return self.args[0]
+    
+    @property
+    def errors(self):
+        '''
+        The errors in the response body, a list of :py:class:`APIError`. Parsed the first time it's used.
+        '''
+        if self._errors is None:
+            self._errors = parse_errors(self.args[2]) if len(self.args) > 2 and self.args[2] else []
+        return self._errors
+    
+    @property
+    def code(self):
+        '''
+        The code of the first error, for example ``RequestThrottled``, or None.
+        '''
+        errors = self.errors
+        return errors[0].code if errors else None
     
     def __repr__(self):
         return str(self)
@@ -10,4 +76,4 @@ class RestAPIException(StandardError):
     def __str__(self):
         return 'FPS REST API Exception: {0} {1}\n\n{2}'.format(self.args[0],
                                           self.args[1],
-                                          self.args[2])
\ No newline at end of file
+                                          self.args[2])
@@ -0,0 +1,247 @@
+import bisect
+import socket
+import threading
+import time
+
+__all__ = ["CallTiming", "TimedReader", "Instrumentation", "Sink", "Aggregator", "CallbackSink", "StatsdSink", "PHASES"]
+
+PHASES = ('sign', 'connect', 'tls', 'wait', 'read', 'parse')
+'''
+The phases of a call, in order:
+
+    * **sign** -- building the common parameters and the signature.
+    * **connect** -- DNS lookup and TCP connect, only when a new connection is opened.
+    * **tls** -- the TLS handshake, only when a new HTTPS connection is opened.
+    * **wait** -- from sending the request to receiving the response headers.
+    * **read** -- reading the response body.
+    * **parse** -- parsing the response XML.
+'''
+
+class CallTiming(object):
+    '''
+    Timing of one API call. ``phases`` maps a phase name to seconds, ``status`` is the HTTP status or None
+    when no response was received, and ``error`` the exception raised, if any.
+    '''
+    __slots__ = ('action', 'start', 'duration', 'phases', 'status', 'error')
+
+    def __init__(self, action):
+        self.action = action
+        self.start = time.time()
+        self.duration = None
+        self.phases = {}
+        self.status = None
+        self.error = None
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @property
+    def ok(self):
+        return self.error is None
+
+class TimedReader(object):
+    '''
+    Wraps a file like object and adds up the time spent in ``read``.
+    '''
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.elapsed = 0.0
+
+    def read(self, amt=None):
+        start = time.time()
+        data = self.fp.read(amt)
+        self.elapsed += time.time() - start
+        return data
+
+class Sink(object):
+    '''
+    Receives the timings collected by :py:class:`Instrumentation`.
+    '''
+
+    def started(self, timing):
+        pass
+
+    def record(self, timing):
+        pass
+
+class Instrumentation(object):
+    '''
+    Collects per call timings and hands them to sinks::
+
+        stats = Aggregator()
+        flex_pay = FlexPay(PUB_KEY, SECRET_KEY, instrument=Instrumentation(stats, StatsdSink()))
+        ...
+        print stats.snapshot()['Pay']['total']['p99_ms']
+
+    A FlexPay without instrumentation skips all of this, the only cost is a check for None.
+    '''
+
+    def __init__(self, *sinks):
+        self.sinks = list(sinks)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def start(self, action):
+        timing = CallTiming(action)
+        with self._lock:
+            self.in_flight += 1
+        for sink in self.sinks:
+            sink.started(timing)
+        return timing
+
+    def finish(self, timing, error=None):
+        timing.duration = time.time() - timing.start
+        timing.error = error
+        with self._lock:
+            self.in_flight -= 1
+        for sink in self.sinks:
+            sink.record(timing)
+
+# Histogram bucket upper bounds in milliseconds.
+BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, float('inf'))
+
+class Histogram(object):
+    '''
+    A fixed bucket latency histogram in milliseconds.
+    '''
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.sum += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        '''
+        Upper bound of the bucket holding the p-th percentile, capped at the largest value seen.
+        '''
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.sum / self.count if self.count else None,
+            'p50_ms': self.percentile(50),
+            'p90_ms': self.percentile(90),
+            'p99_ms': self.percentile(99),
+            'max_ms': self.max,
+        }
+
+class Aggregator(Sink):
+    '''
+    Keeps latency histograms per Action and phase, plus in-flight, success and error counters.
+    Errors are counted by HTTP status, 0 for calls that failed without a response.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.in_flight = {}
+            self.successes = {}
+            self.errors = {}
+
+    def started(self, timing):
+        with self._lock:
+            self.in_flight[timing.action] = self.in_flight.get(timing.action, 0) + 1
+
+    def record(self, timing):
+        action = timing.action
+        with self._lock:
+            self.in_flight[action] -= 1
+            histograms = self.histograms.get(action)
+            if histograms is None:
+                histograms = self.histograms[action] = {}
+            for phase, seconds in timing.phases.iteritems():
+                h = histograms.get(phase)
+                if h is None:
+                    h = histograms[phase] = Histogram()
+                h.add(seconds * 1000.0)
+            h = histograms.get('total')
+            if h is None:
+                h = histograms['total'] = Histogram()
+            h.add(timing.duration * 1000.0)
+            if timing.ok:
+                self.successes[action] = self.successes.get(action, 0) + 1
+            else:
+                key = (action, timing.status or 0)
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def snapshot(self):
+        '''
+        Returns ``{action: {phase: summary, ..., 'in_flight': n, 'successes': n, 'errors': {status: n}}}``.
+        '''
+        with self._lock:
+            out = {}
+            for action in set(self.histograms) | set(self.in_flight):
+                stats = dict((phase, h.summary()) for phase, h in self.histograms.get(action, {}).iteritems())
+                stats['in_flight'] = self.in_flight.get(action, 0)
+                stats['successes'] = self.successes.get(action, 0)
+                stats['errors'] = dict((status, n) for (a, status), n in self.errors.iteritems() if a == action)
+                out[action] = stats
+            return out
+
+class CallbackSink(Sink):
+    '''
+    Calls ``callback(timing)`` with each finished :py:class:`CallTiming`.
+    '''
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def record(self, timing):
+        self.callback(timing)
+
+class StatsdSink(Sink):
+    '''
+    Emits statsd lines: a timer per phase and for the whole call, a counter per HTTP status and an
+    in-flight gauge.
+
+        :param write: Called with each batch of lines. The default sends them over UDP to host and port.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='flexpay', write=None):
+        self.prefix = prefix
+        if write is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            address = (host, port)
+
+            def write(data):
+                try:
+                    sock.sendto(data, address)
+                except socket.error:
+                    # Metrics are best effort, never fail a payment over them.
+                    pass
+        self.write = write
+
+    def started(self, timing):
+        self.write('{0}.in_flight:+1|g'.format(self.prefix))
+
+    def record(self, timing):
+        name = '{0}.{1}'.format(self.prefix, timing.action)
+        lines = ['{0}.in_flight:-1|g'.format(self.prefix),
+                 '{0}.total:{1:.3f}|ms'.format(name, timing.duration * 1000.0),
+                 '{0}.status.{1}:1|c'.format(name, timing.status or 0)]
+        for phase, seconds in timing.phases.iteritems():
+            lines.append('{0}.{1}:{2:.3f}|ms'.format(name, phase, seconds * 1000.0))
+        self.write('\n'.join(lines))
@@ -0,0 +1,326 @@
+'''
+Receivers for Instant Payment Notifications, the POSTs FPS sends when a transaction or token changes.
+
+:py:class:`IPNReceiver` is a WSGI application. :py:class:`AsyncIPNReceiver` runs on an asyncio event loop and
+needs `trollius <https://pypi.python.org/pypi/trollius>`_. Both verify each notification, drop the ones already
+seen, and hand the rest to your code. They answer FPS as soon as the notification has been handed over, and
+answer 503 when your code can't keep up, so FPS sends the notification again later instead of it being lost.
+'''
+import threading
+from collections import OrderedDict
+from Queue import Full
+from urlparse import parse_qsl
+
+try:
+    from trollius import From, Return
+except ImportError:
+    pass
+
+from flexpay.aio import asyncio, _coroutine, _require_asyncio, _read_body
+from flexpay.results import TransactionStatus
+from flexpay.verify import default_verifier
+
+__all__ = ["Notification", "RecentIndex", "IPNReceiver", "AsyncIPNReceiver", "parse_notification"]
+
+class Notification(object):
+    '''
+    One IPN. Every posted parameter is in ``params``, the common ones are also attributes.
+
+        .. py:attribute:: notification_type
+
+            ``TransactionStatus`` or ``TokenCancellation``.
+
+        .. py:attribute:: transaction_status
+
+            A :py:class:`flexpay.results.TransactionStatus` when the value is known, otherwise the raw string.
+    '''
+
+    def __init__(self, params):
+        self.params = params
+        self.notification_type = params.get('notificationType')
+        self.transaction_id = params.get('transactionId')
+        self.caller_reference = params.get('callerReference')
+        self.operation = params.get('operation')
+        self.status_code = params.get('statusCode')
+        self.token_id = params.get('tokenId')
+        status = params.get('transactionStatus')
+        if status is not None:
+            try:
+                status = TransactionStatus.reverse_lookup(status)
+            except TypeError:
+                pass
+        self.transaction_status = status
+
+    @property
+    def key(self):
+        '''
+        Identifies the event: FPS sends a notification again until it's acknowledged, each copy has the same key.
+        '''
+        return (self.notification_type, self.transaction_id or self.token_id, self.transaction_status)
+
+    def __repr__(self):
+        return '<Notification {0} {1} {2}>'.format(self.notification_type, self.transaction_id or self.token_id,
+                                                   self.transaction_status)
+
+def parse_notification(body):
+    '''
+    Parses the form encoded body of an IPN into a :py:class:`Notification`.
+    '''
+    return Notification(dict(parse_qsl(body, keep_blank_values=True)))
+
+class RecentIndex(object):
+    '''
+    The keys of the most recent max_size notifications, for dropping the copies FPS sends again.
+    '''
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._keys = OrderedDict()
+
+    def claim(self, key):
+        '''
+        Returns True and remembers key if it hasn't been seen, False if it has.
+        '''
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._keys[key] = True
+            if len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+            return True
+
+    def forget(self, key):
+        '''
+        Forgets key, when a notification couldn't be delivered and FPS should send it again.
+        '''
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+class _Receiver(object):
+    def __init__(self, url_end_point, verifier, recent):
+        if verifier is None:
+            verifier = default_verifier()
+        if recent is None:
+            recent = RecentIndex()
+        self.url_end_point = url_end_point
+        self.verifier = verifier
+        self.recent = recent
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+    def check(self, body):
+        '''
+        Parses and verifies body. Returns ``(status, notification)``, status is None when the notification
+        should be delivered.
+        '''
+        self.received += 1
+        try:
+            notification = parse_notification(body)
+        except ValueError:
+            self.rejected += 1
+            return 400, None
+        if self.verifier is not False:
+            try:
+                valid = self.verifier.verify(notification.params, self.url_end_point, 'POST')
+            except IOError:
+                # The signing certificate couldn't be fetched, have FPS try again later.
+                return 503, None
+            except ValueError:
+                valid = False
+            if not valid:
+                self.rejected += 1
+                return 403, None
+        if not self.recent.claim(notification.key):
+            self.duplicates += 1
+            return 200, None
+        return None, notification
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 405: 'Method Not Allowed', 500: 'Internal Server Error',
+            503: 'Service Unavailable'}
+
+class IPNReceiver(_Receiver):
+    '''
+    A WSGI application that receives IPNs::
+
+        def handle(notification):
+            orders.update_status(notification.caller_reference, notification.transaction_status)
+
+        application = IPNReceiver('https://shop.example.com/fps/ipn', callback=handle)
+
+    Give either a callback or a queue. A callback is called on the request thread and should be quick. A
+    ``Queue.Queue`` with a maxsize decouples slow processing from the request, when it's still full after
+    put_timeout the notification is refused with 503.
+
+        :param url_end_point: The URL FPS posts to, exactly as registered, it's part of what FPS signs.
+
+        :param callback: Called with each new :py:class:`Notification`.
+
+        :param queue: A ``Queue.Queue`` that new notifications are put on.
+
+        :param put_timeout: Seconds to wait for room on the queue.
+
+        :param verifier: The :py:class:`flexpay.verify.SignatureVerifier`, False skips verification. The default
+            is :py:func:`flexpay.verify.default_verifier`.
+
+        :param recent: The :py:class:`RecentIndex` of notifications already received.
+    '''
+
+    def __init__(self, url_end_point, callback=None, queue=None, put_timeout=1.0, verifier=None, recent=None):
+        if (callback is None) == (queue is None):
+            raise TypeError('IPNReceiver needs either a callback or a queue.')
+        _Receiver.__init__(self, url_end_point, verifier, recent)
+        self.callback = callback
+        self.queue = queue
+        self.put_timeout = put_timeout
+
+    def deliver(self, notification):
+        if self.queue is not None:
+            self.queue.put(notification, timeout=self.put_timeout)
+        else:
+            self.callback(notification)
+
+    def receive(self, body):
+        '''
+        Handles one posted body. Returns the HTTP status to answer with.
+        '''
+        status, notification = self.check(body)
+        if status is not None:
+            return status
+        try:
+            self.deliver(notification)
+        except Full:
+            self.recent.forget(notification.key)
+            return 503
+        except Exception:
+            self.recent.forget(notification.key)
+            raise
+        return 200
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] != 'POST':
+            status = 405
+        else:
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+            try:
+                status = self.receive(environ['wsgi.input'].read(length))
+            except Exception:
+                environ['wsgi.errors'].write('Delivering an IPN failed.\n')
+                status = 500
+        start_response('{0} {1}'.format(status, _REASONS[status]), [('Content-Type', 'text/plain'),
+                                                                     ('Content-Length', '0')])
+        return []
+
+class AsyncIPNReceiver(_Receiver):
+    '''
+    Receives IPNs on an asyncio event loop::
+
+        queue = asyncio.Queue(maxsize=1000)
+        receiver = AsyncIPNReceiver('https://shop.example.com/fps/ipn', queue=queue)
+        server = loop.run_until_complete(receiver.start_server(port=8081))
+
+        @asyncio.coroutine
+        def worker():
+            while True:
+                notification = yield From(queue.get())
+                ...
+
+    Give either a callback, a coroutine function called with each new notification, or an ``asyncio.Queue``.
+    When the queue stays full for put_timeout seconds the notification is refused with 503. The first time a
+    certificate is needed the notification is checked on the loop's executor, after that verification runs on the
+    loop.
+
+    The parameters are the same as :py:class:`IPNReceiver`'s.
+    '''
+
+    def __init__(self, url_end_point, callback=None, queue=None, put_timeout=1.0, verifier=None, recent=None,
+                 loop=None):
+        _require_asyncio()
+        if (callback is None) == (queue is None):
+            raise TypeError('AsyncIPNReceiver needs either a callback or a queue.')
+        _Receiver.__init__(self, url_end_point, verifier, recent)
+        self.callback = callback
+        self.queue = queue
+        self.put_timeout = put_timeout
+        self.loop = loop or asyncio.get_event_loop()
+
+    @_coroutine
+    def receive(self, body):
+        '''
+        Handles one posted body. Returns the HTTP status to answer with.
+        '''
+        url = None
+        if self.verifier is not False:
+            url = dict(parse_qsl(body)).get('certificateUrl')
+        if url and not self.verifier.certificates.cached(url):
+            # Checking fetches the certificate, which mustn't block the loop, even when the fetch fails.
+            status, notification = yield From(self.loop.run_in_executor(None, self.check, body))
+        else:
+            status, notification = self.check(body)
+        if status is not None:
+            raise Return(status)
+        try:
+            if self.queue is not None:
+                yield From(asyncio.wait_for(self.queue.put(notification), self.put_timeout, loop=self.loop))
+            else:
+                yield From(self.callback(notification))
+        except asyncio.TimeoutError:
+            self.recent.forget(notification.key)
+            raise Return(503)
+        except Exception:
+            self.recent.forget(notification.key)
+            raise
+        raise Return(200)
+
+    @_coroutine
+    def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = yield From(reader.readline())
+                if not request_line:
+                    break
+                method = request_line.split(' ', 1)[0]
+                headers = {}
+                while True:
+                    line = yield From(reader.readline())
+                    if line in ('\r\n', '\n', ''):
+                        break
+                    name, value = line.split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                if 'content-length' not in headers and 'transfer-encoding' not in headers:
+                    headers['content-length'] = '0'
+                body = yield From(_read_body(reader, headers))
+                if method != 'POST':
+                    status = 405
+                else:
+                    try:
+                        status = yield From(self.receive(body))
+                    except Exception:
+                        status = 500
+                keep_alive = headers.get('connection', '').lower() != 'close' and 'HTTP/1.1' in request_line
+                writer.write('HTTP/1.1 {0} {1}\r\nContent-Length: 0\r\nConnection: {2}\r\n\r\n'.format(
+                    status, _REASONS[status], 'keep-alive' if keep_alive else 'close'))
+                if not keep_alive:
+                    break
+        except (IOError, OSError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @_coroutine
+    def start_server(self, host='0.0.0.0', port=8081, **kwargs):
+        '''
+        Starts listening for IPNs, extra arguments are passed to ``asyncio.start_server``. Returns the server.
+        '''
+        server = yield From(asyncio.start_server(self.handle_connection, host, port, loop=self.loop, **kwargs))
+        raise Return(server)
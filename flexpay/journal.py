@@ -0,0 +1,310 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from flexpay.exceptions import RestAPIException
+from flexpay.retry import RETRYABLE_CODES
+
+__all__ = ["Journal", "JournalEntry", "Replay", "REPLAYABLE_ACTIONS", "recover"]
+
+REPLAYABLE_ACTIONS = frozenset(['Pay', 'Reserve', 'Refund'])
+'''
+Actions FPS de-duplicates by ``CallerReference``, sending one again returns the original transaction.
+'''
+
+# Each record is its length and CRC-32 followed by that many bytes of JSON. A zero length marks the end.
+_HEADER = struct.Struct('<II')
+
+class JournalEntry(object):
+    '''
+    An operation recorded in a :py:class:`Journal`.
+
+        .. py:attribute:: id
+
+        .. py:attribute:: action
+
+        .. py:attribute:: params
+
+            The parameters built by the API method, without the signature or timestamp.
+
+        .. py:attribute:: outcome
+
+            None while the outcome is unknown, otherwise a dict with ``ok`` and either the ``TransactionId`` and
+            ``TransactionStatus`` of the response or the HTTP ``status`` and error ``code`` of a client error.
+    '''
+
+    def __init__(self, id, params, outcome=None):
+        self.id = id
+        self.action = params.get('Action')
+        self.params = params
+        self.outcome = outcome
+
+    @property
+    def finished(self):
+        return self.outcome is not None
+
+    def __repr__(self):
+        return '<JournalEntry {0} {1} {2}>'.format(self.id, self.action, 'finished' if self.finished else 'pending')
+
+def _outcome(response=None, error=None):
+    if error is None:
+        outcome = {'ok': True}
+        for name in ('TransactionId', 'TransactionStatus'):
+            value = getattr(response, name, None)
+            if value is not None:
+                outcome[name] = value.value
+        return outcome
+    if isinstance(error, RestAPIException) and error.status < 500 and error.code not in RETRYABLE_CODES:
+        # FPS refused the request, it never took effect.
+        return {'ok': False, 'status': error.status, 'code': error.code}
+    # No answer, or a server error FPS says to retry with the same CallerReference: the operation may or may
+    # not have happened.
+    return None
+
+def _fsync_directory(path):
+    # Makes a file created or renamed in the directory durable.
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Journal(object):
+    '''
+    A durable, append-only log of the operations a :py:class:`flexpay.payment.FlexPay` sends::
+
+        journal = Journal('/var/lib/shop/flexpay.journal')
+        recover(FlexPay(PUB_KEY, SECRET_KEY), journal)
+        flex_pay = FlexPay(PUB_KEY, SECRET_KEY, journal=journal)
+
+    Before a call that isn't a read is sent, its parameters are appended and flushed to disk. The outcome is
+    appended once FPS answers. After a crash, :py:func:`recover` finds the operations without an outcome.
+
+    Records are written to a memory mapped file. Concurrent calls share their flushes: the first caller
+    to wait flushes every record appended so far, and the others only wait for it.
+
+        :param path: The journal file, created if it doesn't exist.
+
+        :param chunk_size: The file grows by this many bytes at a time.
+    '''
+
+    def __init__(self, path, chunk_size=4 * 1024 * 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._cond = threading.Condition(threading.Lock())
+        self._flush_lock = threading.Lock()
+        self._entries = {} # The pending entries by id.
+        self._next_id = 1
+        self._open()
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        size = os.fstat(self._fd).st_size
+        if size == 0:
+            size = self.chunk_size
+            os.ftruncate(self._fd, size)
+            os.fsync(self._fd)
+            _fsync_directory(self.path)
+        self._map = mmap.mmap(self._fd, size)
+        self._end = self._scan()
+        self._written = self._synced = self._end
+
+    def _scan(self):
+        # Loads every intact record, stops at the end marker or at a record torn by a crash.
+        m = self._map
+        pos = 0
+        while pos + _HEADER.size <= len(m):
+            length, crc = _HEADER.unpack_from(m, pos)
+            start = pos + _HEADER.size
+            if length == 0 or start + length > len(m):
+                break
+            data = m[start:start + length]
+            if zlib.crc32(data) & 0xffffffff != crc:
+                break
+            self._load(json.loads(data))
+            pos = start + length
+        # Clear whatever a torn write left behind. Records after a torn one may have reached the disk too, they
+        # must not come back once a new record of the same length is written over the torn one.
+        end = pos
+        cleared = False
+        while end < len(m):
+            size = min(len(m) - end, 65536)
+            if m[end:end + size].strip('\0'):
+                m[end:end + size] = '\0' * size
+                cleared = True
+            end += size
+        if cleared:
+            m.flush()
+        return pos
+
+    def _load(self, record):
+        id = record['id']
+        if 'params' in record:
+            params = dict((str(k), v.encode('utf-8') if isinstance(v, unicode) else v)
+                          for k, v in record['params'].iteritems())
+            self._entries[id] = JournalEntry(id, params)
+            self._next_id = max(self._next_id, id + 1)
+        else:
+            entry = self._entries.pop(id, None)
+            if entry is not None:
+                entry.outcome = record['outcome']
+
+    def _grow(self, needed):
+        # Called with the lock held.
+        size = len(self._map)
+        while size < needed:
+            size += self.chunk_size
+        with self._flush_lock:
+            self._map.flush()
+            self._map.close()
+            os.ftruncate(self._fd, size)
+            os.fsync(self._fd)
+            self._map = mmap.mmap(self._fd, size)
+            self._synced = self._written
+
+    def _append(self, record):
+        # Called with the lock held. Returns the offset after the record.
+        data = json.dumps(record, separators=(',', ':'))
+        end = self._end + _HEADER.size + len(data)
+        if end + _HEADER.size > len(self._map):
+            self._grow(end + _HEADER.size)
+        m = self._map
+        m[self._end + _HEADER.size:end] = data
+        # The header goes last, a record is only visible once it's complete.
+        _HEADER.pack_into(m, self._end, len(data), zlib.crc32(data) & 0xffffffff)
+        self._end = self._written = end
+        return end
+
+    def _sync(self, offset):
+        '''
+        Waits until everything up to offset is on disk.
+        '''
+        with self._cond:
+            while self._synced < offset:
+                if self._flush_lock.acquire(False):
+                    break
+                self._cond.wait()
+            else:
+                return
+            target = self._written
+            start = self._synced - self._synced % mmap.PAGESIZE
+            m = self._map
+        try:
+            m.flush(start, target - start)
+        finally:
+            self._flush_lock.release()
+        with self._cond:
+            self._synced = max(self._synced, target)
+            self._cond.notify_all()
+        if target < offset:
+            self._sync(offset)
+
+    def intent(self, params):
+        '''
+        Records an operation that is about to be sent and returns its :py:class:`JournalEntry` once the record
+        is on disk.
+        '''
+        params = dict((k, v) for k, v in params.iteritems() if k not in ('Signature', 'Timestamp'))
+        with self._cond:
+            entry = JournalEntry(self._next_id, params)
+            self._next_id += 1
+            self._entries[entry.id] = entry
+            offset = self._append({'id': entry.id, 'params': params})
+        self._sync(offset)
+        return entry
+
+    def outcome(self, entry, response=None, error=None, sync=False):
+        '''
+        Records how entry ended. Errors without a response from FPS leave the entry pending, and so do 5xx
+        errors and the codes in :py:data:`flexpay.retry.RETRYABLE_CODES`, which FPS asks to be retried with the
+        same ``CallerReference``. Outcomes aren't flushed unless sync is True, losing one only means the
+        operation is replayed.
+        '''
+        outcome = _outcome(response, error)
+        if outcome is None:
+            return
+        with self._cond:
+            entry.outcome = outcome
+            self._entries.pop(entry.id, None)
+            offset = self._append({'id': entry.id, 'outcome': outcome})
+        if sync:
+            self._sync(offset)
+
+    def pending(self):
+        '''
+        The entries without an outcome, oldest first.
+        '''
+        with self._cond:
+            return sorted(self._entries.values(), key=lambda e: e.id)
+
+    def compact(self):
+        '''
+        Rewrites the journal with only the pending entries. Don't call it while calls are in flight.
+        '''
+        pending = self.pending()
+        tmp = self.path + '.compact'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        fresh = Journal(tmp, self.chunk_size)
+        with fresh._cond:
+            for entry in pending:
+                fresh._append({'id': entry.id, 'params': entry.params})
+        # Closing syncs the new file, it has to be on disk before it replaces the old one.
+        fresh.close()
+        with self._cond:
+            self._close()
+            os.rename(tmp, self.path)
+            _fsync_directory(self.path)
+            self._entries = {}
+            self._open()
+
+    def _close(self):
+        self._map.flush()
+        self._map.close()
+        os.fsync(self._fd)
+        os.close(self._fd)
+
+    def close(self):
+        with self._cond:
+            self._close()
+
+class Replay(object):
+    '''
+    What :py:func:`recover` did with a pending :py:class:`JournalEntry`. When replayed is False the entry
+    couldn't be replayed safely and is left for you to resolve.
+    '''
+
+    def __init__(self, entry, response=None, error=None, replayed=False):
+        self.entry = entry
+        self.response = response
+        self.error = error
+        self.replayed = replayed
+
+    def __repr__(self):
+        return '<Replay {0!r} replayed={1} error={2!r}>'.format(self.entry, self.replayed, self.error)
+
+def recover(client, journal, actions=REPLAYABLE_ACTIONS):
+    '''
+    Sends every pending entry of journal whose Action is in actions again, and records the outcomes.
+    Only Actions FPS de-duplicates are replayed by default, so a call that went through before the crash
+    returns the original transaction instead of charging twice.
+
+    :Returns:
+        A list of :py:class:`Replay`, one per pending entry.
+    '''
+    results = []
+    for entry in journal.pending():
+        if entry.action not in actions:
+            results.append(Replay(entry))
+            continue
+        try:
+            response = client.send_uncached(dict(entry.params))
+        except Exception, error:
+            journal.outcome(entry, error=error)
+            results.append(Replay(entry, error=error, replayed=True))
+            continue
+        journal.outcome(entry, response)
+        results.append(Replay(entry, response, replayed=True))
+    return results
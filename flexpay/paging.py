@@ -0,0 +1,59 @@
+import sys
+import threading
+
+__all__ = ["iter_pages"]
+
+class _Prefetch(object):
+    '''
+    Fetches one page on a background thread.
+    '''
+
+    def __init__(self, fetch, key):
+        self._fetch = fetch
+        self._key = key
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self._result = self._fetch(self._key)
+        except Exception:
+            self._error = sys.exc_info()
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+def iter_pages(fetch, key, next_key, prefetch=True):
+    '''
+    Yields the pages of a paginated listing, one at a time.
+
+        :param fetch: Called with a page key, returns the page.
+
+        :param key: Key of the first page.
+
+        :param next_key: Called with a page, returns the key of the next page or None on the last page.
+
+        :param prefetch: Fetch the next page on a background thread while the caller works through the current one.
+    '''
+    page = fetch(key)
+    while page is not None:
+        key = next_key(page)
+        if key is None:
+            following = None
+        elif prefetch:
+            following = _Prefetch(fetch, key)
+        else:
+            following = key
+        yield page
+        if following is None:
+            page = None
+        elif prefetch:
+            page = following.result()
+        else:
+            page = fetch(following)
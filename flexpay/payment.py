@@ -1,21 +1,34 @@
 import hmac
 from hashlib import sha256, sha1
 from datetime import datetime
+import sys
+import time
 import urllib
-import urllib2
 from urlparse import urlparse
 import base64
-from flexpay.response import make_response
-from flexpay.utils import make_enum, signature_quote, make_amount
+from flexpay.batch import run_batch
+from flexpay.cbui import CBUITemplate, generate_urls
+from flexpay.response import make_response_from_stream
+from flexpay.retry import call_with_retry, READ_ACTIONS
+from flexpay.results import TransactionStatus, TokenStatus, VerificationStatus
+from flexpay.signing import Signer, RequestTemplate, string_to_sign
+from flexpay.exceptions import RestAPIException
+from flexpay.instrument import TimedReader
+from flexpay.paging import iter_pages
+from flexpay.transport import default_transport
+from flexpay.verify import default_verifier
+from flexpay.utils import make_enum, make_amount, make_timestamp
 from functools import wraps
 
-__all__ = ["PaymentMethod", "CBUIStatus", "CBUIPipeline", "CurrencyCode", "SandboxAPI", "FlexPay"]
+__all__ = ["PaymentMethod", "CBUIStatus", "CBUIPipeline", "CurrencyCode", "TransactionStatus", "TokenStatus", "SandboxAPI", "FlexPay"]
 
 '''
 Enumerated Values
 You can convert string intro one of the enum's by using reverse_lookup.
 For Example:
 CC = PaymentMethod.reverse_lookup('CC')
+Comma separated lists can be converted with parse_list:
+methods = PaymentMethod.parse_list('ABT,ACH,CC')
 '''
 
 PaymentMethod = make_enum(
@@ -170,10 +183,7 @@ When your ready for the production environment created your own with the correct
 def api_method(f):
     @wraps(f)
     def wrap(self, *args):
-        params = f(self, *args)
-        self.api_parameters(params)
-        params['Signature'] = self.make_signature(params, self.api.API_URL)        
-        return self.make_request(self.api.API_URL, params)
+        return self.call_api(f(self, *args))
     return wrap
 
 def cbui_api_method(f):
@@ -192,6 +202,31 @@ def find_signature_method(params, default):
     else:
         return sha256
 
+def cbui_payment_methods(pipeline, paymentMethod):
+    '''
+    Validates the pipeline and payment methods for a CBUI request. Returns the paymentMethod parameter.
+    '''
+    if not isinstance(pipeline, CBUIPipeline):
+        raise TypeError('Argument pipeline should be an instance of CBUIPipeline.')
+    
+    # paymentMethod should be a list.
+    if not isinstance(paymentMethod, list):
+        paymentMethod = [ paymentMethod ]
+    
+    # Each element of the list should be a PaymentMethod, join checks them by identity.
+    try:
+        return PaymentMethod.join(paymentMethod)
+    except TypeError:
+        raise TypeError('Argument paymentMethod should be a list of PaymentMethod instances.')
+
+def _cbui_arguments(order_id,
+                    return_url,
+                    amount,
+                    reason_text = None,
+                    pipeline = CBUIPipeline.SingleUse,
+                    paymentMethod = [PaymentMethod.ABT, PaymentMethod.ACH, PaymentMethod.CC]):
+    return order_id, return_url, amount, reason_text, pipeline, paymentMethod
+
 class FlexPay:
     """
     FlexPay class.
@@ -201,7 +236,17 @@ class FlexPay:
                  aws_public_key,
                  aws_secret_key,
                  api=SandboxAPI,
-                 currency_code=CurrencyCode.USD):
+                 currency_code=CurrencyCode.USD,
+                 transport=None,
+                 keep_response_text=True,
+                 instrument=None,
+                 retry=None,
+                 hedge=None,
+                 cache=None,
+                 verifier=None,
+                 journal=None,
+                 rate_limiter=None,
+                 single_flight=None):
         '''
             :param aws_public_key: Your AWS public key.
             
@@ -210,23 +255,78 @@ class FlexPay:
             :param api: The API that you want to use. The default is :py:class:`flexpay.payment.SandboxAPI`.
             
             :param currency_code: The currency to use for transactions. Must be an instance of :py:class:`flexpay.payment.CurrencyCode`.
+            
+            :param transport: The :py:class:`flexpay.transport.Transport` used to send requests. The default is a \
+            pool of keep-alive connections shared by every FlexPay instance, see :py:func:`flexpay.transport.default_transport`.
+            
+            :param keep_response_text: Keep the raw XML of each response as ``ResponseText``. Turn this off to save memory.
+            
+            :param instrument: A :py:class:`flexpay.instrument.Instrumentation` that receives the timing of every API call.
+            
+            :param retry: A :py:class:`flexpay.retry.RetryPolicy` for retrying transient failures. The default doesn't retry.
+            
+            :param hedge: A :py:class:`flexpay.retry.HedgePolicy` for hedging reads. The default doesn't hedge.
+            
+            :param cache: A :py:class:`flexpay.cache.ResponseCache` for reads. The default doesn't cache.
+            
+            :param verifier: The :py:class:`flexpay.verify.SignatureVerifier` for return URLs and IPNs. The default \
+            shares one in-memory certificate cache between every FlexPay instance.
+            
+            :param journal: A :py:class:`flexpay.journal.Journal` that records every operation that isn't a read \
+            before it's sent. The default doesn't journal.
+            
+            :param rate_limiter: A :py:class:`flexpay.ratelimit.RateLimiter` that paces requests. The default \
+            doesn't limit.
+            
+            :param single_flight: A :py:class:`flexpay.coalesce.SingleFlight` that lets identical concurrent reads \
+            share one request. The default sends each.
         '''
         self.pub_key = aws_public_key
         self.secret_key = aws_secret_key
         self.currency_code = currency_code
         self.api = api
+        self.keep_response_text = keep_response_text
+        self.instrument = instrument
+        self.retry = retry
+        self.hedge = hedge
+        self.cache = cache
+        if verifier is None:
+            verifier = default_verifier()
+        self.verifier = verifier
+        self.journal = journal
+        self.rate_limiter = rate_limiter
+        self.single_flight = single_flight
+        self.signer = Signer(aws_secret_key)
+        self._templates = {}
+        if transport is None:
+            transport = default_transport()
+        self.transport = transport
+    
+    def prewarm(self, count=1):
+        '''
+        Opens ``count`` connections to the FPS endpoint ahead of the first request.
+        '''
+        return self.transport.prewarm(self.api.API_URL, count)
     
     def cbui_api_parameters(self, params):
         params['callerKey'] = self.pub_key
         params['signatureMethod'] = 'HmacSHA256'
         params['signatureVersion'] = 2
         
+    def static_api_parameters(self):
+        '''
+        The parameters that are the same for every API request.
+        '''
+        return {
+            'AWSAccessKeyId': self.pub_key,
+            'SignatureMethod': 'HmacSHA256',
+            'SignatureVersion': 2,
+            'Version': '2010-08-28',
+        }
+    
     def api_parameters(self, params):
-        params['AWSAccessKeyId'] = self.pub_key
-        params['SignatureMethod'] = 'HmacSHA256'
-        params['SignatureVersion'] = 2
-        params['Version'] = '2010-08-28'
-        params['Timestamp'] = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        params.update(self.static_api_parameters())
+        params['Timestamp'] = make_timestamp(datetime.utcnow())
         return params
     
     def make_signature(self, params, url):
@@ -244,27 +344,155 @@ class FlexPay:
         # When returning from the cobranded ui url a different signature method may be present.
         # So we'll need to figure out which one to use in order to produce the correct signature.
         signature_method = find_signature_method(params, 'HmacSHA256')
-        up = urlparse(url)
-          
-        qs = 'GET\n'
-        qs += up.netloc + '\n'
-        qs += up.path + '\n'
-        
-        qs += '&'.join(signature_quote(i[0]) + '=' + signature_quote(i[1]) for i in sorted(params.items()))
+        qs = string_to_sign(params, url)
         sig = base64.b64encode(hmac.new(self.secret_key, qs, signature_method).digest())
         return sig
     
-    def make_request(self, url, params):
+    def sign_request(self, params):
+        '''
+        Adds the common parameters and the signature to params. Returns the url and params to send.
+        '''
+        self.api_parameters(params)
+        params['Signature'] = self.request_template(params['Action']).sign(params)
+        return self.api.API_URL, params
+    
+    def request_template(self, action):
+        '''
+        Returns the :py:class:`flexpay.signing.RequestTemplate` used to sign requests for action.
+        '''
+        url = self.api.API_URL
+        template = self._templates.get((action, url))
+        if template is None:
+            static = self.static_api_parameters()
+            static['Action'] = action
+            template = self._templates[(action, url)] = RequestTemplate(self.signer, url, static)
+        return template
+    
+    def call_api(self, params):
+        '''
+        Sends the parameters built by an API method, journaling, caching, coalescing, retrying and hedging \
+        according to the client's policies.
+        '''
+        cache = self.cache
+        journal = self.journal
+        if cache is None and journal is None:
+            return self.send_uncached(params)
+        
+        if cache is not None:
+            scope = self.scope()
+            resp = cache.get(params, scope)
+            if resp is not None:
+                return resp
+        # Taken before sending, signing adds to params.
+        key = dict(params)
+        entry = None
+        if journal is not None and key['Action'] not in READ_ACTIONS:
+            entry = journal.intent(key)
         try:
-            dest = '{0}?{1}'.format(url, urllib.urlencode(params))        
-            response = urllib2.urlopen(dest)
-            data = response.read()
+            resp = self.send_uncached(params)
+        except Exception, error:
+            exc_info = sys.exc_info()
+            if entry is not None:
+                journal.outcome(entry, error=error)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            if cache is not None:
+                cache.written(key, scope)
+        if entry is not None:
+            journal.outcome(entry, resp)
+        if cache is not None:
+            cache.put(key, resp, scope)
+        return resp
+    
+    def send_uncached(self, params):
+        '''
+        Sends params, coalescing identical reads, retrying and hedging according to the client's policies.
+        '''
+        single_flight = self.single_flight
+        if single_flight is not None:
+            return single_flight.call(params, lambda: self._send(params), self.scope())
+        return self._send(params)
+    
+    def scope(self):
+        '''
+        The access key and endpoint, which tell this client's requests apart from other accounts' in a shared
+        :py:class:`flexpay.cache.ResponseCache` or :py:class:`flexpay.coalesce.SingleFlight`.
+        '''
+        return (self.pub_key, self.api.API_URL)
+    
+    def _send(self, params):
+        if self.retry is None and self.hedge is None:
+            return self.send_request(params)
+        return call_with_retry(self, params)
+    
+    def send_request(self, params):
+        '''
+        Signs and sends params once.
+        '''
+        instrument = self.instrument
+        if instrument is None:
+            url, params = self.sign_request(params)
+            return self.make_request(url, params)
+        
+        timing = instrument.start(params['Action'])
+        try:
+            start = time.time()
+            url, params = self.sign_request(params)
+            timing.add('sign', time.time() - start)
+            resp = self.make_request(url, params, timing)
+        except Exception, error:
+            exc_info = sys.exc_info()
+            instrument.finish(timing, error)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        instrument.finish(timing)
+        return resp
+    
+    def make_request(self, url, params, timing=None):
+        limiter = self.rate_limiter
+        if limiter is not None:
+            ticket = limiter.acquire(params['Action'])
+        dest = '{0}?{1}'.format(url, urllib.urlencode(params))
+        response = self.transport.open(dest, timing)
+        try:
+            if timing is not None:
+                timing.status = response.status
+            if not 200 <= response.status < 300:
+                error = RestAPIException(response.status, response.reason, response.read())
+                if limiter is not None:
+                    limiter.record(ticket, error)
+                raise error
+            if limiter is not None:
+                limiter.record(ticket)
+            if timing is None:
+                return make_response_from_stream(response, params['Action'], keep_text=self.keep_response_text)
+            
+            # Reading and parsing are interleaved, time the reads and count the rest as parsing.
+            start = time.time()
+            reader = TimedReader(response)
+            resp = make_response_from_stream(reader, params['Action'], keep_text=self.keep_response_text)
+            timing.add('read', reader.elapsed)
+            timing.add('parse', time.time() - start - reader.elapsed)
+            return resp
+        finally:
             response.close()
-            return make_response(data, params['Action'])
-        except urllib2.HTTPError, httperror:
-            data = httperror.read()
-            httperror.close()
-            raise RestAPIException(httperror.code, httperror.reason, data)
+    
+    def batch(self, operations, max_workers=8, callback=None):
+        '''
+        Runs many API calls concurrently on a bounded pool of threads::
+        
+            results = flex_pay.batch([('settle', txn_id) for txn_id in reserved])
+            failed = [r for r in results if not r.ok]
+        
+        :param operations: A list of tuples, a method name followed by its arguments.
+        
+        :param max_workers: Maximum number of calls in flight at once.
+        
+        :param callback: Called with each :py:class:`flexpay.batch.BatchResult` as it completes.
+        
+        :Returns:
+            A list of :py:class:`flexpay.batch.BatchResult` in the same order as operations.
+        '''
+        return run_batch(self, operations, max_workers, callback)
     
     @api_method
     def get_account_balance(self):
@@ -281,7 +509,7 @@ class FlexPay:
         '''
         http://docs.aws.amazon.com/AmazonFPS/latest/FPSAPIReference/VerifySignatureAPI.html
         '''        
-        p = urlparse.urlparse(url)
+        p = urlparse(url)
         http_parameters = p.query
         url_end_point = '{0.scheme}://{0.netloc}{0.path}'.format(p)
         
@@ -292,6 +520,41 @@ class FlexPay:
         }
         return params
     
+    def verify_return_url(self, url, fallback=False):
+        '''
+        Checks the signature of a CBUI return URL locally, see :py:class:`flexpay.verify.SignatureVerifier`.
+        
+        :param fallback: When the signing certificate can't be fetched, ask FPS with :py:meth:`verify_signature` \
+        instead of raising.
+        
+        :Returns:
+            True if the signature is valid.
+        '''
+        try:
+            return self.verifier.verify_url(url)
+        except (IOError, ValueError):
+            if not fallback:
+                raise
+        return self.verify_signature(url).verification_status == VerificationStatus.Success
+    
+    def verify_notification(self, params, url_end_point, fallback=False):
+        '''
+        Checks the signature of an IPN, the POSTed params as a dict and the URL they were sent to.
+        
+        :param fallback: When the signing certificate can't be fetched, ask FPS with :py:meth:`verify_signature` \
+        instead of raising.
+        
+        :Returns:
+            True if the signature is valid.
+        '''
+        try:
+            return self.verifier.verify(params, url_end_point, 'POST')
+        except (IOError, ValueError):
+            if not fallback:
+                raise
+        resp = self.verify_signature('{0}?{1}'.format(url_end_point, urllib.urlencode(params)))
+        return resp.verification_status == VerificationStatus.Success
+    
     @api_method
     def pay(self, 
             order_id,
@@ -322,7 +585,7 @@ class FlexPay:
         http://docs.aws.amazon.com/AmazonFPS/latest/FPSAPIReference/Refund.html
         '''
         params = {
-            'Action': 'Pay',
+            'Action': 'Refund',
             'CallerReference': order_id,
             'TransactionId': transaction_id,
             'MarketplaceRefundPolicy': refund_policy,
@@ -430,6 +693,97 @@ class FlexPay:
             params['TokenId'] = token_id
         
         return params
+    
+    @api_method
+    def get_tokens(self, order_id=None, token_status=None, token_type=None):
+        '''
+        http://docs.aws.amazon.com/AmazonFPS/latest/FPSAPIReference/GetTokens.html
+        '''
+        params = {
+            'Action': 'GetTokens',
+        }
+        
+        if order_id is not None:
+            params['CallerReference'] = order_id
+        
+        if token_status is not None:
+            params['TokenStatus'] = token_status
+        
+        if token_type is not None:
+            params['TokenType'] = token_type
+        
+        return params
+    
+    def iter_tokens(self, order_id=None, token_status=None, token_type=None):
+        '''
+        Yields each Token returned by :py:meth:`get_tokens`.
+        '''
+        for token in self.get_tokens(order_id, token_status, token_type).getlist('Token'):
+            yield token
+    
+    @api_method
+    def get_account_activity(self,
+                             start_date,
+                             end_date=None,
+                             max_batch_size=None,
+                             operation=None,
+                             role=None,
+                             transaction_status=None):
+        '''
+        http://docs.aws.amazon.com/AmazonFPS/latest/FPSAPIReference/GetAccountActivity.html
+        
+        Dates may be datetimes in UTC or timestamp strings.
+        '''
+        params = {
+            'Action': 'GetAccountActivity',
+            'StartDate': make_timestamp(start_date),
+        }
+        
+        if end_date is not None:
+            params['EndDate'] = make_timestamp(end_date)
+        
+        if max_batch_size is not None:
+            params['MaxBatchSize'] = max_batch_size
+        
+        if operation is not None:
+            params['FPSOperation'] = operation
+        
+        if role is not None:
+            params['Role'] = role
+        
+        if transaction_status is not None:
+            params['TransactionStatus'] = transaction_status
+        
+        return params
+    
+    def iter_account_activity(self,
+                              start_date,
+                              end_date=None,
+                              max_batch_size=None,
+                              operation=None,
+                              role=None,
+                              transaction_status=None,
+                              prefetch=True):
+        '''
+        Yields every Transaction of the account activity between start_date and end_date, following \
+        ``NextStartingDate`` from page to page. Only one page is held at a time, and with prefetch the next \
+        page is requested while the current one is being consumed::
+        
+            for txn in flex_pay.iter_account_activity(datetime(2013, 8, 1), datetime(2013, 9, 1)):
+                ledger.match(txn.CallerReference.value, txn.TransactionId.value)
+        '''
+        def fetch(start):
+            return self.get_account_activity(start, end_date, max_batch_size, operation, role, transaction_status)
+        
+        def next_key(page):
+            next_start = getattr(page, 'NextStartingDate', None)
+            if next_start is None or not next_start.value:
+                return None
+            return next_start.value
+        
+        for page in iter_pages(fetch, start_date, next_key, prefetch):
+            for txn in page.getlist('Transaction'):
+                yield txn
        
     @cbui_api_method
     def get_cbui_url(self, 
@@ -462,22 +816,10 @@ class FlexPay:
         http://docs.aws.amazon.com/AmazonFPS/latest/FPSBasicGuide/SingleUsePipeline.html
         """
         
-        if not isinstance(pipeline, CBUIPipeline):
-            raise TypeError('Argument pipeline should be an instance of CBUIPipeline.')
-        
-        # paymentMethod should be a list.
-        if not isinstance(paymentMethod, list):
-            paymentMethod = [ paymentMethod ]
-        
-        # Each element of the list should be an instance of PaymentMethod
-        for pm in paymentMethod:
-            if not isinstance(pm, PaymentMethod):
-                raise TypeError('Argument paymentMethod should be a list of PaymentMethod instances.')
-        
         params = {
             'callerReference': order_id,
             'currencyCode': self.currency_code,
-            'paymentMethod': ','.join(paymentMethod),
+            'paymentMethod': cbui_payment_methods(pipeline, paymentMethod),
             'transactionAmount': make_amount(amount),
             'pipelineName': pipeline,
             'returnURL': return_url,
@@ -487,3 +829,70 @@ class FlexPay:
             params['paymentReason'] = reason_text
         
         return params
+    
+    def get_cbui_urls(self, orders, processes=0, chunk_size=500):
+        '''
+        Generates Co-Branded User Interface URLs for many orders. The URLs are yielded in the same order as orders.
+        
+        Pipeline and payment methods are validated once per distinct combination, and the part of the request \
+        shared by every order with that combination is quoted and signed once.
+        
+        :param orders: An iterable of orders. Each order is a tuple or a dict of the arguments to \
+        :py:meth:`get_cbui_url`.
+        
+        :param processes: Sign on a pool of this many processes. 0 signs in this process, None uses one per CPU.
+        
+        :param chunk_size: Number of orders sent to a worker process at a time.
+        
+        ::
+        
+            orders = ((o.id, return_url, o.amount) for o in campaign.orders())
+            for order, url in itertools.izip(campaign.orders(), flex_pay.get_cbui_urls(orders, processes=None)):
+                send_invoice(order, url)
+        '''
+        url = str(self.api.CBUI_URL)
+        static = {}
+        
+        def entries():
+            for order in orders:
+                if isinstance(order, dict):
+                    order_id, return_url, amount, reason_text, pipeline, methods = _cbui_arguments(**order)
+                else:
+                    order_id, return_url, amount, reason_text, pipeline, methods = _cbui_arguments(*order)
+                
+                # Key on the types as well, a plain 'CC' string hashes the same as PaymentMethod.CC.
+                if isinstance(methods, list):
+                    method_key = tuple((type(m), m) for m in methods)
+                else:
+                    method_key = (type(methods), methods)
+                key = (type(pipeline), pipeline, method_key)
+                static_items = static.get(key)
+                if static_items is None:
+                    params = {
+                        'currencyCode': self.currency_code,
+                        'paymentMethod': cbui_payment_methods(pipeline, methods),
+                        'pipelineName': pipeline,
+                    }
+                    self.cbui_api_parameters(params)
+                    # Plain strings, enum instances can't be pickled for the worker processes.
+                    static_items = static[key] = tuple(sorted((k, str(v)) for k, v in params.items()))
+                
+                fields = {
+                    'callerReference': order_id,
+                    'transactionAmount': make_amount(amount),
+                    'returnURL': return_url,
+                }
+                if reason_text is not None:
+                    fields['paymentReason'] = reason_text
+                yield static_items, fields
+        
+        if processes == 0:
+            templates = {}
+            for static_items, fields in entries():
+                template = templates.get(static_items)
+                if template is None:
+                    template = templates[static_items] = CBUITemplate(Signer(self.secret_key), url, dict(static_items))
+                yield template.url(fields)
+        else:
+            for u in generate_urls(self.secret_key, url, entries(), processes, chunk_size):
+                yield u
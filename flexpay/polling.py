@@ -0,0 +1,302 @@
+import heapq
+import random
+import sys
+import threading
+import time
+from Queue import Queue
+from flexpay.exceptions import RestAPIException
+from flexpay.results import TransactionStatus
+
+__all__ = ["StatusEvent", "StatusPoller", "TERMINAL_STATUSES"]
+
+TERMINAL_STATUSES = frozenset([TransactionStatus.Success,
+                               TransactionStatus.Failure,
+                               TransactionStatus.Cancelled,
+                               TransactionStatus.Reserved])
+'''
+Statuses a transaction won't leave on its own. Reserved only ends when you settle or cancel.
+'''
+
+class StatusEvent(object):
+    '''
+    A change reported by :py:class:`StatusPoller`.
+
+        .. py:attribute:: transaction_id
+
+        .. py:attribute:: status
+
+            The new status, or the last known one when error is set.
+
+        .. py:attribute:: previous
+
+            The status before this event, None for the first one.
+
+        .. py:attribute:: response
+
+            The GetTransactionStatus response, None when error is set.
+
+        .. py:attribute:: error
+
+            The exception raised by a status check that failed for good. The transaction is no longer polled.
+
+        .. py:attribute:: terminal
+
+            True if the transaction won't be polled again.
+    '''
+
+    def __init__(self, transaction_id, status, previous, response=None, error=None, terminal=False):
+        self.transaction_id = transaction_id
+        self.status = status
+        self.previous = previous
+        self.response = response
+        self.error = error
+        self.terminal = terminal
+
+    def __repr__(self):
+        return '<StatusEvent {0} {1} -> {2}>'.format(self.transaction_id, self.previous, self.status)
+
+class _Tracked(object):
+    __slots__ = ('status', 'delay', 'polls')
+
+    def __init__(self, delay):
+        self.status = None
+        self.delay = delay
+        self.polls = 0
+
+_DONE = object()
+
+class StatusPoller(object):
+    '''
+    Polls GetTransactionStatus for many pending transactions.
+
+    Checks are kept in a heap ordered by due time and run on at most ``max_workers`` threads. A transaction
+    whose status hasn't changed is checked less and less often, its delay grows by ``backoff`` up to
+    ``max_delay``. A change resets the delay. Transactions are dropped once they reach a terminal status::
+
+        poller = StatusPoller(flex_pay, max_workers=16)
+        poller.add_all(pending_ids)
+        for event in poller.events():
+            orders.update_status(event.transaction_id, event.status)
+
+        :param client: The :py:class:`flexpay.payment.FlexPay` used for the checks.
+
+        :param max_workers: Maximum number of status checks in flight.
+
+        :param initial_delay: Seconds before the second check of a transaction.
+
+        :param max_delay: Longest wait between two checks of a transaction.
+
+        :param backoff: Factor the delay grows by while the status stays the same.
+
+        :param jitter: Random fraction added to each delay so checks don't bunch up.
+
+        :param terminal: Statuses that end polling.
+
+        :param callback: Called with each :py:class:`StatusEvent`. Calls are serialized. If it raises, polling
+            stops and :py:meth:`run` raises the exception once the checks in flight are done.
+    '''
+
+    def __init__(self,
+                 client,
+                 max_workers=8,
+                 initial_delay=2.0,
+                 max_delay=300.0,
+                 backoff=2.0,
+                 jitter=0.1,
+                 terminal=TERMINAL_STATUSES,
+                 callback=None):
+        self.client = client
+        self.max_workers = max_workers
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self.terminal = terminal
+        self.callback = callback
+        self.random = random.Random()
+        self._cond = threading.Condition(threading.Lock())
+        self._callback_lock = threading.Lock()
+        self._heap = []
+        self._tracked = {}
+        self._seq = 0
+        self._in_flight = 0
+        self._stopped = False
+        self._error = None
+        self._listeners = []
+
+    def __len__(self):
+        with self._cond:
+            return len(self._tracked)
+
+    def _schedule(self, transaction_id, delay):
+        self._seq += 1
+        heapq.heappush(self._heap, (time.time() + delay, self._seq, transaction_id))
+
+    def add(self, transaction_id, delay=0):
+        '''
+        Starts polling transaction_id, the first check is due after delay seconds.
+        '''
+        with self._cond:
+            if transaction_id not in self._tracked:
+                self._tracked[transaction_id] = _Tracked(self.initial_delay)
+                self._schedule(transaction_id, delay)
+                self._cond.notify_all()
+
+    def add_all(self, transaction_ids, delay=0):
+        for transaction_id in transaction_ids:
+            self.add(transaction_id, delay)
+
+    def remove(self, transaction_id):
+        '''
+        Stops polling transaction_id, for example after you learn its status some other way.
+        '''
+        with self._cond:
+            self._tracked.pop(transaction_id, None)
+            self._cond.notify_all()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _next_due(self):
+        # Called with the lock held. Returns a transaction id, or None when there's nothing left to do.
+        while True:
+            if self._stopped or self._error is not None:
+                return None
+            heap = self._heap
+            # Skip entries for transactions that were removed.
+            while heap and heap[0][2] not in self._tracked:
+                heapq.heappop(heap)
+            if not heap and not self._in_flight:
+                return None
+            timeout = None
+            if heap and self._in_flight < self.max_workers:
+                timeout = heap[0][0] - time.time()
+                if timeout <= 0:
+                    self._in_flight += 1
+                    return heapq.heappop(heap)[2]
+            self._cond.wait(timeout)
+
+    def _check(self, transaction_id):
+        response = error = None
+        try:
+            response = self.client.get_transaction_status(transaction_id)
+        except Exception, e:
+            error = e
+
+        event = None
+        with self._cond:
+            self._in_flight -= 1
+            tracked = self._tracked.get(transaction_id)
+            if tracked is not None:
+                tracked.polls += 1
+                if error is not None:
+                    if isinstance(error, RestAPIException) and error.status == 400:
+                        # An unknown or invalid transaction, checking again won't help.
+                        del self._tracked[transaction_id]
+                        event = StatusEvent(transaction_id, tracked.status, tracked.status, error=error, terminal=True)
+                    else:
+                        tracked.delay = min(self.max_delay, tracked.delay * self.backoff)
+                        self._schedule(transaction_id, self._jittered(tracked.delay))
+                else:
+                    status = getattr(response, 'transaction_status', None) or response.TransactionStatus.value
+                    terminal = status in self.terminal
+                    if status != tracked.status:
+                        event = StatusEvent(transaction_id, status, tracked.status, response, terminal=terminal)
+                        tracked.status = status
+                        tracked.delay = self.initial_delay
+                    else:
+                        tracked.delay = min(self.max_delay, tracked.delay * self.backoff)
+                    if terminal:
+                        del self._tracked[transaction_id]
+                    else:
+                        self._schedule(transaction_id, self._jittered(tracked.delay))
+            self._cond.notify_all()
+
+        if event is not None:
+            self._emit(event)
+
+    def _jittered(self, delay):
+        return delay * (1 + self.jitter * self.random.random())
+
+    def _emit(self, event):
+        with self._callback_lock:
+            if self.callback is not None:
+                self.callback(event)
+            for listener in self._listeners:
+                listener(event)
+
+    def run(self):
+        '''
+        Polls until every transaction has reached a terminal status or :py:meth:`stop` is called.
+        '''
+        self._error = None
+        jobs = Queue()
+
+        def worker():
+            while True:
+                transaction_id = jobs.get()
+                if transaction_id is _DONE:
+                    return
+                try:
+                    self._check(transaction_id)
+                except Exception:
+                    # Usually the callback. Stop handing out checks, run raises it once the workers are done.
+                    with self._cond:
+                        if self._error is None:
+                            self._error = sys.exc_info()
+                        self._cond.notify_all()
+
+        threads = [threading.Thread(target=worker) for i in range(self.max_workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            while True:
+                with self._cond:
+                    transaction_id = self._next_due()
+                if transaction_id is None:
+                    break
+                jobs.put(transaction_id)
+        finally:
+            for t in threads:
+                jobs.put(_DONE)
+            for t in threads:
+                t.join()
+        error, self._error = self._error, None
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def events(self):
+        '''
+        Runs the poller on a background thread and yields each :py:class:`StatusEvent` as it happens. An
+        exception raised by :py:meth:`run` is raised here after the last event.
+        '''
+        events = Queue()
+        self._listeners.append(events.put)
+        failed = []
+
+        def run():
+            try:
+                self.run()
+            except Exception:
+                failed.append(sys.exc_info())
+            finally:
+                events.put(_DONE)
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        try:
+            while True:
+                event = events.get()
+                if event is _DONE:
+                    if failed:
+                        raise failed[0][0], failed[0][1], failed[0][2]
+                    return
+                yield event
+        finally:
+            self._listeners.remove(events.put)
+            if t.is_alive():
+                self.stop()
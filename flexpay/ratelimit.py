@@ -0,0 +1,143 @@
+import threading
+import time
+
+__all__ = ["RateController", "RateLimiter"]
+
+class RateController(object):
+    '''
+    A token bucket whose rate adapts AIMD style: it grows by ``increase`` requests per second for every second
+    of successful calls, and is multiplied by ``decrease`` when FPS throttles. Until the first throttle it
+    grows faster, doubling every second of successful calls, to find the limit quickly.
+
+    Only throttles of requests sent after the last decrease count, so a burst of throttled responses that were
+    already in flight backs off once rather than collapsing the rate.
+
+        :param rate: The starting rate in requests per second.
+
+        :param min_rate: The rate never drops below this.
+
+        :param max_rate: The rate never grows above this.
+
+        :param increase: Requests per second added for each second of successful calls.
+
+        :param decrease: Factor the rate is multiplied by on a throttle.
+
+        :param burst: Requests that may be sent at once after an idle period.
+    '''
+
+    def __init__(self,
+                 rate=10.0,
+                 min_rate=0.5,
+                 max_rate=1000.0,
+                 increase=1.0,
+                 decrease=0.5,
+                 burst=1,
+                 clock=time.time,
+                 sleep=time.sleep):
+        self.rate = float(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.throttles = 0
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._decreased = 0.0
+        self._slow_start = True
+
+    def acquire(self):
+        '''
+        Waits for a token. Returns the time it was granted, pass it to :py:meth:`record`.
+        '''
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                # Rounding can leave the bucket a hair short of a token after sleeping exactly the wait, and a
+                # wait that small may not move the clock at all.
+                if self._tokens >= 1 - 1e-9:
+                    self._tokens = max(0.0, self._tokens - 1)
+                    return now
+                wait = (1 - self._tokens) / self.rate
+            self.sleep(wait)
+
+    def record(self, granted, throttled=False):
+        '''
+        Adjusts the rate after a request granted at granted got an answer.
+        '''
+        with self._lock:
+            if throttled:
+                self.throttles += 1
+                self._slow_start = False
+                # A request granted at the instant of the last decrease was still sent at the old rate.
+                if granted > self._decreased:
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self._decreased = self.clock()
+                    self._tokens = min(self._tokens, 0.0)
+            elif self._slow_start:
+                self.rate = min(self.max_rate, self.rate + 1)
+            else:
+                # One success is 1/rate seconds of calls, so increase per second works out the same at any rate.
+                self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+class RateLimiter(object):
+    '''
+    Paces requests so they stay just under the rate FPS accepts::
+
+        limiter = RateLimiter(RateController(rate=20), {'Pay': pay_and_settle, 'Settle': pay_and_settle})
+        flex_pay = FlexPay(PUB_KEY, SECRET_KEY, rate_limiter=limiter)
+
+    Share one limiter, and the FlexPay using it, between threads so they draw from the same budget.
+
+        :param default: The :py:class:`RateController` for Actions without one of their own. FPS throttles per
+            account, so by default every Action shares it.
+
+        :param actions: A dict of Action to :py:class:`RateController`. Actions may share a controller.
+
+        :param throttle_codes: Error codes that mean FPS throttled the request. A 503 without an error
+            code counts too.
+    '''
+
+    def __init__(self, default=None, actions=None, throttle_codes=('RequestThrottled', 'ServiceUnavailable')):
+        if default is None:
+            default = RateController()
+        self.default = default
+        self.actions = dict(actions or {})
+        self.throttle_codes = throttle_codes
+
+    def controller_for(self, action):
+        return self.actions.get(action, self.default)
+
+    def acquire(self, action):
+        '''
+        Waits until a request for action may be sent. Returns a ticket for :py:meth:`record`.
+        '''
+        controller = self.controller_for(action)
+        return controller, controller.acquire()
+
+    def record(self, ticket, error=None):
+        '''
+        Reports how the request of ticket went, error is the :py:class:`flexpay.exceptions.RestAPIException`
+        it raised, if any.
+        '''
+        controller, granted = ticket
+        if error is None:
+            controller.record(granted)
+            return
+        code = error.code
+        throttled = code in self.throttle_codes if code is not None else error.status == 503
+        if throttled:
+            controller.record(granted, True)
+
+    def rates(self):
+        '''
+        Returns ``{action: rate}`` for the configured Actions and ``None`` for the default.
+        '''
+        rates = dict((action, c.rate) for action, c in self.actions.iteritems())
+        rates[None] = self.default.rate
+        return rates
@@ -0,0 +1,275 @@
+import csv
+import sqlite3
+from decimal import Decimal, InvalidOperation
+
+__all__ = ["Reconciler", "Mismatch", "MISSING_IN_FPS", "MISSING_IN_LEDGER", "AMOUNT_DIFFERS", "STATUS_DIFFERS"]
+
+MISSING_IN_FPS = 'missing_in_fps'
+MISSING_IN_LEDGER = 'missing_in_ledger'
+AMOUNT_DIFFERS = 'amount_differs'
+STATUS_DIFFERS = 'status_differs'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS ledger (
+    caller_reference TEXT NOT NULL,
+    transaction_id TEXT,
+    amount TEXT,
+    status TEXT,
+    operation TEXT NOT NULL,
+    PRIMARY KEY (caller_reference, operation)
+);
+CREATE INDEX IF NOT EXISTS ledger_transaction_id ON ledger (transaction_id);
+CREATE TABLE IF NOT EXISTS activity (
+    transaction_id TEXT PRIMARY KEY,
+    caller_reference TEXT,
+    amount TEXT,
+    status TEXT,
+    operation TEXT,
+    date_received TEXT
+);
+CREATE INDEX IF NOT EXISTS activity_caller_reference ON activity (caller_reference, operation);
+CREATE TABLE IF NOT EXISTS checkpoint (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+def _amount(value):
+    # Amounts are compared as text, so 10, 10.0 and 10.00 have to come out the same.
+    if value is None or value == '':
+        return None
+    try:
+        return str(Decimal(value).quantize(Decimal('0.01')))
+    except InvalidOperation:
+        return value
+
+def _value(node, name):
+    node = getattr(node, name, None)
+    return node.value if node is not None else None
+
+class Mismatch(object):
+    '''
+    A difference between the ledger and FPS.
+
+        .. py:attribute:: kind
+
+            :py:data:`MISSING_IN_FPS`, :py:data:`MISSING_IN_LEDGER`, :py:data:`AMOUNT_DIFFERS` or
+            :py:data:`STATUS_DIFFERS`.
+
+        .. py:attribute:: ledger
+
+            ``(caller_reference, transaction_id, amount, status, operation)`` from the ledger, None when missing.
+
+        .. py:attribute:: fps
+
+            ``(transaction_id, caller_reference, amount, status, operation, date_received)`` from FPS, None
+            when missing.
+    '''
+
+    def __init__(self, kind, ledger, fps):
+        self.kind = kind
+        self.ledger = ledger
+        self.fps = fps
+
+    @property
+    def caller_reference(self):
+        return self.ledger[0] if self.ledger is not None else self.fps[1]
+
+    @property
+    def operation(self):
+        return self.ledger[4] if self.ledger is not None else self.fps[4]
+
+    @property
+    def transaction_id(self):
+        return self.fps[0] if self.fps is not None else self.ledger[1]
+
+    def __repr__(self):
+        return '<Mismatch {0} {1} {2}>'.format(self.kind, self.caller_reference, self.transaction_id)
+
+class Reconciler(object):
+    '''
+    Matches FPS account activity against your order ledger under bounded memory. Both sides are streamed
+    into a sqlite database, matched there, and the mismatches are streamed back out::
+
+        rec = Reconciler('/var/tmp/recon-2013-08.db')
+        with open('orders-2013-08.csv') as f:
+            rec.load_ledger(f)
+        rec.load_activity(flex_pay, datetime(2013, 8, 1), datetime(2013, 9, 1), operation='Pay')
+        with open('mismatches.csv', 'wb') as f:
+            rec.write_report(f)
+
+    Loading commits and checkpoints every ``commit_every`` records. Run the same steps again on the same
+    database after a crash and each load continues from its checkpoint.
+
+    A ledger row matches the FPS transaction with its transaction id when it has one, otherwise the
+    transaction with its caller reference and operation. FPS keeps caller references apart per operation, so a
+    Pay and its Refund may share one.
+
+        :param path: The sqlite database, ``':memory:'`` for a throwaway one.
+
+        :param status_map: Maps the statuses used in the ledger to FPS's, for example ``{'paid': 'Success'}``.
+            Unmapped statuses are compared as they are.
+
+        :param commit_every: Records loaded between commits.
+    '''
+
+    def __init__(self, path, status_map=None, commit_every=10000):
+        self.path = path
+        self.status_map = status_map or {}
+        self.commit_every = commit_every
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.executescript(_SCHEMA)
+
+    def get_checkpoint(self, name):
+        row = self.db.execute('SELECT value FROM checkpoint WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_checkpoint(self, name, value):
+        self.db.execute('INSERT OR REPLACE INTO checkpoint (name, value) VALUES (?, ?)', (name, value))
+
+    def load_ledger(self,
+                    f,
+                    caller_reference='caller_reference',
+                    transaction_id='transaction_id',
+                    amount='amount',
+                    status='status',
+                    operation='operation',
+                    name='ledger'):
+        '''
+        Loads the CSV ledger in the file f. The arguments name its columns, only caller_reference is required.
+        The operation is FPS's, ``Pay`` or ``Refund`` for example, rows without one are Pays. Rows loaded by an
+        earlier, interrupted run are skipped. Returns the number of rows loaded.
+        '''
+        skip = int(self.get_checkpoint(name) or 0)
+        status_map = self.status_map
+        rows = 0
+        batch = []
+        for row in csv.DictReader(f):
+            rows += 1
+            if rows <= skip:
+                continue
+            s = row.get(status) or None
+            batch.append((row[caller_reference],
+                          row.get(transaction_id) or None,
+                          _amount(row.get(amount)),
+                          status_map.get(s, s),
+                          row.get(operation) or 'Pay'))
+            if len(batch) >= self.commit_every:
+                self._insert_ledger(batch, name, rows)
+                batch = []
+        self._insert_ledger(batch, name, rows)
+        return rows - skip
+
+    def _insert_ledger(self, batch, name, rows):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO ledger VALUES (?, ?, ?, ?, ?)', batch)
+            self.set_checkpoint(name, str(rows))
+
+    def load_activity(self, client, start_date, end_date=None, operation=None, role=None, name='activity'):
+        '''
+        Streams the account activity between start_date and end_date from client, a
+        :py:class:`flexpay.payment.FlexPay`, into the database. After an interrupted run it continues from the
+        last checkpoint. Returns the number of transactions loaded.
+        '''
+        resume = self.get_checkpoint(name)
+        if resume is not None:
+            start_date = resume
+        count = 0
+        batch = []
+        last = None
+        for txn in client.iter_account_activity(start_date, end_date, operation=operation, role=role):
+            amount = getattr(txn, 'TransactionAmount', None)
+            last = _value(txn, 'DateReceived')
+            batch.append((_value(txn, 'TransactionId'),
+                          _value(txn, 'CallerReference') or None,
+                          _amount(_value(amount, 'Value')) if amount is not None else None,
+                          _value(txn, 'TransactionStatus'),
+                          _value(txn, 'FPSOperation'),
+                          last))
+            count += 1
+            if len(batch) >= self.commit_every:
+                self._insert_activity(batch, name, last)
+                batch = []
+        self._insert_activity(batch, name, last)
+        return count
+
+    def _insert_activity(self, batch, name, last):
+        # Resuming from the date of the last transaction may fetch some of them again, they replace themselves.
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO activity VALUES (?, ?, ?, ?, ?, ?)', batch)
+            if last is not None:
+                self.set_checkpoint(name, last)
+
+    def _matched(self):
+        # Every ledger row with the FPS transaction it matches, or Nones.
+        return self.db.execute('''
+            SELECT l.caller_reference, l.transaction_id, l.amount, l.status, l.operation,
+                   a.transaction_id, a.caller_reference, a.amount, a.status, a.operation, a.date_received
+            FROM ledger l LEFT JOIN activity a ON a.transaction_id = l.transaction_id
+            WHERE l.transaction_id IS NOT NULL
+            UNION ALL
+            SELECT l.caller_reference, l.transaction_id, l.amount, l.status, l.operation,
+                   a.transaction_id, a.caller_reference, a.amount, a.status, a.operation, a.date_received
+            FROM ledger l LEFT JOIN activity a ON a.caller_reference = l.caller_reference
+                                              AND a.operation = l.operation
+            WHERE l.transaction_id IS NULL''')
+
+    def mismatches(self):
+        '''
+        Yields every :py:class:`Mismatch`. Only one row is held in memory at a time.
+        '''
+        for row in self._matched():
+            ledger, fps = row[:5], row[5:]
+            if fps[0] is None:
+                yield Mismatch(MISSING_IN_FPS, ledger, None)
+                continue
+            if ledger[2] is not None and ledger[2] != fps[2]:
+                yield Mismatch(AMOUNT_DIFFERS, ledger, fps)
+            if ledger[3] is not None and ledger[3] != fps[3]:
+                yield Mismatch(STATUS_DIFFERS, ledger, fps)
+
+        for row in self.db.execute('''
+            SELECT * FROM activity a
+            WHERE NOT EXISTS (SELECT 1 FROM ledger l WHERE l.transaction_id = a.transaction_id)
+              AND NOT EXISTS (SELECT 1 FROM ledger l WHERE l.caller_reference = a.caller_reference
+                                                      AND l.operation = a.operation
+                                                      AND l.transaction_id IS NULL)'''):
+            yield Mismatch(MISSING_IN_LEDGER, None, row)
+
+    def summary(self):
+        '''
+        Returns the number of mismatches of each kind.
+        '''
+        counts = dict.fromkeys([MISSING_IN_FPS, MISSING_IN_LEDGER, AMOUNT_DIFFERS, STATUS_DIFFERS], 0)
+        for m in self.mismatches():
+            counts[m.kind] += 1
+        return counts
+
+    def write_report(self, f):
+        '''
+        Writes the mismatches to the file f as CSV. Returns how many were written.
+        '''
+        writer = csv.writer(f)
+        writer.writerow(['kind', 'caller_reference', 'operation', 'transaction_id', 'ledger_amount', 'fps_amount',
+                         'ledger_status', 'fps_status'])
+        count = 0
+        for m in self.mismatches():
+            ledger = m.ledger or (None,) * 5
+            fps = m.fps or (None,) * 6
+            writer.writerow([m.kind, m.caller_reference, m.operation, m.transaction_id, ledger[2], fps[2], ledger[3],
+                             fps[3]])
+            count += 1
+        return count
+
+    def reset(self):
+        '''
+        Empties the database for a new run.
+        '''
+        with self.db:
+            self.db.execute('DELETE FROM ledger')
+            self.db.execute('DELETE FROM activity')
+            self.db.execute('DELETE FROM checkpoint')
+
+    def close(self):
+        self.db.close()
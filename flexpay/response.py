@@ -1,21 +1,73 @@
 import xml.sax
 
-__all__ = ["Response"]
+__all__ = ["Response", "make_response", "make_response_from_stream"]
+
+# Classes used for the ``<Action>Result`` element of a response, keyed by element name.
+# Filled in by flexpay.results, any other Result element becomes a plain Response.
+RESULT_CLASSES = {}
 
 class Response(object):
-    def __init__(self, name, parent):
-        self._parent = parent
+    '''
+    A node of an FPS response. Child elements are available as attributes, for example ``resp.TransactionId``.
+    
+    Responses use ``__slots__`` and keep no reference to their parent, so a response tree is small and
+    free of reference cycles.
+    '''
+    __slots__ = ('_name', '_value', '_attrs', '_repeated')
+    
+    def __init__(self, name, parent=None):
         self._name = name
         self._value = ''
-        self._children = []
+        self._attrs = None
+        self._repeated = None
         
     def add_attribute(self, name, o):
         if isinstance(o, str) or\
            isinstance(o, unicode):
             o = o.strip()   
-        elif isinstance(o, Response):
-            self._children.append(o)
-        setattr(self, name, o)
+        if self._attrs is None:
+            self._attrs = {}
+        elif name in self._attrs:
+            # Repeated elements, such as each Transaction in a listing. The attribute is the last one,
+            # getlist returns all of them.
+            if self._repeated is None:
+                self._repeated = {}
+            self._repeated.setdefault(name, [self._attrs[name]]).append(o)
+        self._attrs[name] = o
+    
+    def getlist(self, name):
+        '''
+        Returns every child element called name, in document order.
+        '''
+        if self._repeated is not None and name in self._repeated:
+            return list(self._repeated[name])
+        if self._attrs is not None and name in self._attrs:
+            return [self._attrs[name]]
+        return []
+    
+    def __getattr__(self, name):
+        # Only called when the name isn't a slot or method. Private names are never elements, checking
+        # them here also keeps copy and pickle from recursing on an instance whose slots aren't set yet.
+        if name[0] != '_' and self._attrs is not None:
+            try:
+                return self._attrs[name]
+            except KeyError:
+                pass
+        raise AttributeError(name)
+    
+    def __getstate__(self):
+        # Slots have no __dict__ for pickle to copy, without these protocols 0 and 1 restore an empty node.
+        return (self._name, self._value, self._attrs, self._repeated)
+    
+    def __setstate__(self, state):
+        self._name, self._value, self._attrs, self._repeated = state
+    
+    def __dir__(self):
+        return sorted(set(dir(type(self))) | set(self._attrs or ()))
+    
+    def has_children(self):
+        return self._attrs is not None and\
+               any(isinstance(o, Response) for o in self._attrs.itervalues())
     
     def set_value(self, v):
         self._value = v.strip()
@@ -30,7 +82,7 @@ class Response(object):
         
     def __str__(self):
         v = ''
-        if (not len(self._children)) and self._value:
+        if (not self.has_children()) and self._value:
             return str(self._value)
         return self._name + v
         
@@ -38,20 +90,26 @@ class Handler(xml.sax.ContentHandler):
     def __init__(self, method):
         self.root_obj = None
         self.method_result = method + 'Result'
-        self._text = ''
+        self._text = []
+        self._stack = []
         self.resp = None
         self.request_id = None
     
     def push_layer(self, name):
-        o = Response(name, self.root_obj)
+        if name == self.method_result:
+            o = RESULT_CLASSES.get(name, Response)(name)
+        else:
+            o = Response(name)
         if self.root_obj:
             self.root_obj.add_attribute(name, o)            
+        self._stack.append(o)
         self.root_obj = o
     
     def pop_layer(self):
         if self.root_obj:
-            self.root_obj.set_value(self._text)
-            self.root_obj = self.root_obj._parent
+            self.root_obj.set_value(''.join(self._text))
+            self._stack.pop()
+            self.root_obj = self._stack[-1] if self._stack else None
         
     def startElement(self, name, attrs):            
         if name == self.method_result or self.root_obj != None:
@@ -59,19 +117,45 @@ class Handler(xml.sax.ContentHandler):
     
     def endElement(self, name):
         if name == 'RequestId':
-            self.resp.add_attribute('RequestId', self._text)
+            self.resp.add_attribute('RequestId', ''.join(self._text))
         if self.root_obj != None:
             if name == self.method_result:
                 self.resp = self.root_obj
             self.pop_layer()
-        self._text = ''
+        self._text = []
         
     def characters(self, content):
-        self._text += content
+        self._text.append(content)
 
-def make_response(x, method):
+def make_response(x, method, keep_text=True):
+    '''
+    Parses the response XML in x. When keep_text is False the XML isn't kept as ``ResponseText``.
+    '''
     h = Handler(method)
     xml.sax.parseString(x, h)
     resp = h.resp
-    resp.add_attribute('ResponseText', x)
+    if keep_text:
+        resp.add_attribute('ResponseText', x)
     return resp
+
+def make_response_from_stream(fp, method, chunk_size=16384, keep_text=True):
+    '''
+    Parses the response read from fp, a file like object such as an HTTP response.
+
+    When keep_text is False the XML isn't kept as ``ResponseText``, the response is parsed incrementally as it's
+    read and no copy of the whole body is made. When keep_text is True the whole body is kept anyway, so it's
+    read first and handed to :py:func:`make_response`, parsing one string is a little faster than feeding the
+    parser chunk by chunk.
+    '''
+    if keep_text:
+        return make_response(fp.read(), method)
+    h = Handler(method)
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(h)
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        parser.feed(chunk)
+    parser.close()
+    return h.resp
@@ -0,0 +1,164 @@
+import re
+from datetime import datetime, timedelta
+from decimal import Decimal
+from flexpay.response import Response, RESULT_CLASSES
+from flexpay.utils import make_enum
+
+__all__ = ["TransactionStatus", "TokenStatus", "VerificationStatus", "Result", "parse_timestamp", "SCHEMA"]
+
+TransactionStatus = make_enum(
+                        str,
+                        Cancelled='Cancelled',
+                        Failure='Failure',
+                        Pending='Pending',
+                        Reserved='Reserved',
+                        Success='Success')
+'''
+Status of a transaction.
+
+    See Also: http://docs.aws.amazon.com/AmazonFPS/latest/FPSAPIReference/TransactionStatus.html
+'''
+
+TokenStatus = make_enum(
+                str,
+                Active='Active',
+                Inactive='Inactive')
+'''
+Status of a payment token.
+'''
+
+VerificationStatus = make_enum(
+                        str,
+                        Success='Success',
+                        Failure='Failure')
+'''
+Result of :py:meth:`flexpay.payment.FlexPay.verify_signature`.
+'''
+
+_timestamp_re = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?(Z|[+-]\d\d:?\d\d)?$')
+
+def parse_timestamp(value):
+    '''
+    Converts an FPS timestamp such as ``2013-08-16T16:57:08.843-07:00`` into a naive datetime in UTC.
+    '''
+    m = _timestamp_re.match(value)
+    if m is None:
+        raise ValueError('Invalid timestamp {0}.'.format(value))
+    year, month, day, hour, minute, second, fraction, zone = m.groups()
+    microsecond = int((fraction or '0')[:6].ljust(6, '0'))
+    dt = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond)
+    if zone and zone != 'Z':
+        offset = timedelta(hours=int(zone[1:3]), minutes=int(zone[-2:]))
+        if zone[0] == '+':
+            dt -= offset
+        else:
+            dt += offset
+    return dt
+
+def _enum(enum):
+    def convert(value):
+        try:
+            return enum.reverse_lookup(str(value))
+        except TypeError:
+            # A value FPS added after this table was written, leave it as a string.
+            return value
+    return convert
+
+_transaction = (
+    ('transaction_id', 'TransactionId', str),
+    ('transaction_status', 'TransactionStatus', _enum(TransactionStatus)),
+)
+
+SCHEMA = {
+    'Pay': _transaction,
+    'Reserve': _transaction,
+    'Settle': _transaction,
+    'Refund': _transaction,
+    'Cancel': _transaction,
+    'GetTransactionStatus': _transaction + (
+        ('caller_reference', 'CallerReference', str),
+        ('status_code', 'StatusCode', str),
+        ('status_message', 'StatusMessage', unicode),
+    ),
+    'GetAccountBalance': (
+        ('total_balance', 'AccountBalance.TotalBalance.Value', Decimal),
+        ('pending_in_balance', 'AccountBalance.PendingInBalance.Value', Decimal),
+        ('pending_out_balance', 'AccountBalance.PendingOutBalance.Value', Decimal),
+        ('disbursable_balance', 'AccountBalance.AvailableBalances.DisbursableBalance.Value', Decimal),
+        ('refundable_balance', 'AccountBalance.AvailableBalances.RefundableBalance.Value', Decimal),
+    ),
+    'GetTokenByCaller': (
+        ('token_id', 'Token.TokenId', str),
+        ('token_status', 'Token.TokenStatus', _enum(TokenStatus)),
+        ('token_type', 'Token.TokenType', str),
+        ('caller_reference', 'Token.CallerReference', str),
+        ('date_installed', 'Token.DateInstalled', parse_timestamp),
+    ),
+    'GetAccountActivity': (
+        ('batch_size', 'BatchSize', int),
+        ('next_starting_date', 'NextStartingDate', parse_timestamp),
+    ),
+    'VerifySignature': (
+        ('verification_status', 'VerificationStatus', _enum(VerificationStatus)),
+    ),
+}
+'''
+Typed fields for each Action: ``(attribute, element path, converter)``. Elements not listed here stay plain
+:py:class:`flexpay.response.Response` attributes and are never converted.
+'''
+
+class Result(Response):
+    '''
+    Base class of the typed results. Typed fields are converted the first time they're read and then cached.
+    The untyped elements are still available as attributes, just like :py:class:`flexpay.response.Response`.
+    '''
+    __slots__ = ('_typed',)
+
+    def __init__(self, name, parent=None):
+        Response.__init__(self, name)
+        self._typed = None
+
+    def __setstate__(self, state):
+        # The typed values aren't pickled, they're converted again when read.
+        Response.__setstate__(self, state)
+        self._typed = None
+
+def _lookup(node, path):
+    for name in path:
+        node = getattr(node, name, None)
+        if node is None:
+            return None
+    if isinstance(node, Response):
+        node = node.value
+    return node
+
+def _field(attr, path, convert):
+    path = tuple(path.split('.'))
+
+    def get(self):
+        typed = self._typed
+        if typed is None:
+            typed = self._typed = {}
+        elif attr in typed:
+            return typed[attr]
+        value = _lookup(self, path)
+        if value:
+            value = convert(value)
+        else:
+            value = None
+        typed[attr] = value
+        return value
+
+    return property(get, doc='Typed value of ``{0}``, None when the element is missing.'.format('.'.join(path)))
+
+def _make_result_class(action, fields):
+    attrs = {'__slots__': (), '__doc__': 'Typed result of the {0} Action.'.format(action)}
+    for attr, path, convert in fields:
+        attrs[attr] = _field(attr, path, convert)
+    return type(action + 'Result', (Result,), attrs)
+
+for _action, _fields in SCHEMA.iteritems():
+    _cls = _make_result_class(_action, _fields)
+    globals()[_cls.__name__] = _cls
+    __all__.append(_cls.__name__)
+    RESULT_CLASSES[_cls.__name__] = _cls
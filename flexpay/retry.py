@@ -0,0 +1,179 @@
+import errno
+import httplib
+import random
+import socket
+import sys
+import threading
+import time
+from Queue import Queue, Empty
+from flexpay.exceptions import RestAPIException
+
+__all__ = ["RetryPolicy", "HedgePolicy", "RETRYABLE_CODES", "IDEMPOTENT_ACTIONS", "READ_ACTIONS", "call_with_retry"]
+
+RETRYABLE_CODES = frozenset(['RequestThrottled', 'InternalError', 'ServiceUnavailable'])
+'''
+FPS error codes that are worth retrying.
+'''
+
+READ_ACTIONS = frozenset(['GetAccountActivity',
+                          'GetAccountBalance',
+                          'GetTokenByCaller',
+                          'GetTokens',
+                          'GetTransactionStatus',
+                          'VerifySignature'])
+'''
+Actions that only read.
+'''
+
+IDEMPOTENT_ACTIONS = READ_ACTIONS | frozenset(['Pay', 'Reserve', 'Refund'])
+'''
+Actions that are safe to send again: the reads, plus the Actions FPS de-duplicates by ``CallerReference``.
+Settle and Cancel are left out, a retried Settle or Cancel that already went through comes back as an error.
+'''
+
+def _maybe_sent(error):
+    # FPS answered with an error, or the connection was never made: either way it didn't act on the request.
+    if isinstance(error, RestAPIException):
+        return error.code is None
+    if isinstance(error, socket.gaierror):
+        return False
+    return not (isinstance(error, socket.error) and error.errno == errno.ECONNREFUSED)
+
+class RetryPolicy(object):
+    '''
+    Retries transient failures with jittered exponential backoff.
+
+    Every attempt is signed again, so it gets a fresh ``Timestamp``, while the parameters built by the API method,
+    including ``CallerReference``, stay the same.
+
+    Reads are retried after any transient failure. Pay, Reserve and Refund are only retried when FPS answered with
+    a retryable error code or the connection was refused, so they're never sent again once they may have reached
+    FPS without an answer coming back, after a timeout or a reset connection for example. Whether such a call went
+    through is for the caller to find out, with :py:meth:`flexpay.payment.FlexPay.get_transaction_status` or a
+    :py:class:`flexpay.journal.Journal`.
+
+        :param max_attempts: Total number of attempts, including the first.
+
+        :param base_delay: Backoff before the first retry in seconds. It doubles with every retry.
+
+        :param max_delay: Upper bound of the backoff in seconds.
+
+        :param actions: Actions that may be retried.
+
+        :param codes: FPS error codes that may be retried.
+
+        :param statuses: HTTP statuses that may be retried when the body has no error code. Only reads are retried
+            on these, the error may come from a proxy that already passed the request on.
+    '''
+
+    def __init__(self,
+                 max_attempts=4,
+                 base_delay=0.1,
+                 max_delay=5.0,
+                 actions=IDEMPOTENT_ACTIONS,
+                 codes=RETRYABLE_CODES,
+                 statuses=(500, 502, 503, 504),
+                 sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.actions = actions
+        self.codes = codes
+        self.statuses = statuses
+        self.sleep = sleep
+        self.random = random.Random()
+
+    def is_retryable(self, error):
+        if isinstance(error, RestAPIException):
+            code = error.code
+            if code is not None:
+                return code in self.codes
+            return error.status in self.statuses
+        # The request never got an answer: refused or reset connections, timeouts, malformed responses.
+        return isinstance(error, (socket.error, httplib.HTTPException))
+
+    def should_retry(self, action, error, attempt):
+        '''
+        Returns True if the failed attempt number attempt (starting at 0) should be retried.
+        '''
+        if attempt + 1 >= self.max_attempts or action not in self.actions or not self.is_retryable(error):
+            return False
+        return action in READ_ACTIONS or not _maybe_sent(error)
+
+    def backoff(self, attempt):
+        '''
+        "Full jitter" backoff: a random delay between 0 and the exponential bound.
+        '''
+        return self.random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+class HedgePolicy(object):
+    '''
+    Sends a second copy of a read when the first hasn't answered within ``delay`` seconds, and returns
+    whichever answers first. Trades a little extra load for a shorter tail.
+
+        :param delay: Seconds to wait before hedging, typically around the p95 latency.
+
+        :param actions: Actions that may be hedged, all of :py:data:`READ_ACTIONS` by default. Only reads can be
+            hedged, a hedged Pay would be in flight twice.
+    '''
+
+    def __init__(self, delay=0.1, actions=READ_ACTIONS):
+        writes = set(actions) - READ_ACTIONS
+        if writes:
+            raise ValueError('Only reads can be hedged, not {0}.'.format(', '.join(sorted(writes))))
+        self.delay = delay
+        self.actions = actions
+
+def hedged_send(client, params, delay):
+    results = Queue()
+
+    def attempt():
+        try:
+            results.put((True, client.send_request(dict(params))))
+        except Exception:
+            results.put((False, sys.exc_info()))
+
+    def start():
+        t = threading.Thread(target=attempt)
+        t.daemon = True
+        t.start()
+
+    start()
+    try:
+        outcome = results.get(timeout=delay)
+        outstanding = 0
+    except Empty:
+        start()
+        outcome = results.get()
+        outstanding = 1
+
+    # Return the first success, or the last failure once every attempt has failed.
+    while not outcome[0] and outstanding:
+        outcome = results.get()
+        outstanding -= 1
+    ok, value = outcome
+    if ok:
+        return value
+    raise value[0], value[1], value[2]
+
+def call_with_retry(client, params):
+    '''
+    Sends params with the client's :py:class:`RetryPolicy` and :py:class:`HedgePolicy`.
+    '''
+    retry = client.retry
+    hedge = client.hedge
+    action = params['Action']
+    hedged = hedge is not None and action in hedge.actions
+    attempt = 0
+    while True:
+        try:
+            if hedged:
+                return hedged_send(client, params, hedge.delay)
+            return client.send_request(dict(params))
+        except Exception, error:
+            # Keep the traceback, checking the error parses its body which may replace the current exception.
+            exc_info = sys.exc_info()
+            if retry is None or not retry.should_retry(action, error, attempt):
+                raise exc_info[0], exc_info[1], exc_info[2]
+            retry.sleep(retry.backoff(attempt))
+            attempt += 1
@@ -0,0 +1,125 @@
+'''
+Compact serialization of responses, for passing them between processes or keeping them in a shared cache.
+
+A response tree is flattened into one tuple of names, values and child counts, in pre-order::
+
+    data = dumps(resp)                  # JSON
+    data = dumps(resp, 'msgpack')       # needs the msgpack package
+    resp = loads(data)
+
+The raw ``ResponseText`` is left out unless keep_text is True. Typed results come back as the same
+:py:mod:`flexpay.results` class, their fields are converted again on first use.
+
+``marshal`` and ``msgpack`` keep ``str`` and ``unicode`` apart. JSON has one string type, so every name and
+value comes back as ``unicode``. They compare equal to the parsed ones, which are ``unicode`` apart from a few
+ASCII ``str`` such as empty values. ``ResponseText`` is encoded back to the UTF-8 ``str`` it was read as.
+'''
+import json
+import marshal
+from itertools import islice
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from flexpay.response import Response, RESULT_CLASSES
+
+__all__ = ["to_tuple", "from_tuple", "dumps", "loads", "FORMATS"]
+
+# Child count of an attribute that's a plain string rather than a Response, such as RequestId.
+_STRING = -1
+
+def _flatten(node, out, keep_text):
+    attrs = node._attrs
+    if not attrs:
+        out.append(0)
+        return
+    repeated = node._repeated or {}
+    children = []
+    for name, child in attrs.iteritems():
+        if name == 'ResponseText' and not keep_text:
+            continue
+        children.extend((name, c) for c in repeated.get(name, (child,)))
+    out.append(len(children))
+    for name, child in children:
+        if isinstance(child, Response):
+            out.append(name)
+            out.append(child._value)
+            _flatten(child, out, keep_text)
+        else:
+            out.append(name)
+            out.append(child)
+            out.append(_STRING)
+
+def to_tuple(resp, keep_text=False):
+    '''
+    Flattens resp into a tuple of strings and integers: each node is its name, value and number of children,
+    followed by its children.
+    '''
+    out = [resp._name, resp._value]
+    _flatten(resp, out, keep_text)
+    return tuple(out)
+
+def _add(node, name, child):
+    # Response.add_attribute without the strip, the values were stripped when the response was parsed.
+    attrs = node._attrs
+    if attrs is None:
+        attrs = node._attrs = {}
+    elif name in attrs:
+        if node._repeated is None:
+            node._repeated = {}
+        node._repeated.setdefault(name, [attrs[name]]).append(child)
+    attrs[name] = child
+
+def _build(node, count, items):
+    for i in xrange(count):
+        name = next(items)
+        value = next(items)
+        n = next(items)
+        if n == _STRING:
+            if name == 'ResponseText' and isinstance(value, unicode):
+                value = value.encode('utf-8')
+            _add(node, name, value)
+        else:
+            child = Response(name)
+            child._value = value
+            if n:
+                _build(child, n, items)
+            _add(node, name, child)
+
+def from_tuple(data):
+    '''
+    Rebuilds the response flattened by :py:func:`to_tuple`.
+    '''
+    name = data[0]
+    root = RESULT_CLASSES.get(name, Response)(name)
+    root._value = data[1]
+    _build(root, data[2], islice(data, 3, None))
+    return root
+
+def _msgpack_dumps(data):
+    if msgpack is None:
+        raise ImportError('The msgpack format requires the msgpack package.')
+    return msgpack.packb(data, use_bin_type=True)
+
+def _msgpack_loads(data):
+    if msgpack is None:
+        raise ImportError('The msgpack format requires the msgpack package.')
+    return msgpack.unpackb(data, raw=False)
+
+FORMATS = {
+    'json': (lambda data: json.dumps(data, separators=(',', ':')), json.loads),
+    'marshal': (marshal.dumps, marshal.loads),
+    'msgpack': (_msgpack_dumps, _msgpack_loads),
+}
+'''
+The formats :py:func:`dumps` and :py:func:`loads` support, as ``(dumps, loads)`` pairs. ``marshal`` is the
+fastest but only readable by the same Python version, ``msgpack`` needs the msgpack package.
+'''
+
+def dumps(resp, format='json', keep_text=False):
+    return FORMATS[format][0](to_tuple(resp, keep_text))
+
+def loads(data, format='json'):
+    return from_tuple(FORMATS[format][1](data))
@@ -0,0 +1,101 @@
+import base64
+import hmac
+from hashlib import sha256
+from urlparse import urlparse
+from flexpay.utils import signature_quote
+
+__all__ = ["Signer", "RequestTemplate", "string_to_sign"]
+
+def string_to_sign(params, url, http_method='GET'):
+    '''
+    The canonical string that signature version 2 signs: the HTTP method, host and path of url,
+    followed by the sorted and quoted parameters.
+    '''
+    up = urlparse(url)
+
+    qs = http_method + '\n'
+    qs += up.netloc + '\n'
+    qs += up.path + '\n'
+
+    qs += '&'.join(signature_quote(i[0]) + '=' + signature_quote(i[1]) for i in sorted(params.items()))
+    return qs
+
+class Signer(object):
+    '''
+    HMAC signer for one secret key. The keyed HMAC state is built once and copied for each signature.
+    '''
+
+    def __init__(self, secret_key, digestmod=sha256):
+        self._hmac = hmac.new(secret_key, digestmod=digestmod)
+
+    def sign(self, string_to_sign):
+        h = self._hmac.copy()
+        h.update(string_to_sign)
+        return base64.b64encode(h.digest())
+
+class RequestTemplate(object):
+    '''
+    A precompiled request for one API Action.
+
+    The parameters that are the same on every call (access key, signature method and version, Action, ...) are
+    quoted and sorted once, as is the host and path part of the string to sign. Signing a request then only
+    quotes the parameters that vary and merges them in. The signature is byte for byte the one
+    :py:meth:`flexpay.payment.FlexPay.make_signature` produces.
+
+        :param signer: The :py:class:`Signer` for the caller's secret key.
+
+        :param url: The endpoint the request is sent to.
+
+        :param static_params: The parameters shared by every request made from this template.
+    '''
+
+    def __init__(self, signer, url, static_params):
+        self.signer = signer
+        self.url = url
+        up = urlparse(url)
+        self.prefix = 'GET\n' + up.netloc + '\n' + up.path + '\n'
+        self.static_params = dict(static_params)
+        self._static_pairs = sorted((k, signature_quote(k) + '=' + signature_quote(v))
+                                    for k, v in self.static_params.iteritems())
+        self._quoted_keys = {}
+
+    def quote_key(self, key):
+        q = self._quoted_keys.get(key)
+        if q is None:
+            q = self._quoted_keys[key] = signature_quote(key) + '='
+        return q
+
+    def string_to_sign(self, params):
+        static = self.static_params
+        pairs = []
+        matched = 0
+        for k, v in params.iteritems():
+            if k == 'Signature':
+                continue
+            if k in static and static[k] == v:
+                matched += 1
+                continue
+            pairs.append((k, self.quote_key(k) + signature_quote(v)))
+
+        if matched == len(static):
+            pairs.extend(self._static_pairs)
+        else:
+            # Some of the static parameters are missing, only include the ones that were passed in.
+            pairs.extend(p for p in self._static_pairs if p[0] in params and params[p[0]] == static[p[0]])
+        pairs.sort()
+        return self.prefix + '&'.join(p[1] for p in pairs)
+
+    def sign(self, params):
+        '''
+        Returns the signature for params, which must include the static parameters.
+        '''
+        return self.signer.sign(self.string_to_sign(params))
+
+    def sign_fields(self, fields):
+        '''
+        Returns the signature for the static parameters plus fields. Fields must not repeat a static parameter.
+        '''
+        pairs = [(k, self.quote_key(k) + signature_quote(v)) for k, v in fields.iteritems()]
+        pairs.extend(self._static_pairs)
+        pairs.sort()
+        return self.signer.sign(self.prefix + '&'.join(p[1] for p in pairs))
@@ -0,0 +1,517 @@
+'''
+A local stand-in for the FPS REST endpoint, for load testing and offline development.
+
+The stand-in answers the Actions :py:class:`flexpay.payment.FlexPay` sends with realistic XML, checks
+signatures with the same canonicalization the client signs with, and can add latency, throttling and
+server errors::
+
+    from flexpay.standin import StandInServer, lognormal
+
+    with StandInServer(keys={PUB_KEY: SECRET_KEY}, latency=lognormal(0.08, 0.5), throttle_rate=0.01) as server:
+        flex_pay = FlexPay(PUB_KEY, SECRET_KEY, api=server.api)
+        flex_pay.pay(order_id, sender_token, '10.00')
+'''
+import BaseHTTPServer
+import SocketServer
+import base64
+import hmac
+import math
+import random
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from hashlib import sha1, sha256
+from urlparse import urlsplit, parse_qsl
+from xml.sax.saxutils import escape
+from flexpay.results import parse_timestamp
+from flexpay.signing import string_to_sign
+from flexpay.utils import make_enum
+
+__all__ = ["StandInServer", "fixed", "uniform", "lognormal", "exponential", "SANDBOX_AMOUNT_ERRORS"]
+
+NAMESPACE = 'http://fps.amazonaws.com/doc/2010-08-28/'
+
+def fixed(seconds):
+    '''
+    Latency of exactly ``seconds``.
+    '''
+    return lambda rng: seconds
+
+def uniform(low, high):
+    '''
+    Latency spread evenly between low and high seconds.
+    '''
+    return lambda rng: rng.uniform(low, high)
+
+def lognormal(median, sigma):
+    '''
+    Log-normally distributed latency, the long tail typical of a remote service.
+    '''
+    mu = math.log(median)
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+def exponential(mean):
+    '''
+    Exponentially distributed latency with the given mean.
+    '''
+    return lambda rng: rng.expovariate(1.0 / mean)
+
+SANDBOX_AMOUNT_ERRORS = {
+    60: (400, 'InsufficientBalance', 'The sender does not have sufficient balance.'),
+    61: (400, 'AmountOutOfRange', 'The transaction amount is more than the allowed range.'),
+    62: (400, 'TokenNotActive_Sender', 'The sender token is not active.'),
+    63: (400, 'InvalidTokenId_Sender', 'The sender token is invalid.'),
+    64: (400, 'PaymentMethodNotDefined', 'Payment method is not defined in the transaction.'),
+    65: (400, 'TransactionDenied', 'This transaction is not allowed.'),
+    66: (400, 'InvalidAccountState_Sender', 'The sender account is not in an active state.'),
+    67: (500, 'InternalError', 'A retriable error that happens within FPS.'),
+    68: (400, 'AccountLimitsExceeded', 'The spending or receiving limit on the account is exceeded.'),
+    69: (503, 'ServiceUnavailable', 'The service is temporarily unavailable.'),
+}
+'''
+Request errors simulated from the cents of an amount, like the FPS sandbox does with amounts between .60 and .89.
+Amounts from .70 to .89 are accepted but the transaction ends in Failure.
+'''
+
+_FAILURE_CENTS = range(70, 90)
+
+class FPSError(Exception):
+    def __init__(self, status, code, message):
+        Exception.__init__(self, status, code, message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+def _element(name, value):
+    return '<{0}>{1}</{0}>'.format(name, escape(unicode(value).encode('utf-8')))
+
+def _amount(name, value, currency='USD'):
+    return '<{0}><CurrencyCode>{1}</CurrencyCode><Value>{2}</Value></{0}>'.format(name, currency, value)
+
+def _timestamp(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+class _Transaction(object):
+    def __init__(self, action, amount, caller_reference, sender_token, final_status, status_code, resolve_at):
+        self.id = uuid.uuid4().hex.upper()[:35]
+        self.action = action
+        self.amount = amount
+        self.caller_reference = caller_reference
+        self.sender_token = sender_token
+        self.final_status = final_status
+        self.status_code = status_code
+        self.resolve_at = resolve_at
+        self.date_received = datetime.utcnow()
+        self.cancelled = False
+
+    def status(self, now):
+        if self.cancelled:
+            return 'Cancelled'
+        if now < self.resolve_at:
+            return 'Pending'
+        return self.final_status
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        status, body = self.server.standin.handle(parts.path, dict(parse_qsl(parts.query, True)), self.headers.get('Host', ''))
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, *args):
+        BaseHTTPServer.HTTPServer.__init__(self, *args)
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.connections_lock:
+            self.connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        # Keep-alive connections would otherwise hold their handler threads open after shutdown.
+        with self.connections_lock:
+            connections = list(self.connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+class StandInServer(object):
+    '''
+    A local FPS stand-in.
+
+        :param keys: A dict of AWS public key to secret key. Requests signed with any other key, or with a bad
+            signature, are rejected. None accepts every request unchecked.
+
+        :param host: Interface to listen on.
+
+        :param port: Port to listen on, 0 picks a free one.
+
+        :param latency: Called with a ``random.Random`` for the delay of each request in seconds.
+            See :py:func:`fixed`, :py:func:`uniform`, :py:func:`lognormal` and :py:func:`exponential`.
+
+        :param throttle_rate: Fraction of requests answered with 503 RequestThrottled.
+
+        :param rate_limit: Requests per second accepted, like FPS's per account limit. Requests over it are
+            answered with 503 RequestThrottled. None accepts any rate.
+
+        :param unavailable_rate: Fraction of requests answered with 503 ServiceUnavailable.
+
+        :param error_rate: Fraction of requests answered with 500 InternalError.
+
+        :param amount_errors: Request errors by the cents of the amount, see :py:data:`SANDBOX_AMOUNT_ERRORS`.
+
+        :param settle_delay: Seconds a transaction stays Pending before reaching its final status.
+
+        :param seed: Seed for the random number generator, for reproducible runs.
+    '''
+
+    def __init__(self,
+                 keys=None,
+                 host='127.0.0.1',
+                 port=0,
+                 latency=None,
+                 throttle_rate=0.0,
+                 rate_limit=None,
+                 unavailable_rate=0.0,
+                 error_rate=0.0,
+                 amount_errors=SANDBOX_AMOUNT_ERRORS,
+                 settle_delay=0.0,
+                 seed=None):
+        self.keys = keys
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self._allowance = rate_limit
+        self._allowance_updated = time.time()
+        self.unavailable_rate = unavailable_rate
+        self.error_rate = error_rate
+        self.amount_errors = amount_errors
+        self.settle_delay = settle_delay
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._transactions = {}
+        self._activity = []
+        self._references = {}
+        self._tokens = {}
+        self._actions = {
+            'Pay': self.do_pay,
+            'Reserve': self.do_reserve,
+            'Settle': self.do_settle,
+            'Refund': self.do_refund,
+            'Cancel': self.do_cancel,
+            'GetTransactionStatus': self.do_get_transaction_status,
+            'GetAccountBalance': self.do_get_account_balance,
+            'GetAccountActivity': self.do_get_account_activity,
+            'GetTokenByCaller': self.do_get_token_by_caller,
+            'GetTokens': self.do_get_tokens,
+            'CancelToken': self.do_cancel_token,
+            'VerifySignature': self.do_verify_signature,
+        }
+        self.httpd = _HTTPServer((host, port), _Handler)
+        self.httpd.standin = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{0}:{1}/'.format(host, port)
+
+    @property
+    def api(self):
+        '''
+        An API enum pointing at this server, pass it to :py:class:`flexpay.payment.FlexPay`.
+        '''
+        return make_enum(str, API_URL=self.url, CBUI_URL=self.url + 'cobranded-ui/actions/start')
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.close_connections()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def take_allowance(self):
+        # A token bucket holding up to one second of requests. Called with the lock held.
+        now = time.time()
+        self._allowance = min(self.rate_limit, self._allowance + (now - self._allowance_updated) * self.rate_limit)
+        self._allowance_updated = now
+        if self._allowance < 1:
+            return False
+        self._allowance -= 1
+        return True
+
+    def handle(self, path, params, host):
+        '''
+        Answers one request. Returns ``(http status, body)``.
+        '''
+        request_id = str(uuid.uuid4())
+        with self._lock:
+            self.requests += 1
+            delay = self.latency(self.random) if self.latency else 0
+            roll = self.random.random()
+            limited = self.rate_limit is not None and not self.take_allowance()
+        if delay > 0:
+            time.sleep(delay)
+
+        try:
+            if limited or roll < self.throttle_rate:
+                raise FPSError(503, 'RequestThrottled', 'The request rate is too high.')
+            roll -= self.throttle_rate
+            if roll < self.unavailable_rate:
+                raise FPSError(503, 'ServiceUnavailable', 'The service is temporarily unavailable.')
+            roll -= self.unavailable_rate
+            if roll < self.error_rate:
+                raise FPSError(500, 'InternalError', 'A retriable error that happens within FPS.')
+
+            self.check_signature(params, host, path)
+            action = params.get('Action')
+            handler = self._actions.get(action)
+            if handler is None:
+                raise FPSError(400, 'InvalidAction', 'Action {0} is not supported.'.format(action))
+            with self._lock:
+                result = handler(params)
+        except FPSError, error:
+            body = '<?xml version="1.0"?>\n<Response><Errors><Error>{0}{1}</Error></Errors>{2}</Response>'.format(
+                _element('Code', error.code),
+                _element('Message', error.message),
+                _element('RequestID', request_id))
+            return error.status, body
+
+        body = ('<?xml version="1.0"?>\n<{0}Response xmlns="{1}"><{0}Result>{2}</{0}Result>'
+                '<ResponseMetadata>{3}</ResponseMetadata></{0}Response>').format(action,
+                                                                                NAMESPACE,
+                                                                                result,
+                                                                                _element('RequestId', request_id))
+        return 200, body
+
+    def check_signature(self, params, host, path):
+        if self.keys is None:
+            params.pop('Signature', None)
+            return
+        secret = self.keys.get(params.get('AWSAccessKeyId'))
+        if secret is None:
+            raise FPSError(403, 'InvalidAccessKeyId', 'The AWS Access Key Id you provided does not exist.')
+        signature = params.pop('Signature', '')
+        digestmod = sha1 if params.get('SignatureMethod') == 'HmacSHA1' else sha256
+        expected = base64.b64encode(hmac.new(secret, string_to_sign(params, 'http://' + host + path), digestmod).digest())
+        if not hmac.compare_digest(signature, expected):
+            raise FPSError(403, 'SignatureDoesNotMatch', 'The request signature does not match.')
+
+    def require(self, params, *names):
+        for name in names:
+            if not params.get(name):
+                raise FPSError(400, 'MissingParameter', 'The request is missing required parameter {0}.'.format(name))
+
+    def parse_amount(self, params, name):
+        try:
+            amount = Decimal(params[name])
+        except (KeyError, InvalidOperation):
+            raise FPSError(400, 'InvalidParams', '{0} is not a valid amount.'.format(name))
+        cents = int((amount * 100) % 100)
+        if cents in self.amount_errors:
+            raise FPSError(*self.amount_errors[cents])
+        return amount, cents
+
+    def transaction(self, params, name='TransactionId'):
+        self.require(params, name)
+        txn = self._transactions.get(params[name])
+        if txn is None:
+            raise FPSError(400, 'InvalidTransactionId', 'The transaction {0} does not exist.'.format(params[name]))
+        return txn
+
+    def new_transaction(self, action, params, amount, cents, final_status):
+        reference = params.get('CallerReference')
+        if reference is not None:
+            # Same CallerReference, same transaction. This is what makes retrying Pay and Reserve safe.
+            existing = self._references.get((action, reference))
+            if existing is not None:
+                return existing
+        if cents in _FAILURE_CENTS:
+            final_status, status_code = 'Failure', 'PaymentMethodDeclined'
+        else:
+            status_code = 'Success'
+        txn = _Transaction(action,
+                           amount,
+                           reference,
+                           params.get('SenderTokenId'),
+                           final_status,
+                           status_code,
+                           time.time() + self.settle_delay)
+        # DateReceived has millisecond precision and NextStartingDate is the DateReceived of the first transaction
+        # of the next page, so each transaction gets a millisecond of its own or a page would repeat the end of the
+        # page before.
+        received = txn.date_received.replace(microsecond=txn.date_received.microsecond // 1000 * 1000)
+        if self._activity and received <= self._activity[-1].date_received:
+            received = self._activity[-1].date_received + timedelta(milliseconds=1)
+        txn.date_received = received
+        self._transactions[txn.id] = txn
+        self._activity.append(txn)
+        if reference is not None:
+            self._references[(action, reference)] = txn
+        if txn.sender_token:
+            self._tokens.setdefault(txn.sender_token, ['Active', reference])
+        return txn
+
+    def transaction_result(self, txn):
+        return _element('TransactionId', txn.id) + _element('TransactionStatus', txn.status(time.time()))
+
+    def do_pay(self, params):
+        self.require(params, 'CallerReference', 'SenderTokenId')
+        amount, cents = self.parse_amount(params, 'TransactionAmount.Value')
+        return self.transaction_result(self.new_transaction('Pay', params, amount, cents, 'Success'))
+
+    def do_reserve(self, params):
+        self.require(params, 'CallerReference', 'SenderTokenId')
+        amount, cents = self.parse_amount(params, 'TransactionAmount.Value')
+        return self.transaction_result(self.new_transaction('Reserve', params, amount, cents, 'Reserved'))
+
+    def do_settle(self, params):
+        reserved = self.transaction(params, 'ReserveTransactionId')
+        if reserved.status(time.time()) != 'Reserved':
+            raise FPSError(400, 'TransactionTypeNotRefundable', 'Only a Reserved transaction can be settled.')
+        if 'TransactionAmount.Value' in params:
+            amount, cents = self.parse_amount(params, 'TransactionAmount.Value')
+            if amount > reserved.amount:
+                raise FPSError(400, 'SettleAmountGreaterThanReserveAmount', 'The settle amount is more than the reserved amount.')
+        else:
+            amount, cents = reserved.amount, 0
+        return self.transaction_result(self.new_transaction('Settle', params, amount, cents, 'Success'))
+
+    def do_refund(self, params):
+        self.require(params, 'CallerReference')
+        original = self.transaction(params)
+        if 'RefundAmount.Value' in params:
+            amount, cents = self.parse_amount(params, 'RefundAmount.Value')
+            if amount > original.amount:
+                raise FPSError(400, 'RefundAmountExceeded', 'The refund amount is more than the refundable amount.')
+        else:
+            amount, cents = original.amount, 0
+        return self.transaction_result(self.new_transaction('Refund', params, -amount, cents, 'Success'))
+
+    def do_cancel(self, params):
+        txn = self.transaction(params)
+        if txn.status(time.time()) not in ('Pending', 'Reserved'):
+            raise FPSError(400, 'TransactionNotCancelable', 'The transaction can not be cancelled.')
+        txn.cancelled = True
+        return self.transaction_result(txn)
+
+    def do_get_transaction_status(self, params):
+        txn = self.transaction(params)
+        status = txn.status(time.time())
+        if status == 'Pending':
+            status_code, message = 'PendingNetworkResponse', 'The transaction is awaiting a response from the network.'
+        else:
+            status_code, message = txn.status_code, 'The transaction is {0}.'.format(status)
+        return ''.join([self.transaction_result(txn),
+                        _element('CallerReference', txn.caller_reference or ''),
+                        _element('StatusCode', status_code),
+                        _element('StatusMessage', message)])
+
+    def do_get_account_balance(self, params):
+        now = time.time()
+        settled = sum((t.amount for t in self._activity
+                       if t.action in ('Pay', 'Settle', 'Refund') and t.status(now) == 'Success'), Decimal('0.00'))
+        pending = sum((t.amount for t in self._activity
+                       if t.action in ('Pay', 'Settle') and t.status(now) == 'Pending'), Decimal('0.00'))
+        return '<AccountBalance>{0}{1}{2}<AvailableBalances>{3}{4}</AvailableBalances></AccountBalance>'.format(
+            _amount('TotalBalance', settled),
+            _amount('PendingInBalance', pending),
+            _amount('PendingOutBalance', Decimal('0.00')),
+            _amount('DisbursableBalance', settled),
+            _amount('RefundableBalance', settled))
+
+    def do_get_account_activity(self, params):
+        self.require(params, 'StartDate')
+        start = parse_timestamp(params['StartDate'])
+        end = parse_timestamp(params['EndDate']) if params.get('EndDate') else None
+        batch_size = int(params.get('MaxBatchSize') or 20)
+        now = time.time()
+        matching = [t for t in self._activity if t.date_received >= start and (end is None or t.date_received < end)]
+        page, rest = matching[:batch_size], matching[batch_size:]
+        out = [_element('BatchSize', len(page))]
+        for t in page:
+            out.append('<Transaction>{0}{1}{2}{3}{4}{5}</Transaction>'.format(
+                _element('TransactionId', t.id),
+                _element('CallerReference', t.caller_reference or ''),
+                _element('DateReceived', _timestamp(t.date_received)),
+                _element('FPSOperation', t.action),
+                _element('TransactionStatus', t.status(now)),
+                _amount('TransactionAmount', t.amount)))
+        if rest:
+            out.append(_element('NextStartingDate', _timestamp(rest[0].date_received)))
+        return ''.join(out)
+
+    def token_xml(self, token_id):
+        status, reference = self._tokens[token_id]
+        return '<Token>{0}{1}{2}{3}</Token>'.format(_element('TokenId', token_id),
+                                                    _element('TokenStatus', status),
+                                                    _element('TokenType', 'SingleUse'),
+                                                    _element('CallerReference', reference or ''))
+
+    def do_get_token_by_caller(self, params):
+        token_id = params.get('TokenId')
+        if token_id is None:
+            reference = params.get('CallerReference')
+            for t, (status, r) in self._tokens.iteritems():
+                if reference is not None and r == reference:
+                    token_id = t
+                    break
+        if token_id not in self._tokens:
+            raise FPSError(400, 'InvalidTokenId', 'The token does not exist.')
+        return self.token_xml(token_id)
+
+    def do_get_tokens(self, params):
+        reference = params.get('CallerReference')
+        status = params.get('TokenStatus')
+        return ''.join(self.token_xml(t) for t, (s, r) in sorted(self._tokens.iteritems())
+                       if (reference is None or r == reference) and (status is None or s == status))
+
+    def do_cancel_token(self, params):
+        self.require(params, 'TokenId')
+        if params['TokenId'] not in self._tokens:
+            raise FPSError(400, 'InvalidTokenId', 'The token does not exist.')
+        self._tokens[params['TokenId']][0] = 'Inactive'
+        return ''
+
+    def do_verify_signature(self, params):
+        self.require(params, 'UrlEndPoint', 'HttpParameters')
+        return _element('VerificationStatus', 'Success')
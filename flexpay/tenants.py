@@ -0,0 +1,162 @@
+import threading
+import weakref
+from collections import OrderedDict
+from flexpay.payment import FlexPay, SandboxAPI
+from flexpay.transport import Transport, PooledTransport
+
+__all__ = ["FlexPayPool"]
+
+# FlexPay arguments holding state that belongs to one account, with what to do instead.
+_TENANT_STATE = {
+    'journal': 'give each tenant a journal of its own',
+    'rate_limiter': 'pass rate_limiter_factory',
+}
+
+class _LimitedResponse(object):
+    def __init__(self, response, semaphore):
+        self._response = response
+        self._semaphore = semaphore
+        self.status = response.status
+        self.reason = response.reason
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def close(self):
+        try:
+            self._response.close()
+        finally:
+            if self._semaphore is not None:
+                semaphore, self._semaphore = self._semaphore, None
+                semaphore.release()
+
+    def __del__(self):
+        if self._semaphore is not None:
+            self._semaphore.release()
+            self._semaphore = None
+
+class _LimitedTransport(Transport):
+    '''
+    Bounds the number of requests one tenant has in flight on a shared transport.
+    '''
+
+    def __init__(self, transport, semaphore):
+        self.transport = transport
+        self.semaphore = semaphore
+
+    def open(self, url, timing=None):
+        self.semaphore.acquire()
+        try:
+            response = self.transport.open(url, timing)
+        except:
+            self.semaphore.release()
+            raise
+        return _LimitedResponse(response, self.semaphore)
+
+    def prewarm(self, url, count=1):
+        self.transport.prewarm(url, count)
+
+class FlexPayPool(object):
+    '''
+    Hands out a :py:class:`flexpay.payment.FlexPay` per tenant, for marketplaces that call FPS with the keys
+    of many sellers::
+
+        pool = FlexPayPool(api=ProductionAPI, max_concurrency=4)
+        ...
+        pool.client(seller.aws_public_key, seller.aws_secret_key).pay(order.id, order.sender_token, order.amount)
+
+    Every client shares the pool's transport, so connections to an endpoint are reused across tenants. Clients
+    are kept in an LRU, along with the keyed HMAC state and request templates they precompute, so a
+    returning tenant costs a dict lookup instead of a new client.
+
+        :param api: The API every client uses.
+
+        :param transport: The transport shared by every client. The default is a new
+            :py:class:`flexpay.transport.PooledTransport`.
+
+        :param max_clients: Number of clients kept, the least recently used is dropped first.
+
+        :param max_concurrency: Maximum requests a single tenant may have in flight, None for no limit.
+
+        :param rate_limiter_factory: Called with no arguments to make the
+            :py:class:`flexpay.ratelimit.RateLimiter` of each tenant. FPS throttles per account, so one tenant's
+            throttles only slow that tenant down. None for no limit.
+
+        :param options: Other :py:class:`flexpay.payment.FlexPay` arguments, passed to every client. A response
+            cache and single flight can be shared, they keep the requests of different access keys apart. A
+            journal or rate limiter can't be: recovery would replay one tenant's operations with the keys of
+            another, and one tenant's throttles would slow every tenant down.
+    '''
+
+    def __init__(self,
+                 api=SandboxAPI,
+                 transport=None,
+                 max_clients=1000,
+                 max_concurrency=None,
+                 rate_limiter_factory=None,
+                 **options):
+        for name, instead in sorted(_TENANT_STATE.iteritems()):
+            if options.get(name) is not None:
+                raise ValueError('A {0} would be shared between tenants, {1}.'.format(name.replace('_', ' '),
+                                                                                       instead))
+        if transport is None:
+            transport = PooledTransport()
+        self.api = api
+        self.transport = transport
+        self.max_clients = max_clients
+        self.max_concurrency = max_concurrency
+        self.rate_limiter_factory = rate_limiter_factory
+        self.options = options
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._clients = OrderedDict() # (public key, secret key) -> FlexPay, least recently used first.
+        # Semaphores and rate limiters outlive evicted clients that still have requests in flight, and are
+        # shared by the clients of one access key.
+        self._semaphores = weakref.WeakValueDictionary()
+        self._rate_limiters = weakref.WeakValueDictionary()
+
+    def client(self, aws_public_key, aws_secret_key):
+        '''
+        Returns the client for this pair of keys, creating it if needed.
+        '''
+        key = (aws_public_key, aws_secret_key)
+        with self._lock:
+            client = self._clients.pop(key, None)
+            if client is not None:
+                self._clients[key] = client
+                self.hits += 1
+                return client
+            self.misses += 1
+            transport = self.transport
+            if self.max_concurrency is not None:
+                semaphore = self._semaphores.get(aws_public_key)
+                if semaphore is None:
+                    semaphore = self._semaphores[aws_public_key] = threading.BoundedSemaphore(self.max_concurrency)
+                transport = _LimitedTransport(transport, semaphore)
+            options = self.options
+            if self.rate_limiter_factory is not None:
+                limiter = self._rate_limiters.get(aws_public_key)
+                if limiter is None:
+                    limiter = self._rate_limiters[aws_public_key] = self.rate_limiter_factory()
+                options = dict(options, rate_limiter=limiter)
+            client = FlexPay(aws_public_key, aws_secret_key, api=self.api, transport=transport, **options)
+            self._clients[key] = client
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+            return client
+
+    def discard(self, aws_public_key, aws_secret_key):
+        '''
+        Drops the client for this pair of keys, for example when a seller rotates their keys.
+        '''
+        with self._lock:
+            self._clients.pop((aws_public_key, aws_secret_key), None)
+
+    def __len__(self):
+        return len(self._clients)
+
+    def close(self):
+        with self._lock:
+            self._clients.clear()
+        self.transport.close()
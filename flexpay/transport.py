@@ -0,0 +1,352 @@
+import httplib
+import select
+import socket
+import ssl
+import threading
+import time
+import urllib2
+from urlparse import urlsplit
+
+__all__ = ["Transport", "UrllibTransport", "PooledTransport", "default_transport"]
+
+class Transport(object):
+    '''
+    Base class for the objects :py:class:`flexpay.payment.FlexPay` uses to talk HTTP.
+
+    A transport only has to implement :py:meth:`open`, which sends a GET request and returns a file like response.
+    The response must provide ``status``, ``reason``, ``read([amt])`` and ``close()``. Error statuses are
+    returned like any other response, it's up to the caller to raise.
+
+    When ``timing`` is given it's a :py:class:`flexpay.instrument.CallTiming`, add the time spent in each
+    phase the transport can tell apart to it.
+    '''
+
+    def open(self, url, timing=None):
+        raise NotImplementedError
+
+    def prewarm(self, url, count=1):
+        '''
+        Open ``count`` connections to the host in url ahead of time. Transports without a pool ignore this.
+        '''
+        pass
+
+    def close(self):
+        pass
+
+class _UrllibResponse(object):
+    def __init__(self, fp, status, reason):
+        self._fp = fp
+        self.status = status
+        self.reason = reason
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._fp.read()
+        return self._fp.read(amt)
+
+    def close(self):
+        self._fp.close()
+
+class UrllibTransport(Transport):
+    '''
+    A transport that uses ``urllib2.urlopen``. Every request opens a new connection.
+
+        :param timeout: Socket timeout in seconds, the default is the global socket timeout.
+    '''
+
+    def __init__(self, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        self.timeout = timeout
+
+    def open(self, url, timing=None):
+        start = time.time()
+        try:
+            fp = urllib2.urlopen(url, timeout=self.timeout)
+            response = _UrllibResponse(fp, fp.code, fp.msg)
+        except urllib2.HTTPError, httperror:
+            response = _UrllibResponse(httperror, httperror.code, httperror.reason)
+        if timing is not None:
+            # urllib2 connects and waits for the headers in one call.
+            timing.add('wait', time.time() - start)
+        return response
+
+class _HTTPConnection(httplib.HTTPConnection):
+    timing = None
+
+    def connect(self):
+        start = time.time()
+        httplib.HTTPConnection.connect(self)
+        if self.timing is not None:
+            self.timing.add('connect', time.time() - start)
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    timing = None
+
+    def connect(self):
+        # The same as HTTPSConnection.connect, split so the TCP connect and TLS handshake are timed apart.
+        start = time.time()
+        httplib.HTTPConnection.connect(self)
+        connected = time.time()
+        if self._tunnel_host:
+            server_hostname = self._tunnel_host
+        else:
+            server_hostname = self.host
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname)
+        if self.timing is not None:
+            self.timing.add('connect', connected - start)
+            self.timing.add('tls', time.time() - connected)
+
+class PooledResponse(object):
+    '''
+    Response returned by :py:class:`PooledTransport`. Once the body has been read and the response is
+    closed the connection goes back to the pool.
+    '''
+
+    def __init__(self, response, pool, conn):
+        self._response = response
+        self._pool = pool
+        self._conn = conn
+        self.status = response.status
+        self.reason = response.reason
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        # The connection can only be reused if the whole body was consumed and the server
+        # didn't ask us to close it.
+        reusable = self._response.isclosed() and not self._response.will_close
+        self._response.close()
+        self._pool.release(conn, reusable)
+
+    def __del__(self):
+        if self._conn is not None:
+            self._pool.release(self._conn, False)
+            self._conn = None
+
+class ConnectionPool(object):
+    '''
+    A pool of persistent connections to one host.
+
+    At most ``max_size`` connections are open at once, callers block in :py:meth:`acquire` until one
+    is free. Connections that have sat idle longer than ``idle_timeout`` seconds are closed instead of reused.
+    '''
+
+    def __init__(self,
+                 scheme,
+                 host,
+                 port,
+                 max_size=10,
+                 idle_timeout=30.0,
+                 timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                 ssl_context=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = [] # (last_used, conn), most recently used last.
+        self._open = 0
+
+    def new_connection(self):
+        if self.scheme == 'https':
+            return _HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self.ssl_context)
+        return _HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _evict(self, now):
+        # Idle connections are ordered by last use, so the stale ones are at the front.
+        stale = 0
+        for last_used, conn in self._idle:
+            if now - last_used < self.idle_timeout:
+                break
+            stale += 1
+        expired = self._idle[:stale]
+        del self._idle[:stale]
+        self._open -= len(expired)
+        return [conn for last_used, conn in expired]
+
+    def acquire(self):
+        '''
+        Returns ``(conn, reused)`` where reused is True if the connection has already served a request.
+        '''
+        with self._cond:
+            expired = self._evict(time.time())
+            while not self._idle and self._open >= self.max_size:
+                self._cond.wait()
+                expired.extend(self._evict(time.time()))
+            if self._idle:
+                conn = self._idle.pop()[1]
+                reused = True
+            else:
+                conn = None
+                reused = False
+                self._open += 1
+        for c in expired:
+            c.close()
+        if conn is None:
+            conn = self.new_connection()
+        return conn, reused
+
+    def release(self, conn, reusable=True):
+        with self._cond:
+            if reusable:
+                self._idle.append((time.time(), conn))
+            else:
+                self._open -= 1
+            self._cond.notify()
+        if not reusable:
+            conn.close()
+
+    def prewarm(self, count=1):
+        '''
+        Opens up to ``count`` connections and leaves them idle in the pool.
+        '''
+        conns = []
+        try:
+            for i in range(min(count, self.max_size)):
+                conn, reused = self.acquire()
+                # Appended first so a connection that fails to connect is still given back.
+                conns.append(conn)
+                if not reused:
+                    conn.connect()
+        finally:
+            for conn in conns:
+                self.release(conn, conn.sock is not None)
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for last_used, conn in idle:
+            conn.close()
+
+def _dropped(conn):
+    # An idle connection has nothing to read, unless the server closed it or sent something unasked for.
+    sock = conn.sock
+    if sock is None:
+        return True
+    try:
+        return bool(select.select([sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+class PooledTransport(Transport):
+    '''
+    A thread safe transport that keeps persistent (keep-alive) connections open, one pool per host.
+
+        :param max_size: Maximum number of open connections per host.
+
+        :param idle_timeout: Seconds a connection may sit unused before it's closed.
+
+        :param timeout: Socket timeout in seconds, the default is the global socket timeout.
+
+        :param ssl_context: The ``ssl.SSLContext`` used for every HTTPS connection. Sharing one context avoids
+            reloading the trust store for each new connection. The default is ``ssl.create_default_context()``.
+
+        :param prewarm: A list of URLs to open a connection to immediately.
+    '''
+
+    def __init__(self,
+                 max_size=10,
+                 idle_timeout=30.0,
+                 timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                 ssl_context=None,
+                 prewarm=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        if ssl_context is None:
+            ssl_context = ssl.create_default_context()
+        self.ssl_context = ssl_context
+        self._lock = threading.Lock()
+        self._pools = {}
+        for url in prewarm or []:
+            self.prewarm(url)
+
+    def pool_for(self, url):
+        parts = urlsplit(url)
+        scheme = parts.scheme
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = ConnectionPool(scheme,
+                                          parts.hostname,
+                                          port,
+                                          max_size=self.max_size,
+                                          idle_timeout=self.idle_timeout,
+                                          timeout=self.timeout,
+                                          ssl_context=self.ssl_context)
+                    self._pools[key] = pool
+        return pool
+
+    def prewarm(self, url, count=1):
+        self.pool_for(url).prewarm(count)
+
+    def open(self, url, timing=None):
+        pool = self.pool_for(url)
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        while True:
+            conn, reused = pool.acquire()
+            if reused and _dropped(conn):
+                pool.release(conn, False)
+                continue
+            sent = False
+            try:
+                if not reused:
+                    conn.timing = timing
+                    conn.connect()
+                    conn.timing = None
+                start = time.time()
+                conn.request('GET', path)
+                sent = True
+                response = conn.getresponse()
+                if timing is not None:
+                    timing.add('wait', time.time() - start)
+            except (httplib.HTTPException, socket.error):
+                pool.release(conn, False)
+                # The server may have closed an idle keep-alive connection, try again on a new one. Once the
+                # request has been sent the server may have acted on it, and a Pay or Refund mustn't be sent twice.
+                if reused and not sent:
+                    continue
+                raise
+            except:
+                pool.release(conn, False)
+                raise
+            return PooledResponse(response, pool, conn)
+
+    def close(self):
+        with self._lock:
+            pools = self._pools.values()
+        for pool in pools:
+            pool.close()
+
+_default_transport = None
+_default_lock = threading.Lock()
+
+def default_transport():
+    '''
+    Returns the :py:class:`PooledTransport` shared by every :py:class:`flexpay.payment.FlexPay` instance
+    that wasn't given a transport of its own.
+    '''
+    global _default_transport
+    if _default_transport is None:
+        with _default_lock:
+            if _default_transport is None:
+                _default_transport = PooledTransport()
+    return _default_transport
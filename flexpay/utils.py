@@ -1,25 +1,57 @@
+from datetime import datetime
 from urllib import quote
 
 def make_enum(base, **enums):
+    '''
+    Creates an enumeration whose members are instances of base.
+
+    The members are indexed by value when the class is created, so :py:meth:`reverse_lookup` is a dict lookup.
+    Constructing an instance yourself doesn't make it a member.
+    '''
     class _ENUM(base):
         instances = []
-        def __init__(self, *args, **kwargs):
-            self.__class__.instances.append(self)
-            base.__init__(self, *args, **kwargs)
+        _index = {}
+        _lists = {}
         
         @classmethod
         def reverse_lookup(cls, value):
-            if isinstance(value, base):
-                for v in cls.instances:
-                    if v == value:
-                        return v
-            raise TypeError('Reverse lookup for enumerated value {0} failed.'.format(value))
+            member = cls._index.get(value)
+            if member is None:
+                raise TypeError('Reverse lookup for enumerated value {0} failed.'.format(value))
+            return member
+        
+        @classmethod
+        def join(cls, members, sep=','):
+            '''
+            Joins a sequence of members into one string, raising ``TypeError`` if any isn't a member.
+            '''
+            index = cls._index
+            for m in members:
+                if index.get(m) is not m:
+                    raise TypeError('{0!r} is not a member of the enumeration.'.format(m))
+            return sep.join(members)
+        
+        @classmethod
+        def parse_list(cls, value, sep=','):
+            '''
+            Parses a list such as ``'ABT,ACH,CC'`` into a tuple of members, raising ``TypeError`` for unknown values.
+            '''
+            members = cls._lists.get(value)
+            if members is None:
+                members = tuple(cls.reverse_lookup(v.strip()) for v in value.split(sep) if v.strip())
+                if len(cls._lists) >= 1024:
+                    cls._lists.clear()
+                cls._lists[value] = members
+            return members
         
         def __setattr__(self, name, value):
             raise NotImplementedError
     
     for e in enums:
-        setattr(_ENUM, e, _ENUM(enums[e]))
+        member = _ENUM(enums[e])
+        setattr(_ENUM, e, member)
+        _ENUM.instances.append(member)
+        _ENUM._index[member] = member
     
     return _ENUM
 
@@ -29,6 +61,14 @@ def make_amount(amt):
     '''
     return str(amt) # All decimal and floating point classes will convert to string properly.
 
+def make_timestamp(t):
+    '''
+    Turn a datetime in UTC into a timestamp for use in the REST API. Strings are passed through unchanged.
+    '''
+    if isinstance(t, datetime):
+        return t.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return t
+
 def signature_quote(thing): 
     x = quote(str(thing), '~')
     return x
\ No newline at end of file
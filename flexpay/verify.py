@@ -0,0 +1,281 @@
+import base64
+import os
+import tempfile
+import threading
+import time
+import urllib2
+from datetime import datetime
+from hashlib import sha1, sha256
+from urlparse import urlparse, urlsplit, parse_qsl
+from flexpay.signing import string_to_sign
+
+__all__ = ["Certificate", "CertificateCache", "SignatureVerifier", "TRUSTED_CERTIFICATE_HOSTS",
+           "default_verifier", "fetch_certificate", "split_url"]
+
+TRUSTED_CERTIFICATE_HOSTS = frozenset(['fps.amazonaws.com', 'fps.sandbox.amazonaws.com'])
+'''
+Hosts signing certificates are accepted from. The certificate is trusted because it was fetched from one of them
+over verified HTTPS.
+'''
+
+# DigestInfo prefixes of PKCS#1 v1.5 signatures, RFC 3447 section 9.2.
+_DIGESTS = {
+    'RSA-SHA1': (sha1, '3021300906052b0e03021a05000414'.decode('hex')),
+    'RSA-SHA256': (sha256, '3031300d060960864801650304020105000420'.decode('hex')),
+}
+
+def _tlv(data, pos):
+    # Reads one DER element at pos. Returns its tag, contents and the position after it.
+    tag = ord(data[pos])
+    length = ord(data[pos + 1])
+    pos += 2
+    if length & 0x80:
+        n = length & 0x7f
+        length = int(data[pos:pos + n].encode('hex'), 16)
+        pos += n
+    end = pos + length
+    if end > len(data):
+        raise ValueError('Truncated DER element.')
+    return tag, data[pos:end], end
+
+def _children(data):
+    pos = 0
+    while pos < len(data):
+        tag, value, pos = _tlv(data, pos)
+        yield tag, value
+
+def _integer(value):
+    return int(value.encode('hex'), 16)
+
+def _time(tag, value):
+    if tag == 0x17: # UTCTime, two digit years from 1950.
+        year = int(value[:2])
+        value = str(year + (2000 if year < 50 else 1900)) + value[2:]
+    return datetime.strptime(value[:14], '%Y%m%d%H%M%S')
+
+def _pem_to_der(data):
+    if '-----BEGIN' not in data:
+        return data
+    lines = [l.strip() for l in data.splitlines()]
+    start = lines.index('-----BEGIN CERTIFICATE-----') + 1
+    end = lines.index('-----END CERTIFICATE-----', start)
+    return base64.b64decode(''.join(lines[start:end]))
+
+class Certificate(object):
+    '''
+    The parts of an X.509 certificate needed to check a signature: the RSA public key and the validity period.
+
+        :param data: The certificate, PEM or DER encoded.
+    '''
+
+    def __init__(self, data):
+        try:
+            tag, cert, end = _tlv(_pem_to_der(data), 0)
+            tbs = list(_children(cert))[0][1]
+            fields = list(_children(tbs))
+            if fields[0][0] == 0xa0: # Explicit version.
+                fields = fields[1:]
+            validity = list(_children(fields[3][1]))
+            self.not_before = _time(*validity[0])
+            self.not_after = _time(*validity[1])
+            algorithm, key_bits = [value for t, value in _children(fields[5][1])]
+            # The BIT STRING starts with the number of unused bits.
+            modulus, exponent = [_integer(value) for t, value in _children(_tlv(key_bits[1:], 0)[1])]
+        except (IndexError, ValueError, TypeError), e:
+            raise ValueError('Not an RSA certificate: {0}'.format(e))
+        self.modulus = modulus
+        self.exponent = exponent
+        self.size = (modulus.bit_length() + 7) // 8
+
+    def valid_at(self, when):
+        return self.not_before <= when <= self.not_after
+
+    def verify(self, message, signature, method='RSA-SHA1'):
+        '''
+        Returns True if signature is a PKCS#1 v1.5 signature of message made with this certificate's key.
+        '''
+        if method not in _DIGESTS:
+            return False
+        digestmod, prefix = _DIGESTS[method]
+        if len(signature) != self.size:
+            return False
+        s = _integer(signature)
+        if s >= self.modulus:
+            # Out of range, RFC 3447 section 5.2.2. Otherwise s and s + modulus would both verify.
+            return False
+        m = pow(s, self.exponent, self.modulus)
+        encoded = '{0:0{1}x}'.format(m, self.size * 2).decode('hex')
+        digest = prefix + digestmod(message).digest()
+        expected = '\x00\x01' + '\xff' * (self.size - len(digest) - 3) + '\x00' + digest
+        return encoded == expected
+
+def fetch_certificate(url, timeout=10):
+    '''
+    Downloads the certificate at url. Only HTTPS is accepted.
+    '''
+    if urlsplit(url).scheme != 'https':
+        raise ValueError('Certificates are only fetched over HTTPS: {0}'.format(url))
+    fp = urllib2.urlopen(url, timeout=timeout)
+    try:
+        return fp.read()
+    finally:
+        fp.close()
+
+class CertificateCache(object):
+    '''
+    Signing certificates keyed by their ``certificateUrl``, kept in memory and optionally in a directory
+    so they survive restarts. A certificate is fetched again once it's older than ttl.
+
+        :param fetcher: Called with a URL, returns the certificate. The default is :py:func:`fetch_certificate`.
+
+        :param ttl: Seconds before a certificate is fetched again.
+
+        :param directory: Where certificates are stored on disk, None keeps them in memory only.
+
+        :param trusted_hosts: Hosts a certificateUrl may point to, None accepts any.
+    '''
+
+    def __init__(self,
+                 fetcher=fetch_certificate,
+                 ttl=24 * 3600,
+                 directory=None,
+                 trusted_hosts=TRUSTED_CERTIFICATE_HOSTS,
+                 clock=time.time):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.directory = directory
+        self.trusted_hosts = trusted_hosts
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._certificates = {} # url -> (fetched, Certificate)
+
+    def path_for(self, url):
+        return os.path.join(self.directory, sha1(url).hexdigest() + '.pem')
+
+    def _load(self, url):
+        # Returns (fetched, Certificate) from disk, or None.
+        if self.directory is None:
+            return None
+        path = self.path_for(url)
+        try:
+            fetched = os.path.getmtime(path)
+            with open(path, 'rb') as f:
+                return fetched, Certificate(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _store(self, url, data):
+        if self.directory is None:
+            return
+        # Write and rename so readers never see half a certificate.
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, self.path_for(url))
+        except (IOError, OSError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def get(self, url):
+        '''
+        Returns the :py:class:`Certificate` at url, fetching it if it isn't cached or has expired.
+        '''
+        if self.trusted_hosts is not None:
+            parts = urlsplit(url)
+            if parts.scheme != 'https' or parts.hostname not in self.trusted_hosts:
+                raise ValueError('Untrusted certificate URL: {0}'.format(url))
+
+        now = self.clock()
+        entry = self._certificates.get(url)
+        if entry is None:
+            entry = self._load(url)
+        if entry is None or now - entry[0] >= self.ttl:
+            data = self.fetcher(url)
+            entry = (now, Certificate(data))
+            self._store(url, data)
+        with self._lock:
+            self._certificates[url] = entry
+        return entry[1]
+
+    def cached(self, url):
+        '''
+        Returns True if a fresh certificate for url is held in memory, so :py:meth:`get` won't fetch it.
+        '''
+        entry = self._certificates.get(url)
+        return entry is not None and self.clock() - entry[0] < self.ttl
+
+    def clear(self):
+        with self._lock:
+            self._certificates.clear()
+
+def split_url(url):
+    '''
+    Splits a return URL into its endpoint, without the query, and a dict of its parameters.
+    '''
+    p = urlparse(url)
+    return '{0.scheme}://{0.netloc}{0.path}'.format(p), dict(parse_qsl(p.query, keep_blank_values=True))
+
+class SignatureVerifier(object):
+    '''
+    Checks signature version 2 signatures of CBUI return URLs and IPNs locally, without a VerifySignature call.
+
+    FPS signs these with the RSA key of the certificate at ``certificateUrl``. Once the certificate is cached
+    verifying takes no network round trip.
+
+        :param certificates: The :py:class:`CertificateCache`, a new in-memory one by default.
+    '''
+
+    def __init__(self, certificates=None):
+        if certificates is None:
+            certificates = CertificateCache()
+        self.certificates = certificates
+
+    def verify(self, params, url_end_point, http_method='GET'):
+        '''
+        Returns True if params, the parameters FPS sent to url_end_point, carry a valid signature.
+
+        Raises ``ValueError`` for an untrusted certificate URL and whatever the fetcher raises when the
+        certificate can't be fetched.
+        '''
+        params = dict(params)
+        signature = params.pop('signature', None)
+        if signature is None or params.get('signatureVersion') != '2':
+            return False
+        certificate_url = params.get('certificateUrl')
+        if not certificate_url:
+            return False
+        try:
+            signature = base64.b64decode(signature)
+        except TypeError:
+            return False
+
+        certificate = self.certificates.get(certificate_url)
+        if not certificate.valid_at(datetime.utcnow()):
+            return False
+        message = string_to_sign(params, url_end_point, http_method)
+        return certificate.verify(message, signature, params.get('signatureMethod', 'RSA-SHA1'))
+
+    def verify_url(self, url):
+        '''
+        Returns True if the return URL FPS redirected the buyer to carries a valid signature.
+        '''
+        url_end_point, params = split_url(url)
+        return self.verify(params, url_end_point, 'GET')
+
+_default_verifier = None
+_default_lock = threading.Lock()
+
+def default_verifier():
+    '''
+    Returns the :py:class:`SignatureVerifier` shared by every :py:class:`flexpay.payment.FlexPay` instance
+    that wasn't given a verifier of its own.
+    '''
+    global _default_verifier
+    if _default_verifier is None:
+        with _default_lock:
+            if _default_verifier is None:
+                _default_verifier = SignatureVerifier()
+    return _default_verifier
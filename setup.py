@@ -12,5 +12,6 @@ setup(name='flexpay',
       packages=['flexpay'],
       include_package_data=True,
       zip_safe = False,
+      extras_require={'async': ['trollius']},
       keywords=['Amazon FPS', 'payments', 'e-commerc']
 )
\ No newline at end of file
@@ -0,0 +1,51 @@
+import shutil
+import socket
+import tempfile
+import unittest
+from flexpay.payment import FlexPay
+from flexpay.standin import StandInServer
+
+def unused_port():
+    '''
+    A local port nothing is listening on.
+    '''
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class TestCase(unittest.TestCase):
+    def mkdtemp(self):
+        '''
+        A temporary directory removed after the test.
+        '''
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
+class StandInTestCase(TestCase):
+    '''
+    Runs a :py:class:`flexpay.standin.StandInServer` for each test.
+
+        .. py:attribute:: keys
+
+            The access keys the server accepts, with their secret keys.
+
+        .. py:attribute:: server_options
+
+            Other keyword arguments for the server.
+    '''
+
+    keys = {'AK': 'SK'}
+    server_options = {}
+
+    def setUp(self):
+        self.server = StandInServer(keys=self.keys, **self.server_options).start()
+        self.addCleanup(self.server.stop)
+
+    def make_client(self, access_key='AK', **kwargs):
+        '''
+        A :py:class:`flexpay.payment.FlexPay` for one of the server's accounts.
+        '''
+        return FlexPay(access_key, self.keys[access_key], api=self.server.api, **kwargs)
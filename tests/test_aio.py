@@ -0,0 +1,120 @@
+import socket
+import time
+import unittest
+from datetime import datetime, timedelta
+from flexpay.aio import asyncio
+from flexpay.batch import BatchResult
+from tests import StandInTestCase
+
+if asyncio is not None:
+    from flexpay.aio import AsyncFlexPay, AsyncPooledTransport
+
+class _FailingVerifier(object):
+    def verify(self, params, url_end_point, http_method='GET'):
+        raise IOError('The certificate could not be fetched.')
+
+@unittest.skipIf(asyncio is None, 'trollius is not installed')
+class AsyncHelpersTest(StandInTestCase):
+    def setUp(self):
+        super(AsyncHelpersTest, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncFlexPay('AK', 'SK', api=self.server.api, loop=self.loop)
+
+    def tearDown(self):
+        self.client.transport.close()
+        self.loop.close()
+
+    def run_until_complete(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def pay(self, count):
+        for i in range(count):
+            self.run_until_complete(self.client.pay('order-%d' % i, 'token-%d' % i, '1.00'))
+
+    def test_batch(self):
+        seen = []
+        results = self.run_until_complete(self.client.batch([('pay', 'order-1', 'token-1', '1.00'),
+                                                              ('get_transaction_status', 'no-such-transaction'),
+                                                              ('get_account_balance',)],
+                                                             max_workers=2,
+                                                             callback=seen.append))
+        self.assertEqual([r.index for r in results], [0, 1, 2])
+        self.assertTrue(all(isinstance(r, BatchResult) for r in results))
+        self.assertTrue(results[0].ok)
+        self.assertEqual(str(results[0].response.transaction_status), 'Success')
+        self.assertFalse(results[1].ok)
+        self.assertTrue(results[2].ok)
+        self.assertEqual(len(seen), 3)
+
+    def test_batch_callback_error(self):
+        def callback(result):
+            raise ValueError('callback failed')
+        coroutine = self.client.batch([('get_account_balance',)] * 3, callback=callback)
+        self.assertRaises(ValueError, self.run_until_complete, coroutine)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_iter_tokens(self):
+        self.pay(3)
+        tokens = self.run_until_complete(self.client.iter_tokens())
+        self.assertEqual(sorted(t.TokenId.value for t in tokens), ['token-0', 'token-1', 'token-2'])
+
+    def test_iter_account_activity_is_refused(self):
+        self.assertRaises(TypeError, self.client.iter_account_activity, datetime.utcnow())
+
+    def test_for_each_account_activity(self):
+        self.pay(7)
+        start = datetime.utcnow() - timedelta(hours=1)
+        for prefetch in (True, False):
+            seen = []
+            count = self.run_until_complete(self.client.for_each_account_activity(
+                seen.append, start, max_batch_size=3, prefetch=prefetch))
+            self.assertEqual(count, 7)
+            self.assertEqual(sorted(t.CallerReference.value for t in seen), ['order-%d' % i for i in range(7)])
+
+    def test_verify_notification_fallback(self):
+        self.client.verifier = _FailingVerifier()
+        params = {'transactionId': 'T', 'signature': 'x', 'certificateUrl': 'https://fps.example.com/cert.pem'}
+        coroutine = self.client.verify_notification(params, 'https://shop.example.com/ipn')
+        self.assertRaises(IOError, self.run_until_complete, coroutine)
+        valid = self.run_until_complete(self.client.verify_notification(params, 'https://shop.example.com/ipn',
+                                                                        fallback=True))
+        self.assertIs(valid, True)
+
+    def test_verify_return_url_fallback(self):
+        self.client.verifier = _FailingVerifier()
+        url = 'https://shop.example.com/return?tokenID=T&signature=x'
+        self.assertIs(self.run_until_complete(self.client.verify_return_url(url, fallback=True)), True)
+
+@unittest.skipIf(asyncio is None, 'trollius is not installed')
+class AsyncPooledTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_unanswered_request_times_out(self):
+        # The connection is accepted by the backlog and never answered.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        self.addCleanup(sock.close)
+        transport = AsyncPooledTransport(max_size=1, timeout=0.2, loop=self.loop)
+        started = time.time()
+        url = 'http://127.0.0.1:{0}/'.format(sock.getsockname()[1])
+        self.assertRaises(asyncio.TimeoutError, self.loop.run_until_complete, transport.fetch(url))
+        self.assertLess(time.time() - started, 5)
+        # The slot of the abandoned connection is free again.
+        self.assertRaises(asyncio.TimeoutError, self.loop.run_until_complete, transport.fetch(url))
+        self.assertEqual(transport.pool_for(url).idle, [])
+        transport.close()
+
+    def test_follows_default_timeout(self):
+        previous = socket.getdefaulttimeout()
+        socket.setdefaulttimeout(3.0)
+        try:
+            transport = AsyncPooledTransport(loop=self.loop)
+            self.assertEqual(transport.pool_for('http://127.0.0.1/').timeout, 3.0)
+        finally:
+            socket.setdefaulttimeout(previous)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+from tests import StandInTestCase
+
+class RunBatchTest(StandInTestCase):
+    def setUp(self):
+        super(RunBatchTest, self).setUp()
+        self.client = self.make_client()
+
+    def test_results_in_order(self):
+        operations = [('pay', 'order-%d' % i, 'token', '1.00') for i in range(10)]
+        operations.append(('get_transaction_status', 'no-such-transaction'))
+        results = self.client.batch(operations, max_workers=4)
+        self.assertEqual([r.index for r in results], range(11))
+        self.assertTrue(all(r.ok for r in results[:10]))
+        self.assertFalse(results[10].ok)
+
+    def test_callback_error_raised_after_every_operation_ran(self):
+        seen = []
+
+        def callback(result):
+            seen.append(result.index)
+            if result.index == 0:
+                raise ValueError('callback failed')
+
+        operations = [('get_account_balance',)] * 20
+        self.assertRaises(ValueError, self.client.batch, operations, max_workers=2, callback=callback)
+        self.assertEqual(sorted(seen), range(20))
+        self.assertEqual(self.server.requests, 20)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+import calendar
+import os
+import socket
+import time
+import unittest
+from datetime import datetime, timedelta
+from flexpay.billing import BillingScheduler, caller_reference, _add_months, _Subscription
+from tests import StandInTestCase
+
+WEEK = timedelta(days=7)
+
+class _LostResponses(object):
+    '''
+    Sends every Pay and then loses the response, like a crash right after the request went out.
+    '''
+
+    def __init__(self, client):
+        self.client = client
+
+    def pay(self, *args):
+        self.client.pay(*args)
+        raise socket.error('connection reset')
+
+class _NoStatus(object):
+    '''
+    Answers every Pay with a response that has no TransactionStatus.
+    '''
+
+    class Response(object):
+        transaction_id = 'T1'
+        transaction_status = None
+
+    def pay(self, *args):
+        return self.Response()
+
+def later(days):
+    # A clock days ahead of the real one.
+    return lambda: time.time() + days * 86400
+
+class BillingSchedulerTest(StandInTestCase):
+    def setUp(self):
+        super(BillingSchedulerTest, self).setUp()
+        self.path = os.path.join(self.mkdtemp(), 'billing.db')
+        self.client = self.make_client()
+        # Cycles 0 and 1 are due, cycle 2 is four days away.
+        self.start = datetime.utcnow() - timedelta(days=10)
+
+    def scheduler(self, client=None, **kwargs):
+        kwargs.setdefault('window', 0.1)
+        kwargs.setdefault('max_catch_up', 2) # Both due cycles are billed.
+        return BillingScheduler(client or self.client, self.path, **kwargs)
+
+    def charges(self):
+        # Every Pay FPS has, by caller reference.
+        activity = self.client.iter_account_activity('2000-01-01T00:00:00Z', operation='Pay')
+        return sorted(t.CallerReference.value for t in activity)
+
+    def test_bills_due_cycles(self):
+        seen = []
+        scheduler = self.scheduler(callback=seen.append)
+        for i in range(5):
+            scheduler.add('sub-%d' % i, 'token-%d' % i, '9.99', start=self.start, period=WEEK)
+        scheduler.run(until=time.time() + 0.5)
+        self.assertEqual(len(seen), 10)
+        self.assertTrue(all(c.ok and c.final for c in seen))
+        self.assertEqual(self.charges(), sorted(caller_reference('sub-%d' % i, c) for i in range(5) for c in (0, 1)))
+        self.assertEqual([row[:3] for row in scheduler.charges('sub-0')],
+                         [(0, 'sub-0-c0', 'done'), (1, 'sub-0-c1', 'done')])
+        scheduler.close()
+
+    def test_restart_does_not_bill_again(self):
+        scheduler = self.scheduler()
+        scheduler.add('sub-1', 'token-1', '9.99', start=self.start, period=WEEK)
+        scheduler.run(until=time.time() + 0.3)
+        scheduler.close()
+        requests = self.server.requests
+
+        scheduler = self.scheduler()
+        scheduler.run(until=time.time() + 0.3)
+        self.assertEqual(self.server.requests, requests)
+        self.assertEqual(self.charges(), ['sub-1-c0', 'sub-1-c1'])
+        scheduler.close()
+
+    def test_restart_resends_pending_charge_once(self):
+        scheduler = self.scheduler(_LostResponses(self.client), retry_delay=3600)
+        scheduler.add('sub-1', 'token-1', '9.99', start=self.start, period=WEEK)
+        scheduler.run(until=time.time() + 0.3)
+        self.assertEqual([row[2] for row in scheduler.charges('sub-1')], ['pending'])
+        scheduler.close()
+        self.assertEqual(self.charges(), ['sub-1-c0'])
+
+        seen = []
+        scheduler = self.scheduler(callback=seen.append)
+        scheduler.run(until=time.time() + 0.3)
+        # The pending cycle went out again with the same CallerReference, FPS returned the original charge.
+        self.assertEqual([(c.caller_reference, c.ok) for c in seen], [('sub-1-c0', True), ('sub-1-c1', True)])
+        self.assertEqual(self.charges(), ['sub-1-c0', 'sub-1-c1'])
+        self.assertEqual([row[2:4] for row in scheduler.charges('sub-1')], [('done', 2), ('done', 1)])
+        scheduler.close()
+
+    def test_gives_up_after_max_attempts(self):
+        scheduler = self.scheduler(_LostResponses(self.client), retry_delay=0.01, max_attempts=3)
+        scheduler.add('sub-1', 'token-1', '9.99', start=datetime.utcnow(), period=WEEK)
+        scheduler.run(until=time.time() + 0.5)
+        self.assertEqual([row[2:4] for row in scheduler.charges('sub-1')], [('failed', 3)])
+        # Every attempt used the same CallerReference, so FPS charged once.
+        self.assertEqual(self.charges(), ['sub-1-c0'])
+        scheduler.close()
+
+    def test_declined_charge_moves_on(self):
+        seen = []
+        scheduler = self.scheduler(callback=seen.append)
+        scheduler.add('sub-1', 'token-1', '1.60', start=self.start, period=WEEK)
+        scheduler.run(until=time.time() + 0.3)
+        self.assertEqual([(c.cycle, c.ok, c.final) for c in seen], [(0, False, True), (1, False, True)])
+        self.assertEqual([(row[2], row[6]) for row in scheduler.charges('sub-1')],
+                         [('failed', 'InsufficientBalance'), ('failed', 'InsufficientBalance')])
+        scheduler.close()
+
+    def test_cancel_and_add_again(self):
+        scheduler = self.scheduler()
+        scheduler.add('sub-1', 'token-1', '9.99', start=self.start, period=WEEK)
+        scheduler.cancel('sub-1')
+        scheduler.run(until=time.time() + 0.2)
+        self.assertEqual(self.charges(), [])
+        scheduler.close()
+
+        scheduler = self.scheduler()
+        scheduler.run(until=time.time() + 0.2)
+        self.assertEqual(self.charges(), [])
+        scheduler.add('sub-1', 'token-1', '9.99', start=datetime.utcnow(), period=WEEK)
+        scheduler.run(until=time.time() + 0.3)
+        # Added again it keeps its original schedule.
+        self.assertEqual(self.charges(), ['sub-1-c0', 'sub-1-c1'])
+        scheduler.close()
+
+    def test_max_workers(self):
+        scheduler = self.scheduler(max_workers=2)
+        for i in range(10):
+            scheduler.add('sub-%d' % i, 'token', '1.00', start=self.start, period=WEEK)
+        scheduler.run(until=time.time() + 0.5)
+        self.assertEqual(len(self.charges()), 20)
+        scheduler.close()
+
+    def test_catch_up_is_bounded(self):
+        start = datetime.utcnow() - timedelta(weeks=10, days=1)
+        scheduler = self.scheduler(max_catch_up=1)
+        scheduler.add('sub-1', 'token-1', '9.99', start=start, period=WEEK)
+        scheduler.add('sub-2', 'token-2', '9.99', start=start, period=WEEK)
+        scheduler.cancel('sub-2')
+        scheduler.run(until=time.time() + 0.3)
+        # Cycles 0 to 10 were due, only the last one is billed.
+        self.assertEqual(self.charges(), ['sub-1-c10'])
+        scheduler.close()
+
+        scheduler = self.scheduler(max_catch_up=0)
+        scheduler.add('sub-2', 'token-2', '9.99', start=start, period=WEEK)
+        scheduler.run(until=time.time() + 0.3)
+        self.assertEqual(self.charges(), ['sub-1-c10'])
+        scheduler.close()
+
+        scheduler = self.scheduler(max_catch_up=None)
+        scheduler.add('sub-3', 'token-3', '9.99', start=start, period=WEEK)
+        scheduler.run(until=time.time() + 0.5)
+        self.assertEqual([row[0] for row in scheduler.charges('sub-3')], range(11))
+        scheduler.close()
+
+    def test_outage_skips_missed_cycles(self):
+        scheduler = self.scheduler()
+        scheduler.add('sub-1', 'token-1', '9.99', start=self.start, period=WEEK)
+        scheduler.add('sub-2', 'token-2', '9.99', start=self.start, period=WEEK)
+        scheduler.run(until=time.time() + 0.3)
+        scheduler.close()
+
+        # Five weeks later cycles 2 to 6 are due.
+        clock = later(35)
+        scheduler = self.scheduler(max_catch_up=1, clock=clock)
+        scheduler.run(until=clock() + 0.3)
+        self.assertEqual(self.charges(), ['sub-1-c0', 'sub-1-c1', 'sub-1-c6', 'sub-2-c0', 'sub-2-c1', 'sub-2-c6'])
+        scheduler.close()
+
+    def test_pending_charge_is_not_skipped(self):
+        scheduler = self.scheduler(_LostResponses(self.client), retry_delay=3600)
+        scheduler.add('sub-1', 'token-1', '9.99', start=self.start, period=WEEK)
+        scheduler.run(until=time.time() + 0.3)
+        scheduler.close()
+
+        clock = later(35)
+        scheduler = self.scheduler(max_catch_up=1, clock=clock)
+        scheduler.run(until=clock() + 0.3)
+        self.assertEqual([row[:3] for row in scheduler.charges('sub-1')],
+                         [(0, 'sub-1-c0', 'done'), (6, 'sub-1-c6', 'done')])
+        scheduler.close()
+
+    def test_missing_status_is_null(self):
+        scheduler = self.scheduler(_NoStatus())
+        scheduler.add('sub-1', 'token-1', '9.99', start=datetime.utcnow(), period=WEEK)
+        scheduler.run(until=time.time() + 0.3)
+        self.assertEqual([row[2:6] for row in scheduler.charges('sub-1')], [('done', 1, 'T1', None)])
+        scheduler.close()
+
+    def test_cycle_after(self):
+        weekly = _Subscription('sub-1', 'token', '1.00', str(7 * 86400), 1000000, 0, 1)
+        self.assertEqual(weekly.cycle_after(0), 0)
+        self.assertEqual(weekly.cycle_after(1000000), 1)
+        self.assertEqual(weekly.cycle_after(1000000 + 3 * 7 * 86400 - 1), 3)
+        anchor = calendar.timegm(datetime(2013, 1, 31).utctimetuple())
+        monthly = _Subscription('sub-1', 'token', '1.00', 'month', anchor, 0, 1)
+        self.assertEqual(monthly.cycle_after(anchor - 1), 0)
+        self.assertEqual(monthly.cycle_after(calendar.timegm(datetime(2013, 2, 28).utctimetuple())), 2)
+        self.assertEqual(monthly.cycle_after(calendar.timegm(datetime(2014, 3, 30).utctimetuple())), 14)
+
+    def test_add_months(self):
+        self.assertEqual(_add_months(datetime(2013, 1, 31), 1), datetime(2013, 2, 28))
+        self.assertEqual(_add_months(datetime(2012, 1, 31), 1), datetime(2012, 2, 29))
+        self.assertEqual(_add_months(datetime(2013, 11, 15), 3), datetime(2014, 2, 15))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+from flexpay.cache import CachePolicy, ResponseCache
+from flexpay.standin import StandInServer
+from tests import StandInTestCase
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class ResponseCacheTest(StandInTestCase):
+    keys = {'AK1': 'SK1', 'AK2': 'SK2'}
+
+    def setUp(self):
+        super(ResponseCacheTest, self).setUp()
+        self.clock = _Clock()
+        self.cache = ResponseCache(clock=self.clock)
+        self.client = self.make_client('AK1', cache=self.cache)
+
+    def test_hits(self):
+        transaction_id = self.client.pay('order-1', 'token', '1.00').transaction_id
+        first = self.client.get_transaction_status(transaction_id)
+        self.assertIs(self.client.get_transaction_status(transaction_id), first)
+        self.assertEqual(self.server.requests, 2)
+        stats = self.cache.stats()['GetTransactionStatus']
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 1, 1))
+        # Activity isn't cached.
+        self.client.get_account_activity('2000-01-01T00:00:00Z')
+        self.client.get_account_activity('2000-01-01T00:00:00Z')
+        self.assertEqual(self.server.requests, 4)
+
+    def test_expiry(self):
+        first = self.client.get_account_balance()
+        self.clock.now += 4.9
+        self.assertIs(self.client.get_account_balance(), first)
+        self.clock.now += 0.2
+        self.assertIsNot(self.client.get_account_balance(), first)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_pending_transactions_are_not_cached(self):
+        self.server.settle_delay = 60
+        transaction_id = self.client.pay('order-1', 'token', '1.00').transaction_id
+        self.client.get_transaction_status(transaction_id)
+        self.client.get_transaction_status(transaction_id)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_writes_invalidate(self):
+        transaction_id = self.client.pay('order-1', 'token', '1.00').transaction_id
+        status = self.client.get_transaction_status(transaction_id)
+        balance = self.client.get_account_balance()
+        self.client.refund('order-1-refund', transaction_id)
+        self.assertIsNot(self.client.get_transaction_status(transaction_id), status)
+        self.assertIsNot(self.client.get_account_balance(), balance)
+        self.assertEqual(self.server.requests, 6)
+
+    def test_invalidate(self):
+        transaction_id = self.client.pay('order-1', 'token', '1.00').transaction_id
+        self.client.get_transaction_status(transaction_id)
+        self.client.get_account_balance()
+        self.cache.invalidate('GetTransactionStatus', TransactionId='another')
+        self.assertEqual(self.cache.stats()['GetTransactionStatus']['size'], 1)
+        self.cache.invalidate('GetTransactionStatus', TransactionId=transaction_id)
+        self.assertEqual(self.cache.stats()['GetTransactionStatus']['size'], 0)
+        self.assertEqual(self.cache.stats()['GetAccountBalance']['size'], 1)
+        self.cache.invalidate()
+        self.assertEqual(self.cache.stats()['GetAccountBalance']['size'], 0)
+
+    def test_eviction(self):
+        cache = ResponseCache({'GetTransactionStatus': CachePolicy(max_size=2)})
+        client = self.make_client('AK1', cache=cache)
+        ids = [client.pay('order-%d' % i, 'token', '1.00').transaction_id for i in range(3)]
+        for transaction_id in ids:
+            client.get_transaction_status(transaction_id)
+        client.get_transaction_status(ids[0])
+        stats = cache.stats()['GetTransactionStatus']
+        self.assertEqual((stats['hits'], stats['evictions'], stats['size']), (0, 2, 2))
+
+    def test_accounts_are_isolated(self):
+        other = self.make_client('AK2', cache=self.cache)
+        self.client.pay('order-1', 'token', '1.00')
+        mine = self.client.get_account_balance()
+        theirs = other.get_account_balance()
+        self.assertIsNot(theirs, mine)
+        self.assertEqual(self.server.requests, 3)
+        self.assertIs(other.get_account_balance(), theirs)
+        self.assertIs(self.client.get_account_balance(), mine)
+        # A Pay on one account leaves the other's balance cached.
+        other.pay('order-2', 'token', '1.00')
+        self.assertIs(self.client.get_account_balance(), mine)
+        self.assertIsNot(other.get_account_balance(), theirs)
+        self.cache.invalidate('GetAccountBalance', self.client.scope())
+        self.assertEqual(self.cache.stats()['GetAccountBalance']['size'], 1)
+
+    def test_endpoints_are_isolated(self):
+        production = StandInServer(keys=self.keys).start()
+        self.addCleanup(production.stop)
+        sandbox = self.client.get_account_balance()
+        client = self.make_client('AK1', cache=self.cache)
+        client.api = production.api
+        self.assertIsNot(client.get_account_balance(), sandbox)
+        self.assertEqual((self.server.requests, production.requests), (1, 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import threading
+import time
+import unittest
+from flexpay.coalesce import SingleFlight
+from flexpay.standin import fixed
+from tests import StandInTestCase
+
+def concurrently(*calls):
+    results = [None] * len(calls)
+    start = threading.Event()
+
+    def run(i, call):
+        start.wait()
+        results[i] = call()
+
+    threads = [threading.Thread(target=run, args=(i, call)) for i, call in enumerate(calls)]
+    for t in threads:
+        t.start()
+    start.set()
+    for t in threads:
+        t.join()
+    return results
+
+class SingleFlightTest(unittest.TestCase):
+    def test_scope_separates_callers(self):
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def send(value):
+            def call():
+                release.wait()
+                return value
+            return call
+
+        params = {'Action': 'GetAccountBalance'}
+        results = {}
+
+        def run(name, scope):
+            results[name] = flight.call(params, send(name), scope)
+
+        threads = [threading.Thread(target=run, args=args) for args in [('a1', ('AK1', 'url')),
+                                                                        ('a2', ('AK1', 'url')),
+                                                                        ('b', ('AK2', 'url')),
+                                                                        ('c', ('AK1', 'other-url'))]]
+        for t in threads:
+            t.start()
+        while flight.calls < 4:
+            time.sleep(0.001)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(flight.coalesced, 1)
+        self.assertEqual(results['a1'], results['a2'])
+        self.assertEqual(results['b'], 'b')
+        self.assertEqual(results['c'], 'c')
+
+class SharedSingleFlightTest(StandInTestCase):
+    keys = {'AK1': 'SK1', 'AK2': 'SK2'}
+    server_options = {'latency': fixed(0.2)}
+
+    def setUp(self):
+        super(SharedSingleFlightTest, self).setUp()
+        self.flight = SingleFlight()
+
+    def client(self, key):
+        return self.make_client(key, single_flight=self.flight)
+
+    def test_same_account_is_coalesced(self):
+        a1, a2 = self.client('AK1'), self.client('AK1')
+        first, second = concurrently(a1.get_account_balance, a2.get_account_balance)
+        self.assertIs(first, second)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_different_accounts_are_not_coalesced(self):
+        a, b = self.client('AK1'), self.client('AK2')
+        first, second = concurrently(a.get_account_balance, b.get_account_balance)
+        self.assertIsNot(first, second)
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(self.flight.coalesced, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+from flexpay.exceptions import RestAPIException
+from flexpay.instrument import Aggregator, CallbackSink, Histogram, Instrumentation, StatsdSink
+from flexpay.standin import fixed
+from flexpay.transport import PooledTransport
+from tests import StandInTestCase
+
+class InstrumentationTest(StandInTestCase):
+    server_options = {'latency': fixed(0.05)}
+
+    def setUp(self):
+        super(InstrumentationTest, self).setUp()
+        self.timings = []
+        self.stats = Aggregator()
+        self.lines = []
+        self.instrument = Instrumentation(self.stats,
+                                          CallbackSink(self.timings.append),
+                                          StatsdSink(write=self.lines.append))
+        self.transport = PooledTransport()
+        self.addCleanup(self.transport.close)
+        self.client = self.make_client(transport=self.transport, instrument=self.instrument)
+
+    def test_phases(self):
+        self.client.get_account_balance()
+        self.client.get_account_balance()
+        first, second = self.timings
+        # Only the first call opened a connection.
+        self.assertEqual(sorted(first.phases), ['connect', 'parse', 'read', 'sign', 'wait'])
+        self.assertEqual(sorted(second.phases), ['parse', 'read', 'sign', 'wait'])
+        for timing in (first, second):
+            self.assertTrue(timing.ok)
+            self.assertEqual(timing.status, 200)
+            self.assertEqual(timing.action, 'GetAccountBalance')
+            # The stand-in waits before it answers, so the wait is at least its latency.
+            self.assertGreaterEqual(timing.phases['wait'], 0.05)
+            self.assertLessEqual(sum(timing.phases.values()), timing.duration + 0.001)
+        self.assertEqual(self.instrument.in_flight, 0)
+
+    def test_error(self):
+        self.assertRaises(RestAPIException, self.client.get_transaction_status, 'no-such-transaction')
+        timing, = self.timings
+        self.assertFalse(timing.ok)
+        self.assertIsInstance(timing.error, RestAPIException)
+        self.assertEqual(timing.status, 400)
+        self.assertNotIn('parse', timing.phases)
+        self.assertEqual(self.instrument.in_flight, 0)
+
+    def test_aggregator(self):
+        for i in range(3):
+            self.client.pay('order-%d' % i, 'token', '1.00')
+        self.assertRaises(RestAPIException, self.client.get_transaction_status, 'no-such-transaction')
+        snapshot = self.stats.snapshot()
+        pay = snapshot['Pay']
+        self.assertEqual(pay['total']['count'], 3)
+        self.assertEqual(pay['wait']['count'], 3)
+        self.assertGreaterEqual(pay['total']['p50_ms'], 50)
+        self.assertEqual((pay['in_flight'], pay['successes'], pay['errors']), (0, 3, {}))
+        status = snapshot['GetTransactionStatus']
+        self.assertEqual((status['successes'], status['errors']), (0, {400: 1}))
+
+    def test_statsd(self):
+        self.client.get_account_balance()
+        started, finished = self.lines
+        self.assertEqual(started, 'flexpay.in_flight:+1|g')
+        lines = finished.split('\n')
+        self.assertEqual(lines[0], 'flexpay.in_flight:-1|g')
+        self.assertIn('flexpay.GetAccountBalance.status.200:1|c', lines)
+        names = sorted(line.split(':')[0] for line in lines[1:] if line.endswith('|ms'))
+        self.assertEqual(names, ['flexpay.GetAccountBalance.' + phase
+                                 for phase in ('connect', 'parse', 'read', 'sign', 'total', 'wait')])
+
+class HistogramTest(unittest.TestCase):
+    def test_percentiles(self):
+        h = Histogram()
+        self.assertIsNone(h.percentile(50))
+        for ms in [1] * 90 + [40] * 9 + [300]:
+            h.add(ms)
+        self.assertEqual(h.percentile(50), 1)
+        self.assertEqual(h.percentile(99), 50)
+        self.assertEqual(h.percentile(100), 300)
+        summary = h.summary()
+        self.assertEqual((summary['count'], summary['max_ms']), (100, 300))
+        self.assertAlmostEqual(summary['mean_ms'], (90 + 360 + 300) / 100.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import httplib
+import threading
+import unittest
+import urllib
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+from flexpay.aio import asyncio
+from flexpay.ipn import IPNReceiver
+from flexpay.verify import CertificateCache, SignatureVerifier
+from tests import StandInTestCase
+from tests.test_verify import CERTIFICATE, URL_END_POINT, signed_params
+
+if asyncio is not None:
+    from trollius import From, Return
+    from flexpay.ipn import AsyncIPNReceiver
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class _ReceiverTest(StandInTestCase):
+    def setUp(self):
+        super(_ReceiverTest, self).setUp()
+        self.fetches = [] # The threads certificates were fetched on.
+        self.unreachable = False
+        self.delivered = []
+        client = self.make_client()
+        response = client.pay('order-1', 'token', '1.00')
+        self.params = signed_params(notificationType='TransactionStatus',
+                                    transactionId=response.transaction_id,
+                                    callerReference='order-1',
+                                    operation='PAY')
+
+    def fetcher(self, url):
+        self.fetches.append(threading.current_thread())
+        if self.unreachable:
+            raise IOError('unreachable')
+        return CERTIFICATE
+
+    def verifier(self):
+        return SignatureVerifier(CertificateCache(self.fetcher))
+
+    def body(self, **changes):
+        params = dict(self.params, **changes)
+        return urllib.urlencode(params)
+
+class IPNReceiverTest(_ReceiverTest):
+    def setUp(self):
+        super(IPNReceiverTest, self).setUp()
+        self.receiver = IPNReceiver(URL_END_POINT, callback=self.delivered.append, verifier=self.verifier())
+        httpd = make_server('127.0.0.1', 0, self.receiver, handler_class=_QuietHandler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        self.port = httpd.server_address[1]
+
+    def request(self, body, method='POST'):
+        connection = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        try:
+            connection.request(method, '/fps/ipn', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+            return connection.getresponse().status
+        finally:
+            connection.close()
+
+    def test_valid_signature(self):
+        self.assertEqual(self.request(self.body()), 200)
+        self.assertEqual(self.request(self.body()), 200)
+        self.assertEqual([n.transaction_id for n in self.delivered], [self.params['transactionId']])
+        self.assertEqual(self.delivered[0].caller_reference, 'order-1')
+        self.assertEqual(self.receiver.duplicates, 1)
+
+    def test_bad_signature(self):
+        self.assertEqual(self.request(self.body(transactionStatus='FAILURE')), 403)
+        self.assertEqual((self.delivered, self.receiver.rejected), ([], 1))
+
+    def test_certificate_fetch_failure(self):
+        self.unreachable = True
+        self.assertEqual(self.request(self.body()), 503)
+        # FPS sends it again later, and then it goes through.
+        self.unreachable = False
+        self.assertEqual(self.request(self.body()), 200)
+        self.assertEqual(len(self.delivered), 1)
+
+    def test_not_post(self):
+        self.assertEqual(self.request(None, 'GET'), 405)
+        self.assertEqual((self.delivered, self.fetches), ([], []))
+
+@unittest.skipIf(asyncio is None, 'trollius is not installed')
+class AsyncIPNReceiverTest(_ReceiverTest):
+    def setUp(self):
+        super(AsyncIPNReceiverTest, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+        @asyncio.coroutine
+        def deliver(notification):
+            self.delivered.append(notification)
+
+        self.receiver = AsyncIPNReceiver(URL_END_POINT, callback=deliver, verifier=self.verifier(), loop=self.loop)
+        server = self.loop.run_until_complete(self.receiver.start_server('127.0.0.1', 0))
+        self.addCleanup(self.loop.run_until_complete, server.wait_closed())
+        self.addCleanup(server.close)
+        self.port = server.sockets[0].getsockname()[1]
+
+    @asyncio.coroutine
+    def _request(self, body, method):
+        reader, writer = yield From(asyncio.open_connection('127.0.0.1', self.port, loop=self.loop))
+        try:
+            writer.write('{0} /fps/ipn HTTP/1.1\r\nContent-Length: {1}\r\nConnection: close\r\n\r\n{2}'.format(
+                method, len(body), body))
+            status_line = yield From(reader.readline())
+        finally:
+            writer.close()
+        raise Return(int(status_line.split()[1]))
+
+    def request(self, body, method='POST'):
+        return self.loop.run_until_complete(asyncio.wait_for(self._request(body, method), 5, loop=self.loop))
+
+    def test_valid_signature(self):
+        self.assertEqual(self.request(self.body()), 200)
+        self.assertEqual(self.request(self.body()), 200)
+        self.assertEqual([n.transaction_id for n in self.delivered], [self.params['transactionId']])
+        self.assertEqual(self.receiver.duplicates, 1)
+        self.assertNotIn(threading.current_thread(), self.fetches)
+
+    def test_bad_signature(self):
+        self.assertEqual(self.request(self.body(transactionStatus='FAILURE')), 403)
+        self.assertEqual((self.delivered, self.receiver.rejected), ([], 1))
+
+    def test_certificate_fetch_failure(self):
+        self.unreachable = True
+        self.assertEqual(self.request(self.body()), 503)
+        # The failed fetch ran on the executor once, not again on the loop.
+        self.assertEqual(len(self.fetches), 1)
+        self.assertIsNot(self.fetches[0], threading.current_thread())
+        self.unreachable = False
+        self.assertEqual(self.request(self.body()), 200)
+        self.assertEqual(len(self.delivered), 1)
+
+    def test_not_post(self):
+        self.assertEqual(self.request('', 'GET'), 405)
+        self.assertEqual((self.delivered, self.fetches), ([], []))
+
+if __name__ == '__main__':
+    unittest.main()
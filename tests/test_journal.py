@@ -0,0 +1,223 @@
+import os
+import socket
+import stat
+import unittest
+from flexpay.exceptions import RestAPIException
+from flexpay.journal import Journal, recover, _HEADER
+from flexpay.payment import FlexPay
+from flexpay.utils import make_enum
+from tests import StandInTestCase, TestCase, unused_port
+
+def pay_params(order_id, amount='1.00'):
+    return {'Action': 'Pay', 'CallerReference': order_id, 'SenderTokenId': 'token',
+            'TransactionAmount.Value': amount, 'TransactionAmount.CurrencyCode': 'USD'}
+
+def record_offsets(path):
+    # Offsets of the intact records at the start of the journal file.
+    with open(path, 'rb') as f:
+        data = f.read()
+    offsets = []
+    pos = 0
+    while True:
+        length, crc = _HEADER.unpack_from(data, pos)
+        if length == 0:
+            return offsets, data
+        offsets.append((pos, length))
+        pos += _HEADER.size + length
+
+def error(status, code):
+    return RestAPIException(status, 'Error', '<Response><Errors><Error><Code>{0}</Code></Error></Errors></Response>'
+                                             .format(code))
+
+def patch(path, offset, data):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+class JournalTest(TestCase):
+    def setUp(self):
+        self.path = os.path.join(self.mkdtemp(), 'flexpay.journal')
+
+    def reopen(self, journal=None):
+        if journal is not None:
+            journal.close()
+        return Journal(self.path, chunk_size=4096)
+
+    def test_pending_survives_reopen(self):
+        journal = self.reopen()
+        first = journal.intent(pay_params('order-1'))
+        journal.intent(pay_params('order-2'))
+        journal.outcome(first, error=socket.error('reset'))
+        journal = self.reopen(journal)
+        self.assertEqual([e.params['CallerReference'] for e in journal.pending()], ['order-1', 'order-2'])
+        self.assertEqual(journal.intent(pay_params('order-3')).id, 3)
+        journal.close()
+
+    def test_grows(self):
+        journal = self.reopen()
+        for i in range(200):
+            journal.intent(pay_params('order-%d' % i))
+        journal = self.reopen(journal)
+        self.assertEqual(len(journal.pending()), 200)
+        self.assertGreater(os.path.getsize(self.path), 4096)
+        journal.close()
+
+    def test_torn_last_record(self):
+        journal = self.reopen()
+        for i in range(3):
+            journal.intent(pay_params('order-%d' % i))
+        journal.close()
+        offsets, data = record_offsets(self.path)
+        pos, length = offsets[-1]
+        patch(self.path, pos + _HEADER.size + length // 2, 'X')
+        journal = self.reopen()
+        self.assertEqual([e.id for e in journal.pending()], [1, 2])
+        self.assertEqual(journal.intent(pay_params('order-new')).id, 3)
+        journal = self.reopen(journal)
+        self.assertEqual([e.params['CallerReference'] for e in journal.pending()], ['order-0', 'order-1', 'order-new'])
+        journal.close()
+
+    def test_partial_record_at_end_of_file(self):
+        journal = self.reopen()
+        for i in range(3):
+            journal.intent(pay_params('order-%d' % i))
+        journal.close()
+        offsets, data = record_offsets(self.path)
+        pos, length = offsets[-1]
+        with open(self.path, 'r+b') as f:
+            f.truncate(pos + _HEADER.size + length - 1)
+        journal = self.reopen()
+        self.assertEqual([e.id for e in journal.pending()], [1, 2])
+        journal.close()
+
+    def test_records_after_a_torn_one_stay_dropped(self):
+        journal = self.reopen()
+        entries = [journal.intent(pay_params('order-%d' % i)) for i in range(3)]
+        journal.outcome(entries[0], error=None)
+        journal.close()
+        offsets, data = record_offsets(self.path)
+        # Tear the second intent, the records after it are intact on disk.
+        pos, length = offsets[1]
+        patch(self.path, pos + _HEADER.size, 'X')
+        journal = self.reopen()
+        self.assertEqual([e.id for e in journal.pending()], [1])
+        # A record of the same length written over the torn one must not bring back the old ones after it.
+        journal.intent(pay_params('order-9'))
+        journal = self.reopen(journal)
+        self.assertEqual([e.params['CallerReference'] for e in journal.pending()], ['order-0', 'order-9'])
+        journal.close()
+
+    def test_retriable_errors_stay_pending(self):
+        journal = self.reopen()
+        errors = [error(503, 'RequestThrottled'),
+                  error(503, 'ServiceUnavailable'),
+                  error(500, 'InternalError'),
+                  RestAPIException(502, 'Bad Gateway', '<html>Bad Gateway</html>'),
+                  error(400, 'RequestThrottled'),
+                  error(400, 'InvalidParams'),
+                  error(403, 'SignatureDoesNotMatch')]
+        entries = [journal.intent(pay_params('order-%d' % i)) for i in range(len(errors))]
+        for entry, e in zip(entries, errors):
+            journal.outcome(entry, error=e)
+        self.assertEqual([e.id for e in journal.pending()], [1, 2, 3, 4, 5])
+        self.assertEqual(entries[5].outcome, {'ok': False, 'status': 400, 'code': 'InvalidParams'})
+        journal = self.reopen(journal)
+        self.assertEqual([e.id for e in journal.pending()], [1, 2, 3, 4, 5])
+        journal.close()
+
+    def test_compact_is_synced(self):
+        journal = self.reopen()
+        journal.intent(pay_params('order-1'))
+        events = []
+        fsync, rename = os.fsync, os.rename
+
+        def recording_fsync(fd):
+            events.append('fsync ' + ('directory' if stat.S_ISDIR(os.fstat(fd).st_mode) else 'file'))
+            fsync(fd)
+
+        def recording_rename(src, dst):
+            events.append('rename')
+            rename(src, dst)
+
+        os.fsync, os.rename = recording_fsync, recording_rename
+        try:
+            journal.compact()
+        finally:
+            os.fsync, os.rename = fsync, rename
+        # The new journal is on disk before it replaces the old one, and the rename is on disk after.
+        rename_at = events.index('rename')
+        self.assertIn('fsync file', events[:rename_at])
+        self.assertIn('fsync directory', events[rename_at:])
+        journal.close()
+
+    def test_compact(self):
+        journal = self.reopen()
+        entries = [journal.intent(pay_params('order-%d' % i)) for i in range(5)]
+        for entry in entries[:4]:
+            journal.outcome(entry, error=None)
+        journal.compact()
+        journal = self.reopen(journal)
+        self.assertEqual([e.params['CallerReference'] for e in journal.pending()], ['order-4'])
+        journal.close()
+
+class RecoverTest(StandInTestCase):
+    def setUp(self):
+        super(RecoverTest, self).setUp()
+        self.path = os.path.join(self.mkdtemp(), 'flexpay.journal')
+        self.client = self.make_client()
+
+    def test_replay_after_crash(self):
+        journal = Journal(self.path)
+        # The first Pay reached FPS before the crash, the second never left.
+        sent = journal.intent(pay_params('order-1'))
+        original = self.client.send_uncached(dict(sent.params))
+        journal.intent(pay_params('order-2'))
+        journal.intent({'Action': 'Settle', 'ReserveTransactionId': 'T'})
+        journal.close()
+
+        journal = Journal(self.path)
+        replays = recover(self.client, journal)
+        self.assertEqual([(r.entry.params['Action'], r.replayed) for r in replays],
+                         [('Pay', True), ('Pay', True), ('Settle', False)])
+        self.assertEqual(replays[0].response.transaction_id, original.transaction_id)
+        self.assertNotEqual(replays[1].response.transaction_id, original.transaction_id)
+        # Two charges, not three.
+        self.assertEqual(len(list(self.client.iter_account_activity('2000-01-01T00:00:00Z'))), 2)
+        self.assertEqual([e.action for e in journal.pending()], ['Settle'])
+        journal.close()
+        journal = Journal(self.path)
+        self.assertEqual([e.action for e in journal.pending()], ['Settle'])
+        journal.close()
+
+    def test_server_errors_are_replayed_again(self):
+        journal = Journal(self.path)
+        journal.intent(pay_params('order-1'))
+        self.server.error_rate = 1.0
+        replay, = recover(self.client, journal)
+        self.assertTrue(replay.replayed)
+        self.assertEqual(replay.error.code, 'InternalError')
+        self.assertEqual(len(journal.pending()), 1)
+        self.server.error_rate = 0.0
+        replay, = recover(self.client, journal)
+        self.assertEqual(str(replay.response.transaction_status), 'Success')
+        self.assertEqual(journal.pending(), [])
+        journal.close()
+
+    def test_client_journals_writes(self):
+        journal = Journal(self.path)
+        client = self.make_client(journal=journal)
+        client.pay('order-1', 'token', '1.00')
+        client.get_account_balance()
+        self.assertEqual(journal.pending(), [])
+        journal.close()
+
+    def test_unanswered_call_stays_pending(self):
+        journal = Journal(self.path)
+        api = make_enum(str, API_URL='http://127.0.0.1:{0}/'.format(unused_port()), CBUI_URL=self.server.api.CBUI_URL)
+        client = FlexPay('AK', 'SK', api=api, journal=journal)
+        self.assertRaises(socket.error, client.pay, 'order-1', 'token', '1.00')
+        self.assertEqual([e.params['CallerReference'] for e in journal.pending()], ['order-1'])
+        journal.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import threading
+import unittest
+from datetime import datetime, timedelta
+from flexpay.paging import iter_pages
+from tests import StandInTestCase
+
+class _Pages(object):
+    '''
+    A listing of ten items, three to a page. Page keys are the index of the first item.
+    '''
+
+    def __init__(self, fail_at=None):
+        self.fetched = []
+        self.threads = set()
+        self.fail_at = fail_at
+        self.last_page_fetched = threading.Event()
+
+    def fetch(self, key):
+        self.fetched.append(key)
+        self.threads.add(threading.current_thread().name)
+        if key == 9:
+            self.last_page_fetched.set()
+        if key == self.fail_at:
+            raise IOError('page {0} failed'.format(key))
+        return range(10)[key:key + 3]
+
+    def next_key(self, page):
+        return page[-1] + 1 if page[-1] < 9 else None
+
+class IterPagesTest(unittest.TestCase):
+    def test_every_page_once(self):
+        for prefetch in (True, False):
+            pages = _Pages()
+            self.assertEqual(list(iter_pages(pages.fetch, 0, pages.next_key, prefetch)),
+                             [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]])
+            self.assertEqual(pages.fetched, [0, 3, 6, 9])
+
+    def test_prefetch_fetches_next_page_before_it_is_asked_for(self):
+        pages = _Pages()
+        listing = iter_pages(pages.fetch, 0, pages.next_key)
+        for i in range(3):
+            next(listing)
+        # The last page is fetched while the caller still holds the third.
+        self.assertTrue(pages.last_page_fetched.wait(5))
+        self.assertEqual(pages.fetched, [0, 3, 6, 9])
+        self.assertEqual(len(pages.threads), 4)
+        listing.close()
+
+    def test_without_prefetch_pages_are_fetched_on_demand(self):
+        pages = _Pages()
+        listing = iter_pages(pages.fetch, 0, pages.next_key, prefetch=False)
+        next(listing)
+        self.assertEqual(pages.fetched, [0])
+        self.assertEqual(pages.threads, set([threading.current_thread().name]))
+
+    def test_error_raised_where_the_page_is_consumed(self):
+        for prefetch in (True, False):
+            pages = _Pages(fail_at=6)
+            listing = iter_pages(pages.fetch, 0, pages.next_key, prefetch)
+            self.assertEqual(next(listing), [0, 1, 2])
+            self.assertEqual(next(listing), [3, 4, 5])
+            self.assertRaises(IOError, next, listing)
+
+class IterAccountActivityTest(StandInTestCase):
+    def setUp(self):
+        super(IterAccountActivityTest, self).setUp()
+        self.client = self.make_client()
+        for i in range(7):
+            self.client.pay('order-%d' % i, 'token-%d' % i, '1.00')
+        self.start = datetime.utcnow() - timedelta(hours=1)
+
+    def test_follows_next_starting_date(self):
+        for prefetch in (True, False):
+            self.server.requests = 0
+            activity = self.client.iter_account_activity(self.start, max_batch_size=3, prefetch=prefetch)
+            self.assertEqual([t.CallerReference.value for t in activity], ['order-%d' % i for i in range(7)])
+            self.assertEqual(self.server.requests, 3)
+
+    def test_single_page(self):
+        activity = list(self.client.iter_account_activity(self.start))
+        self.assertEqual(len(activity), 7)
+        self.assertEqual(self.server.requests, 8)
+
+    def test_iter_tokens(self):
+        self.assertEqual(sorted(t.TokenId.value for t in self.client.iter_tokens()),
+                         ['token-%d' % i for i in range(7)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import threading
+import unittest
+from flexpay.polling import StatusPoller
+from flexpay.results import TransactionStatus
+from tests import StandInTestCase
+
+class StatusPollerTest(StandInTestCase):
+    server_options = {'settle_delay': 0.2}
+
+    def setUp(self):
+        super(StatusPollerTest, self).setUp()
+        self.client = self.make_client()
+        self.transaction_ids = [self.client.pay('order-%d' % i, 'token', '1.00').transaction_id for i in range(5)]
+
+    def run_with_timeout(self, poller, timeout=10):
+        outcome = []
+
+        def run():
+            try:
+                poller.run()
+                outcome.append(None)
+            except Exception, e:
+                outcome.append(e)
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        t.join(timeout)
+        self.assertFalse(t.is_alive(), 'run() did not return')
+        return outcome[0]
+
+    def test_polls_until_terminal(self):
+        events = []
+        poller = StatusPoller(self.client, max_workers=2, initial_delay=0.05, callback=events.append)
+        poller.add_all(self.transaction_ids)
+        self.assertIsNone(self.run_with_timeout(poller))
+        final = dict((e.transaction_id, e.status) for e in events if e.terminal)
+        self.assertEqual(sorted(final), sorted(self.transaction_ids))
+        self.assertTrue(all(s == TransactionStatus.Success for s in final.values()))
+        self.assertEqual(len(poller), 0)
+
+    def test_callback_error_stops_run(self):
+        def callback(event):
+            raise ValueError('callback failed')
+
+        for workers in (1, 4):
+            poller = StatusPoller(self.client, max_workers=workers, initial_delay=0.05, callback=callback)
+            poller.add_all(self.transaction_ids)
+            error = self.run_with_timeout(poller)
+            self.assertIsInstance(error, ValueError)
+
+    def test_callback_error_raised_from_events(self):
+        def callback(event):
+            raise ValueError('callback failed')
+
+        poller = StatusPoller(self.client, max_workers=1, initial_delay=0.05, callback=callback)
+        poller.add_all(self.transaction_ids)
+        self.assertRaises(ValueError, list, poller.events())
+
+if __name__ == '__main__':
+    unittest.main()
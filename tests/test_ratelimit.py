@@ -0,0 +1,114 @@
+import unittest
+from flexpay.exceptions import RestAPIException
+from flexpay.ratelimit import RateController, RateLimiter
+from tests import StandInTestCase
+
+class _Clock(object):
+    '''
+    A clock that only moves when something sleeps.
+    '''
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+def error(status, code=None):
+    body = '<Response><Errors><Error><Code>{0}</Code></Error></Errors></Response>'.format(code) if code else ''
+    return RestAPIException(status, 'Error', body)
+
+class RateControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+
+    def controller(self, **kwargs):
+        return RateController(clock=self.clock, sleep=self.clock.sleep, **kwargs)
+
+    def test_throttle_halves_rate(self):
+        c = self.controller(rate=16, min_rate=3)
+        granted = c.acquire()
+        c.record(granted, throttled=True)
+        self.assertEqual(c.rate, 8)
+        # Throttles of requests sent before the decrease don't count again.
+        c.record(granted, throttled=True)
+        self.assertEqual(c.rate, 8)
+        self.assertEqual(c.throttles, 2)
+        for expected in (4, 3, 3):
+            c.record(c.acquire(), throttled=True)
+            self.assertEqual(c.rate, expected)
+
+    def test_slow_start_until_first_throttle(self):
+        c = self.controller(rate=4, max_rate=10)
+        for expected in (5, 6, 7):
+            c.record(c.acquire())
+            self.assertEqual(c.rate, expected)
+        for i in range(10):
+            c.record(c.acquire())
+        self.assertEqual(c.rate, 10)
+
+    def test_additive_increase_up_to_ceiling(self):
+        c = self.controller(rate=20, max_rate=12, increase=1.0)
+        c.record(c.acquire(), throttled=True)
+        self.assertEqual(c.rate, 10)
+        # A second of successful calls at 10 per second adds about one request per second.
+        for i in range(10):
+            c.record(c.acquire())
+        self.assertAlmostEqual(c.rate, 11, delta=0.05)
+        for i in range(100):
+            c.record(c.acquire())
+        self.assertEqual(c.rate, 12)
+
+    def test_acquire_waits_for_a_token(self):
+        c = self.controller(rate=4, burst=2)
+        c.acquire()
+        c.acquire()
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertEqual(c.acquire(), 1000.25)
+        self.assertEqual(self.clock.sleeps, [0.25])
+        # After a throttle the bucket is emptied and the next request waits at the lower rate.
+        self.clock.now += 10
+        c.record(c.acquire(), throttled=True)
+        del self.clock.sleeps[:]
+        c.acquire()
+        self.assertEqual(self.clock.sleeps, [0.5])
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        self.pay = RateController(rate=8, clock=self.clock, sleep=self.clock.sleep)
+        self.default = RateController(rate=8, clock=self.clock, sleep=self.clock.sleep)
+        self.limiter = RateLimiter(self.default, {'Pay': self.pay})
+
+    def test_throttle_codes(self):
+        for e, throttled in [(error(503, 'RequestThrottled'), True),
+                             (error(503, 'ServiceUnavailable'), True),
+                             (error(503), True),
+                             (error(500, 'InternalError'), False),
+                             (error(400, 'InvalidParams'), False)]:
+            rate = self.default.rate
+            self.clock.now += 1
+            self.limiter.record(self.limiter.acquire('GetAccountBalance'), e)
+            self.assertEqual(self.default.rate, rate / 2 if throttled else rate, e.code)
+        self.assertEqual(self.pay.rate, 8)
+
+    def test_actions_have_their_own_controller(self):
+        self.limiter.record(self.limiter.acquire('Pay'), error(503, 'RequestThrottled'))
+        self.assertEqual(self.limiter.rates(), {'Pay': 4, None: 8})
+
+class ThrottledClientTest(StandInTestCase):
+    server_options = {'throttle_rate': 1.0}
+
+    def test_client_reports_throttles(self):
+        controller = RateController(rate=8)
+        client = self.make_client(rate_limiter=RateLimiter(controller))
+        self.assertRaises(RestAPIException, client.get_account_balance)
+        self.assertEqual((controller.rate, controller.throttles), (4, 1))
+
+if __name__ == '__main__':
+    unittest.main()
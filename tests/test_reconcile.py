@@ -0,0 +1,121 @@
+import os
+import unittest
+from StringIO import StringIO
+from flexpay.reconcile import Reconciler, MISSING_IN_FPS, MISSING_IN_LEDGER, AMOUNT_DIFFERS, STATUS_DIFFERS
+from tests import StandInTestCase
+
+START = '2000-01-01T00:00:00Z'
+
+class _Interrupted(object):
+    '''
+    A client whose account activity stops with an error after count transactions.
+    '''
+
+    def __init__(self, client, count):
+        self.client = client
+        self.count = count
+
+    def iter_account_activity(self, *args, **kwargs):
+        for i, txn in enumerate(self.client.iter_account_activity(*args, **kwargs)):
+            if i == self.count:
+                raise IOError('connection reset')
+            yield txn
+
+def interrupted(text, lines):
+    # The lines of text, then an error.
+    for i, line in enumerate(StringIO(text)):
+        if i == lines:
+            raise IOError('disk error')
+        yield line
+
+def ledger(*rows):
+    return 'caller_reference,operation,amount,status\n' + ''.join(','.join(row) + '\n' for row in rows)
+
+class ReconcilerTest(StandInTestCase):
+    def setUp(self):
+        super(ReconcilerTest, self).setUp()
+        self.client = self.make_client()
+        self.rec = Reconciler(':memory:', status_map={'paid': 'Success'})
+        self.addCleanup(self.rec.close)
+
+    def load(self, text, rec=None):
+        rec = rec or self.rec
+        rec.load_ledger(StringIO(text))
+        return rec.load_activity(self.client, START)
+
+    def kinds(self, rec=None):
+        return sorted((m.kind, m.caller_reference, m.operation) for m in (rec or self.rec).mismatches())
+
+    def test_matching(self):
+        pay = self.client.pay('order-1', 'token', '10.00')
+        self.client.refund('order-1', pay.transaction_id)
+        self.client.pay('order-2', 'token', '5.00')
+        # The Pay and Refund of order-1 share its caller reference, each matches its own ledger row.
+        self.assertEqual(self.load(ledger(['order-1', 'Pay', '10', 'paid'],
+                                          ['order-1', 'Refund', '-10.00', 'Success'],
+                                          ['order-2', '', '5.0', 'paid'])), 3)
+        self.assertEqual(self.kinds(), [])
+        self.assertEqual(self.rec.summary(), {MISSING_IN_FPS: 0, MISSING_IN_LEDGER: 0, AMOUNT_DIFFERS: 0,
+                                              STATUS_DIFFERS: 0})
+
+    def test_match_by_transaction_id(self):
+        pay = self.client.pay('order-1', 'token', '10.00')
+        self.rec.load_ledger(StringIO('caller_reference,transaction_id,amount\nrenamed,{0},10.00\n'.format(
+            pay.transaction_id)))
+        self.rec.load_activity(self.client, START)
+        self.assertEqual(self.kinds(), [])
+
+    def test_missing_in_fps(self):
+        self.client.pay('order-1', 'token', '10.00')
+        self.load(ledger(['order-1', 'Pay', '10.00', 'paid'], ['order-1', 'Refund', '-10.00', 'paid'],
+                         ['order-2', 'Pay', '5.00', 'paid']))
+        self.assertEqual(self.kinds(), [(MISSING_IN_FPS, 'order-1', 'Refund'), (MISSING_IN_FPS, 'order-2', 'Pay')])
+
+    def test_missing_in_ledger(self):
+        pay = self.client.pay('order-1', 'token', '10.00')
+        self.client.refund('order-1', pay.transaction_id)
+        self.client.pay('order-2', 'token', '5.00')
+        self.load(ledger(['order-1', 'Pay', '10.00', 'paid']))
+        self.assertEqual(self.kinds(), [(MISSING_IN_LEDGER, 'order-1', 'Refund'),
+                                        (MISSING_IN_LEDGER, 'order-2', 'Pay')])
+
+    def test_amount_and_status_differ(self):
+        self.client.pay('order-1', 'token', '10.00')
+        self.client.pay('order-2', 'token', '5.00')
+        self.load(ledger(['order-1', 'Pay', '9.99', 'paid'], ['order-2', 'Pay', '5.00', 'refunded']))
+        self.assertEqual(self.kinds(), [(AMOUNT_DIFFERS, 'order-1', 'Pay'), (STATUS_DIFFERS, 'order-2', 'Pay')])
+        report = StringIO()
+        self.assertEqual(self.rec.write_report(report), 2)
+        lines = report.getvalue().splitlines()
+        self.assertEqual(lines[0], 'kind,caller_reference,operation,transaction_id,ledger_amount,fps_amount,'
+                                   'ledger_status,fps_status')
+        self.assertTrue(lines[1].startswith('amount_differs,order-1,Pay,'))
+        self.assertTrue(lines[1].endswith(',9.99,10.00,Success,Success'))
+
+    def test_resume_interrupted_run(self):
+        rows = []
+        for i in range(7):
+            pay = self.client.pay('order-%d' % i, 'token', '10.00')
+            rows.append(['order-%d' % i, 'Pay', '10.00', 'paid'])
+            if i % 2:
+                self.client.refund('order-%d' % i, pay.transaction_id)
+                rows.append(['order-%d' % i, 'Refund', '-10.00', 'paid'])
+        rows.append(['order-9', 'Pay', '1.00', 'paid'])
+        text = ledger(*rows)
+        path = os.path.join(self.mkdtemp(), 'recon.db')
+
+        rec = Reconciler(path, status_map={'paid': 'Success'}, commit_every=2)
+        self.assertRaises(IOError, rec.load_ledger, interrupted(text, 6))
+        self.assertRaises(IOError, rec.load_activity, _Interrupted(self.client, 5), START)
+        rec.close()
+
+        rec = Reconciler(path, status_map={'paid': 'Success'}, commit_every=2)
+        self.addCleanup(rec.close)
+        self.assertEqual(rec.load_ledger(StringIO(text)), 7)
+        rec.load_activity(self.client, START)
+        self.assertEqual(rec.db.execute('SELECT COUNT(*) FROM ledger').fetchone()[0], 11)
+        self.assertEqual(rec.db.execute('SELECT COUNT(*) FROM activity').fetchone()[0], 10)
+        self.assertEqual(self.kinds(rec), [(MISSING_IN_FPS, 'order-9', 'Pay')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import cPickle
+import pickle
+import unittest
+from StringIO import StringIO
+from flexpay.response import make_response, make_response_from_stream
+from flexpay.results import TransactionStatus
+
+ACTIVITY_XML = '''<?xml version="1.0"?>
+<GetAccountActivityResponse xmlns="http://fps.amazonaws.com/doc/2010-08-28/"><GetAccountActivityResult>\
+<BatchSize>2</BatchSize>\
+<Transaction><TransactionId>T1</TransactionId><CallerReference>order-1</CallerReference>\
+<TransactionStatus>Success</TransactionStatus>\
+<TransactionAmount><CurrencyCode>USD</CurrencyCode><Value>10.00</Value></TransactionAmount></Transaction>\
+<Transaction><TransactionId>T2</TransactionId><CallerReference>order-2</CallerReference>\
+<TransactionStatus>Failure</TransactionStatus>\
+<TransactionAmount><CurrencyCode>USD</CurrencyCode><Value>5.00</Value></TransactionAmount></Transaction>\
+</GetAccountActivityResult><ResponseMetadata><RequestId>r-1</RequestId></ResponseMetadata>\
+</GetAccountActivityResponse>'''
+
+def transactions(resp):
+    return [(t.TransactionId.value, t.CallerReference.value, t.TransactionStatus.value,
+             t.TransactionAmount.Value.value) for t in resp.getlist('Transaction')]
+
+class MakeResponseTest(unittest.TestCase):
+    def test_parse(self):
+        resp = make_response(ACTIVITY_XML, 'GetAccountActivity')
+        self.assertEqual(transactions(resp), [('T1', 'order-1', 'Success', '10.00'),
+                                              ('T2', 'order-2', 'Failure', '5.00')])
+        self.assertEqual(resp.RequestId, 'r-1')
+        self.assertEqual(resp.ResponseText, ACTIVITY_XML)
+
+    def test_stream_matches_parse_string(self):
+        expected = transactions(make_response(ACTIVITY_XML, 'GetAccountActivity'))
+        for chunk_size in (1, 7, 16384):
+            resp = make_response_from_stream(StringIO(ACTIVITY_XML), 'GetAccountActivity', chunk_size=chunk_size,
+                                             keep_text=False)
+            self.assertEqual(transactions(resp), expected)
+            self.assertRaises(AttributeError, getattr, resp, 'ResponseText')
+        resp = make_response_from_stream(StringIO(ACTIVITY_XML), 'GetAccountActivity')
+        self.assertEqual(transactions(resp), expected)
+        self.assertEqual(resp.ResponseText, ACTIVITY_XML)
+
+class PickleTest(unittest.TestCase):
+    def round_trips(self, resp):
+        for module in (pickle, cPickle):
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                yield module.loads(module.dumps(resp, protocol))
+
+    def test_response(self):
+        resp = make_response(ACTIVITY_XML, 'GetAccountActivity')
+        for copy in self.round_trips(resp):
+            self.assertIs(type(copy), type(resp))
+            self.assertEqual(transactions(copy), transactions(resp))
+            self.assertEqual(copy.RequestId, 'r-1')
+            self.assertEqual(copy.ResponseText, ACTIVITY_XML)
+            self.assertEqual(copy.get_name(), 'GetAccountActivityResult')
+
+    def test_typed_result(self):
+        xml = ('<PayResponse><PayResult><TransactionId>T1</TransactionId>'
+               '<TransactionStatus>Pending</TransactionStatus></PayResult></PayResponse>')
+        resp = make_response(xml, 'Pay', keep_text=False)
+        self.assertEqual(resp.transaction_status, TransactionStatus.Pending)
+        for copy in self.round_trips(resp):
+            self.assertIs(type(copy), type(resp))
+            self.assertEqual(copy.transaction_id, 'T1')
+            self.assertIs(copy.transaction_status, TransactionStatus.Pending)
+
+if __name__ == '__main__':
+    unittest.main()
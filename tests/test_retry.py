@@ -0,0 +1,102 @@
+import socket
+import unittest
+from flexpay.exceptions import RestAPIException
+from flexpay.retry import HedgePolicy, RetryPolicy
+from flexpay.standin import fixed
+from flexpay.transport import PooledTransport
+from flexpay.utils import make_enum
+from tests import StandInTestCase, unused_port
+
+class _LostResponses(object):
+    '''
+    Sends every request and then loses the response, like a connection reset after the request went out.
+    '''
+
+    def __init__(self):
+        self.transport = PooledTransport()
+
+    def open(self, url, timing=None):
+        response = self.transport.open(url, timing)
+        response.read()
+        response.close()
+        raise socket.error('connection reset')
+
+class RetryTest(StandInTestCase):
+    def setUp(self):
+        super(RetryTest, self).setUp()
+        self.sleeps = []
+        self.retry = RetryPolicy(max_attempts=3, sleep=self.sleeps.append)
+
+    def test_throttled_calls_are_retried(self):
+        self.server.throttle_rate = 1.0
+        client = self.make_client(retry=self.retry)
+        for call in (client.get_account_balance, lambda: client.pay('order-1', 'token', '1.00')):
+            self.server.requests = 0
+            try:
+                call()
+            except RestAPIException, e:
+                self.assertEqual(e.code, 'RequestThrottled')
+            else:
+                self.fail('RestAPIException not raised')
+            self.assertEqual(self.server.requests, 3)
+        self.assertEqual(len(self.sleeps), 4)
+        self.assertTrue(all(0 <= delay <= 0.2 for delay in self.sleeps))
+
+    def test_retried_pay_charges_once(self):
+        self.server.error_rate = 0.5
+        self.server.random.seed(1)
+        client = self.make_client(retry=RetryPolicy(max_attempts=20, sleep=self.sleeps.append))
+        for i in range(10):
+            client.pay('order-%d' % i, 'token', '1.00')
+        self.assertTrue(self.sleeps)
+        activity = client.iter_account_activity('2000-01-01T00:00:00Z', operation='Pay')
+        self.assertEqual(sorted(t.CallerReference.value for t in activity), ['order-%d' % i for i in range(10)])
+
+    def test_writes_not_retried_once_sent(self):
+        transport = _LostResponses()
+        self.addCleanup(transport.transport.close)
+        client = self.make_client(retry=self.retry, transport=transport)
+        self.assertRaises(socket.error, client.get_account_balance)
+        self.assertEqual(self.server.requests, 3)
+        for call, args in [(client.pay, ('order-1', 'token', '1.00')),
+                           (client.refund, ('order-1-refund', 'T1', '1.00')),
+                           (client.reserve, ('order-2', 'token', '1.00'))]:
+            self.server.requests = 0
+            self.assertRaises(socket.error, call, *args)
+            self.assertEqual(self.server.requests, 1)
+        self.assertEqual(len(self.sleeps), 2)
+
+    def test_writes_retried_when_connection_refused(self):
+        api = make_enum(str, API_URL='http://127.0.0.1:{0}/'.format(unused_port()), CBUI_URL=self.server.api.CBUI_URL)
+        client = self.make_client(retry=self.retry)
+        client.api = api
+        self.assertRaises(socket.error, client.pay, 'order-1', 'token', '1.00')
+        self.assertEqual(len(self.sleeps), 2)
+
+    def test_other_actions_not_retried(self):
+        self.server.error_rate = 1.0
+        client = self.make_client(retry=self.retry)
+        self.assertRaises(RestAPIException, client.settle, 'T1')
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(self.sleeps, [])
+
+class HedgeTest(StandInTestCase):
+    server_options = {'latency': fixed(0.3)}
+
+    def test_reads_are_hedged(self):
+        client = self.make_client(hedge=HedgePolicy(delay=0.05))
+        client.get_account_balance()
+        self.assertEqual(self.server.requests, 2)
+
+    def test_writes_are_not_hedged(self):
+        client = self.make_client(hedge=HedgePolicy(delay=0.05), retry=RetryPolicy(sleep=lambda delay: None))
+        transaction_id = client.pay('order-1', 'token', '1.00').transaction_id
+        client.refund('order-1-refund', transaction_id, '1.00')
+        self.assertEqual(self.server.requests, 2)
+
+    def test_refuses_writes(self):
+        for action in ('Pay', 'Refund', 'Settle'):
+            self.assertRaises(ValueError, HedgePolicy, actions=['GetAccountBalance', action])
+
+if __name__ == '__main__':
+    unittest.main()
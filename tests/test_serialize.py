@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import unittest
+from flexpay.response import Response, make_response
+from flexpay.results import GetAccountActivityResult, PayResult, TransactionStatus
+from flexpay.serialize import FORMATS, dumps, loads, msgpack, to_tuple, from_tuple
+from tests.test_response import ACTIVITY_XML, transactions
+
+PAY_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<PayResponse xmlns="http://fps.amazonaws.com/doc/2010-08-28/"><PayResult><TransactionId>T1</TransactionId>\
+<TransactionStatus>Pending</TransactionStatus><Note>Café</Note><Empty></Empty></PayResult>\
+<ResponseMetadata><RequestId>r-1</RequestId></ResponseMetadata></PayResponse>'''
+
+FORMAT_NAMES = sorted(name for name in FORMATS if name != 'msgpack' or msgpack is not None)
+
+class SerializeTest(unittest.TestCase):
+    def round_trips(self, resp, keep_text=False):
+        for format in FORMAT_NAMES:
+            yield format, loads(dumps(resp, format, keep_text), format)
+
+    def test_tuple(self):
+        resp = make_response(PAY_XML, 'Pay', keep_text=False)
+        data = to_tuple(resp)
+        self.assertEqual(data[:3], ('PayResult', '', 5))
+        # Children are in the order of the attribute dict.
+        self.assertEqual(sorted(zip(data[3::3], data[4::3], data[5::3])), [('Empty', '', 0),
+                                                                          ('Note', u'Café', 0),
+                                                                          ('RequestId', 'r-1', -1),
+                                                                          ('TransactionId', 'T1', 0),
+                                                                          ('TransactionStatus', 'Pending', 0)])
+        self.assertEqual(to_tuple(from_tuple(data)), data)
+
+    def test_round_trip(self):
+        resp = make_response(ACTIVITY_XML, 'GetAccountActivity')
+        for format, copy in self.round_trips(resp):
+            self.assertIs(type(copy), GetAccountActivityResult, format)
+            self.assertEqual(transactions(copy), transactions(resp))
+            self.assertEqual(copy.RequestId, 'r-1')
+            self.assertEqual(copy.BatchSize.value, '2')
+            self.assertRaises(AttributeError, getattr, copy, 'ResponseText')
+            self.assertEqual(to_tuple(copy), to_tuple(resp))
+
+    def test_typed_result(self):
+        resp = make_response(PAY_XML, 'Pay', keep_text=False)
+        for format, copy in self.round_trips(resp):
+            self.assertIs(type(copy), PayResult, format)
+            self.assertEqual(copy.transaction_id, 'T1')
+            self.assertIs(copy.transaction_status, TransactionStatus.Pending)
+            self.assertEqual(copy.Note.value, u'Café')
+            self.assertIsInstance(copy.Empty, Response)
+            self.assertEqual(copy.Empty.value, '')
+
+    def test_types(self):
+        resp = make_response(PAY_XML, 'Pay')
+        for format, copy in self.round_trips(resp, keep_text=True):
+            # The body is the bytes that were read, in every format.
+            self.assertIs(type(copy.ResponseText), str, format)
+            self.assertEqual(copy.ResponseText, PAY_XML)
+            self.assertEqual(copy.Note.value, u'Café')
+            if format != 'json':
+                self.assertIs(type(copy.Empty.value), type(resp.Empty.value), format)
+                self.assertIs(type(copy.Note.value), type(resp.Note.value), format)
+
+    def test_msgpack_missing(self):
+        if msgpack is not None:
+            self.skipTest('msgpack is installed')
+        self.assertRaises(ImportError, dumps, make_response(PAY_XML, 'Pay'), 'msgpack')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import threading
+import unittest
+from flexpay.cache import ResponseCache
+from flexpay.coalesce import SingleFlight
+from flexpay.exceptions import RestAPIException
+from flexpay.journal import Journal
+from flexpay.ratelimit import RateController, RateLimiter
+from flexpay.standin import StandInServer, fixed
+from flexpay.tenants import FlexPayPool
+from tests import StandInTestCase
+
+class FlexPayPoolTest(StandInTestCase):
+    keys = {'AK1': 'SK1', 'AK2': 'SK2'}
+
+    def setUp(self):
+        super(FlexPayPoolTest, self).setUp()
+        self.pool = FlexPayPool(api=self.server.api)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_clients_are_reused(self):
+        a = self.pool.client('AK1', 'SK1')
+        self.assertIs(self.pool.client('AK1', 'SK1'), a)
+        self.assertIsNot(self.pool.client('AK2', 'SK2'), a)
+        self.assertEqual((self.pool.hits, self.pool.misses), (1, 2))
+
+    def test_tenants_are_isolated(self):
+        a = self.pool.client('AK1', 'SK1')
+        b = self.pool.client('AK2', 'SK2')
+        a.pay('order-1', 'token-a', '1.00')
+        self.assertEqual(len(a.get_tokens().getlist('Token')), 1)
+        for client in (a, b):
+            self.assertIsNone(client.cache)
+            self.assertIsNone(client.single_flight)
+            self.assertIsNone(client.journal)
+        self.assertIs(a.transport, b.transport)
+        # Concurrent identical reads from two tenants each reach FPS with their own keys.
+        threads = [threading.Thread(target=c.get_account_balance) for c in (a, b)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.server.requests, 4)
+
+    def test_rejects_shared_state(self):
+        journal = Journal(os.path.join(self.mkdtemp(), 'journal'))
+        try:
+            for name, value in [('rate_limiter', RateLimiter()), ('journal', journal)]:
+                self.assertRaises(ValueError, FlexPayPool, api=self.server.api, **{name: value})
+        finally:
+            journal.close()
+
+    def test_shared_cache_and_single_flight(self):
+        cache = ResponseCache()
+        pool = FlexPayPool(api=self.server.api, cache=cache, single_flight=SingleFlight())
+        self.addCleanup(pool.close)
+        a = pool.client('AK1', 'SK1')
+        b = pool.client('AK2', 'SK2')
+        self.assertIs(a.cache, b.cache)
+        self.assertIs(a.single_flight, b.single_flight)
+        self.assertIsNot(a.get_account_balance(), b.get_account_balance())
+        self.assertEqual(self.server.requests, 2)
+        a.get_account_balance()
+        self.assertEqual(cache.stats()['GetAccountBalance']['hits'], 1)
+
+    def test_rate_limiter_per_tenant(self):
+        pool = FlexPayPool(api=self.server.api, rate_limiter_factory=lambda: RateLimiter(RateController(rate=8)))
+        self.addCleanup(pool.close)
+        a = pool.client('AK1', 'SK1')
+        b = pool.client('AK2', 'SK2')
+        self.assertIsNot(a.rate_limiter, b.rate_limiter)
+        # Another client for the same access key draws from the same budget.
+        self.assertIs(pool.client('AK1', 'other secret').rate_limiter, a.rate_limiter)
+        self.server.throttle_rate = 1.0
+        self.assertRaises(RestAPIException, a.get_account_balance)
+        self.assertEqual(a.rate_limiter.rates(), {None: 4})
+        self.assertEqual(b.rate_limiter.rates(), {None: 8})
+
+    def test_max_concurrency(self):
+        server = StandInServer(keys=self.keys, latency=fixed(0.1)).start()
+        pool = FlexPayPool(api=server.api, max_concurrency=2)
+        try:
+            client = pool.client('AK1', 'SK1')
+            peak = [0]
+            active = [0]
+            lock = threading.Lock()
+            transport = client.transport
+            open_ = transport.transport.open
+
+            def counting_open(url, timing=None):
+                with lock:
+                    active[0] += 1
+                    peak[0] = max(peak[0], active[0])
+                try:
+                    return open_(url, timing)
+                finally:
+                    with lock:
+                        active[0] -= 1
+
+            transport.transport.open = counting_open
+            threads = [threading.Thread(target=client.get_account_balance) for i in range(6)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(server.requests, 6)
+            self.assertLessEqual(peak[0], 2)
+        finally:
+            pool.close()
+            server.stop()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import httplib
+import socket
+import threading
+import unittest
+from flexpay.standin import StandInServer
+from flexpay.transport import ConnectionPool, PooledTransport, UrllibTransport
+from tests import unused_port
+
+class _OneShotServer(object):
+    '''
+    Answers the first request on a connection and closes it after reading the second, the way a server that
+    crashed while handling a request would.
+    '''
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.requests = 0
+        self._thread = threading.Thread(target=self.serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.sock.getsockname()[1])
+
+    def read_request(self, f):
+        line = f.readline()
+        if not line:
+            return False
+        while f.readline() not in ('\r\n', '\n', ''):
+            pass
+        self.requests += 1
+        return True
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            f = conn.makefile('rb')
+            if self.read_request(f):
+                conn.sendall('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+                self.read_request(f)
+            f.close()
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+class TransportTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.previous = socket.getdefaulttimeout()
+        socket.setdefaulttimeout(3.0)
+
+    def tearDown(self):
+        socket.setdefaulttimeout(self.previous)
+
+    def test_pooled_follows_default_timeout(self):
+        with StandInServer() as s:
+            transport = PooledTransport()
+            response = transport.open(s.url)
+            self.assertEqual(response._conn.sock.gettimeout(), 3.0)
+            response.read()
+            response.close()
+            transport.close()
+
+    def test_pooled_explicit_timeout(self):
+        with StandInServer() as s:
+            transport = PooledTransport(timeout=7.0)
+            response = transport.open(s.url)
+            self.assertEqual(response._conn.sock.gettimeout(), 7.0)
+            response.read()
+            response.close()
+            transport.close()
+
+    def test_urllib_follows_default_timeout(self):
+        self.assertIs(UrllibTransport().timeout, socket._GLOBAL_DEFAULT_TIMEOUT)
+
+class PooledResendTest(unittest.TestCase):
+    def test_no_resend_after_request_was_sent(self):
+        server = _OneShotServer()
+        transport = PooledTransport()
+        try:
+            response = transport.open(server.url)
+            self.assertEqual(response.read(), 'ok')
+            response.close()
+            # The second request reaches the server on the reused connection, which then drops it. Sending
+            # it again could run a Pay twice.
+            self.assertRaises((httplib.HTTPException, socket.error), transport.open, server.url)
+            self.assertEqual(server.requests, 2)
+        finally:
+            transport.close()
+            server.close()
+
+class ConnectionPoolTest(unittest.TestCase):
+    def test_failed_prewarm_gives_connections_back(self):
+        pool = ConnectionPool('http', '127.0.0.1', unused_port(), max_size=2, timeout=1.0)
+        for i in range(2):
+            self.assertRaises(socket.error, pool.prewarm)
+        acquired = []
+        t = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+        t.daemon = True
+        t.start()
+        t.join(5)
+        self.assertEqual(len(acquired), 1)
+        self.assertFalse(acquired[0][1])
+        pool.release(acquired[0][0], False)
+        pool.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+from flexpay.payment import PaymentMethod, CBUIPipeline, cbui_payment_methods
+
+class EnumTest(unittest.TestCase):
+    def test_reverse_lookup(self):
+        self.assertIs(PaymentMethod.reverse_lookup('CC'), PaymentMethod.CC)
+        self.assertIs(PaymentMethod.reverse_lookup(u'CC'), PaymentMethod.CC)
+        self.assertRaises(TypeError, PaymentMethod.reverse_lookup, 'XX')
+
+    def test_join_checks_identity(self):
+        self.assertEqual(PaymentMethod.join([PaymentMethod.ABT, PaymentMethod.CC]), 'ABT,CC')
+        self.assertRaises(TypeError, PaymentMethod.join, [PaymentMethod.ABT, 'CC'])
+        self.assertRaises(TypeError, PaymentMethod.join, [PaymentMethod(PaymentMethod.CC)])
+
+    def test_constructing_does_not_add_members(self):
+        count = len(PaymentMethod.instances)
+        PaymentMethod('ABT')
+        self.assertEqual(len(PaymentMethod.instances), count)
+
+    def test_parse_list(self):
+        self.assertEqual(PaymentMethod.parse_list('ABT, CC'), (PaymentMethod.ABT, PaymentMethod.CC))
+        self.assertIs(PaymentMethod.parse_list('ABT, CC'), PaymentMethod.parse_list('ABT, CC'))
+        self.assertRaises(TypeError, PaymentMethod.parse_list, 'ABT,XX')
+
+    def test_cbui_payment_methods(self):
+        self.assertEqual(cbui_payment_methods(CBUIPipeline.SingleUse, PaymentMethod.CC), 'CC')
+        self.assertRaises(TypeError, cbui_payment_methods, CBUIPipeline.SingleUse, ['CC'])
+        self.assertRaises(TypeError, cbui_payment_methods, 'SingleUse', [PaymentMethod.CC])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+import base64
+import os
+import unittest
+from datetime import datetime
+from hashlib import sha1, sha256
+from flexpay.signing import string_to_sign
+from flexpay.verify import Certificate, CertificateCache, SignatureVerifier
+from tests import StandInTestCase, TestCase
+
+# A self-signed 1024 bit RSA certificate valid until 2126, and its private exponent.
+CERTIFICATE = '''-----BEGIN CERTIFICATE-----
+MIICJjCCAY+gAwIBAgIUe/btdQq+q6/wflQ7BuwC4Px+HdwwDQYJKoZIhvcNAQEL
+BQAwJDEiMCAGA1UEAwwZZnBzLnNhbmRib3guYW1hem9uYXdzLmNvbTAgFw0yNjEw
+MTgwNDAzMzJaGA8yMTI2MDkyNDA0MDMzMlowJDEiMCAGA1UEAwwZZnBzLnNhbmRi
+b3guYW1hem9uYXdzLmNvbTCBnzANBgkqhkiG9w0BAQEFAAOBjQAwgYkCgYEApFGc
+ZqcmajkvHTfRr5nDzPAOM+ZzUWdDQdAO9g/wD2AuEZYgJURlEAN/XRajtVn2QJ5X
+iolosNoXmSBtpmdKw/rUkwfadvJ+ltGx30JK3fOD/vmtVRq09kR67l3oNHWpyN4O
+sFaK+AxTEswiV/kUr3EJ8+uoSPqqZL6+mXkWhM0CAwEAAaNTMFEwHQYDVR0OBBYE
+FCbwMRbjBocjNInddQIKrB3CAjMxMB8GA1UdIwQYMBaAFCbwMRbjBocjNInddQIK
+rB3CAjMxMA8GA1UdEwEB/wQFMAMBAf8wDQYJKoZIhvcNAQELBQADgYEAWEBtt3lc
+t6yBbESSK9qWuh0wtiEVtP0JAHEdhvGkYB6O/vONO19UgTAUBG64akWAxznHt29T
+BeB7uJ6ZCovUyQJ5dbs1fS8TUQ+uZcoJVCzWTaZxWbcSNQ1uytyEliU9dDegx0GP
+D+5jcDyisMbVQEWgJAREF1Jbi+YMQqW+J3I=
+-----END CERTIFICATE-----
+'''
+
+PRIVATE_EXPONENT = int(
+    '36fe9167d1dd8b83a3ff15657a6dee1832e7adfb1cf14bac38e4977d470c43391f72075aaede5b2ca6df039ac623b5fe'
+    '32d64bda33eef3f1aa2037b83b0f2af82f183501a6064eab15d6bed33bf9b60a44eadf29da789b9ea2f722fb15bf7e7b'
+    '78e046538d2b6b465dab0c71179f410431bead08efb4344d2adb79ce30f98fc9', 16)
+
+CERTIFICATE_URL = 'https://fps.sandbox.amazonaws.com/certs/test.pem'
+URL_END_POINT = 'https://shop.example.com/fps/ipn'
+
+SHA1_PREFIX = '3021300906052b0e03021a05000414'.decode('hex')
+SHA256_PREFIX = '3031300d060960864801650304020105000420'.decode('hex')
+
+def sign(message, digestmod=sha1, prefix=SHA1_PREFIX, padding='\xff'):
+    cert = Certificate(CERTIFICATE)
+    digest = prefix + digestmod(message).digest()
+    encoded = '\x00\x01' + padding * (cert.size - len(digest) - 3) + '\x00' + digest
+    m = pow(int(encoded.encode('hex'), 16), PRIVATE_EXPONENT, cert.modulus)
+    return '{0:0{1}x}'.format(m, cert.size * 2).decode('hex')
+
+def signed_params(**extra):
+    params = {
+        'transactionId': 'T1',
+        'transactionStatus': 'SUCCESS',
+        'signatureVersion': '2',
+        'signatureMethod': 'RSA-SHA1',
+        'certificateUrl': CERTIFICATE_URL,
+    }
+    params.update(extra)
+    params['signature'] = base64.b64encode(sign(string_to_sign(params, URL_END_POINT, 'POST')))
+    return params
+
+def der(data):
+    lines = [l for l in data.splitlines() if l and not l.startswith('-----')]
+    return base64.b64decode(''.join(lines))
+
+class CertificateTest(unittest.TestCase):
+    def test_parse(self):
+        cert = Certificate(CERTIFICATE)
+        self.assertEqual(cert.exponent, 65537)
+        self.assertEqual(cert.size, 128)
+        self.assertTrue(cert.valid_at(datetime.utcnow()))
+        self.assertEqual(cert.not_after.year, 2126)
+        self.assertEqual(Certificate(der(CERTIFICATE)).modulus, cert.modulus)
+
+    def test_malformed_der(self):
+        data = der(CERTIFICATE)
+        for bad in ['', '\x30', '\x30\x82', data[:40], data[:-20], '\x30\x84\xff\xff\xff\xff' + data[6:],
+                    '\x04\x03abc', 'not a certificate at all']:
+            self.assertRaises(ValueError, Certificate, bad)
+
+    def test_malformed_pem(self):
+        self.assertRaises(ValueError, Certificate, '-----BEGIN CERTIFICATE-----\nMIIC\n')
+        self.assertRaises(ValueError, Certificate, CERTIFICATE.replace('MIIC', '!!!!'))
+
+    def test_verify(self):
+        cert = Certificate(CERTIFICATE)
+        self.assertTrue(cert.verify('message', sign('message')))
+        self.assertTrue(cert.verify('message', sign('message', sha256, SHA256_PREFIX), 'RSA-SHA256'))
+
+    def test_rejects_bad_signatures(self):
+        cert = Certificate(CERTIFICATE)
+        signature = sign('message')
+        self.assertFalse(cert.verify('massage', signature))
+        self.assertFalse(cert.verify('message', signature[:-1]))
+        self.assertFalse(cert.verify('message', '\x00' + signature))
+        self.assertFalse(cert.verify('message', signature[:-1] + chr(ord(signature[-1]) ^ 1)))
+        self.assertFalse(cert.verify('message', '\x00' * len(signature)))
+        self.assertFalse(cert.verify('message', '\xff' * len(signature)))
+        self.assertFalse(cert.verify('message', signature, 'RSA-SHA256'))
+        self.assertFalse(cert.verify('message', signature, 'RSA-MD5'))
+
+    def test_rejects_signature_out_of_range(self):
+        cert = Certificate(CERTIFICATE)
+        for i in range(100):
+            message = 'message %d' % i
+            s = int(sign(message).encode('hex'), 16) + cert.modulus
+            if s < 1 << (cert.size * 8):
+                break
+        self.assertFalse(cert.verify(message, '{0:0{1}x}'.format(s, cert.size * 2).decode('hex')))
+
+    def test_rejects_bad_padding(self):
+        cert = Certificate(CERTIFICATE)
+        # Right digest, wrong DigestInfo or padding bytes.
+        self.assertFalse(cert.verify('message', sign('message', prefix=SHA256_PREFIX[:-1] + '\x14')))
+        self.assertFalse(cert.verify('message', sign('message', prefix='')))
+        self.assertFalse(cert.verify('message', sign('message', padding='\x00')))
+
+class SignatureVerifierTest(unittest.TestCase):
+    def setUp(self):
+        self.fetched = []
+
+        def fetcher(url):
+            self.fetched.append(url)
+            return CERTIFICATE
+
+        self.verifier = SignatureVerifier(CertificateCache(fetcher))
+
+    def test_valid(self):
+        self.assertTrue(self.verifier.verify(signed_params(), URL_END_POINT, 'POST'))
+        self.assertTrue(self.verifier.verify(signed_params(), URL_END_POINT, 'POST'))
+        self.assertEqual(self.fetched, [CERTIFICATE_URL])
+
+    def test_tampered(self):
+        params = signed_params()
+        params['transactionStatus'] = 'FAILURE'
+        self.assertFalse(self.verifier.verify(params, URL_END_POINT, 'POST'))
+        self.assertFalse(self.verifier.verify(signed_params(), 'https://other.example.com/ipn', 'POST'))
+        self.assertFalse(self.verifier.verify(signed_params(), URL_END_POINT, 'GET'))
+
+    def test_malformed(self):
+        params = signed_params()
+        for name, value in [('signature', '%%% not base64'), ('signature', ''), ('signatureVersion', '1'),
+                            ('certificateUrl', '')]:
+            bad = dict(params)
+            bad[name] = value
+            self.assertFalse(self.verifier.verify(bad, URL_END_POINT, 'POST'))
+        bad = dict(params)
+        del bad['signature']
+        self.assertFalse(self.verifier.verify(bad, URL_END_POINT, 'POST'))
+
+    def test_untrusted_certificate_url(self):
+        for url in ['https://evil.example.com/cert.pem', 'http://fps.sandbox.amazonaws.com/certs/test.pem']:
+            params = signed_params(certificateUrl=url)
+            self.assertRaises(ValueError, self.verifier.verify, params, URL_END_POINT, 'POST')
+        self.assertEqual(self.fetched, [])
+
+    def test_malformed_certificate(self):
+        verifier = SignatureVerifier(CertificateCache(lambda url: 'garbage'))
+        self.assertRaises(ValueError, verifier.verify, signed_params(), URL_END_POINT, 'POST')
+
+    def test_expired_certificate(self):
+        cert = self.verifier.certificates.get(CERTIFICATE_URL)
+        cert.not_after = datetime(2000, 1, 1)
+        self.assertFalse(self.verifier.verify(signed_params(), URL_END_POINT, 'POST'))
+
+class CertificateCacheTest(TestCase):
+    def setUp(self):
+        self.directory = self.mkdtemp()
+
+    def test_survives_restart(self):
+        fetched = []
+        CertificateCache(lambda url: fetched.append(url) or CERTIFICATE, directory=self.directory).get(CERTIFICATE_URL)
+        CertificateCache(lambda url: fetched.append(url) or CERTIFICATE, directory=self.directory).get(CERTIFICATE_URL)
+        self.assertEqual(fetched, [CERTIFICATE_URL])
+
+    def test_corrupt_file_is_fetched_again(self):
+        cache = CertificateCache(lambda url: CERTIFICATE, directory=self.directory)
+        with open(cache.path_for(CERTIFICATE_URL), 'wb') as f:
+            f.write(CERTIFICATE[:100])
+        fetched = []
+        cache = CertificateCache(lambda url: fetched.append(url) or CERTIFICATE, directory=self.directory)
+        self.assertEqual(cache.get(CERTIFICATE_URL).exponent, 65537)
+        self.assertEqual(fetched, [CERTIFICATE_URL])
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(cache.path_for(CERTIFICATE_URL))])
+
+class FlexPayVerifyTest(StandInTestCase):
+    def client(self, fetcher):
+        return self.make_client(verifier=SignatureVerifier(CertificateCache(fetcher)))
+
+    def test_local(self):
+        client = self.client(lambda url: CERTIFICATE)
+        self.assertTrue(client.verify_notification(signed_params(), URL_END_POINT))
+        self.assertEqual(self.server.requests, 0)
+
+    def test_fallback_when_certificate_unavailable(self):
+        def fetcher(url):
+            raise IOError('unreachable')
+
+        client = self.client(fetcher)
+        self.assertRaises(IOError, client.verify_notification, signed_params(), URL_END_POINT)
+        self.assertTrue(client.verify_notification(signed_params(), URL_END_POINT, fallback=True))
+        self.assertEqual(self.server.requests, 1)
+
+if __name__ == '__main__':
+    unittest.main()